@@ -9,8 +9,11 @@ import sys
 import re
 from datetime import datetime, timedelta
 from typing import List, Tuple, Optional
+from db_utils import DB_PATH, log_player_changes
+from epoch_schema import ensure_epoch_columns
+from match_features import DDL as MATCH_FEATURES_DDL, sync_match_features
+from player_matches import DDL as PLAYER_MATCHES_DDL, INDEX_DDL as PLAYER_MATCHES_INDEX_DDL, sync_player_matches
 
-DB_PATH = "betcity_results.db"
 RESULTS_URL = os.getenv('RESULTS_SOURCE_URL', 'https://ad.betcity.ru/d/score')
 REV = os.getenv('RESULTS_REV', '5')
 VER = os.getenv('RESULTS_VER', '39')
@@ -57,24 +60,34 @@ def create_tables(db_path=DB_PATH):
             PRIMARY KEY (match_id, set_no)
         )
     """)
+    # Матч с точки зрения игрока (player_matches.py): строка за player1 и строка за player2
+    c.execute(PLAYER_MATCHES_DDL)
+    c.execute(PLAYER_MATCHES_INDEX_DDL)
+    c.execute(MATCH_FEATURES_DDL)
     conn.commit()
+    ensure_epoch_columns(conn)  # *_epoch INTEGER + индексы (разовая миграция, дальше — no-op)
     conn.close()
-    print("Таблицы results, match_results, set_scores созданы/актуализированы.")
+    print("Таблицы results, match_results, set_scores, player_matches, match_features созданы/актуализированы.")
 
 def prune_old_results(db_path=DB_PATH, months=ROLLING_MONTHS):
     """
-    Удаляет все матчи старше X месяцев во всех таблицах
+    Удаляет все матчи старше X месяцев во всех таблицах;
+    их игроки пишутся в журнал player_changes (паспорта в кэше passport_service содержат эти матчи)
     """
     cutoff = (datetime.now() - timedelta(days=months*30)).strftime('%Y-%m-%d')
     conn = sqlite3.connect(db_path)
     c = conn.cursor()
     # Сначала найти match_id старых матчей
-    c.execute("SELECT match_id FROM results WHERE finished < ?", (cutoff,))
-    old_ids = [row[0] for row in c.fetchall()]
+    c.execute("SELECT match_id, player1, player2 FROM results WHERE finished < ?", (cutoff,))
+    old = c.fetchall()
+    old_ids = [row[0] for row in old]
     print(f"Удаляем {len(old_ids)} старых матчей до {cutoff}...")
     if old_ids:
         ids_tuple = tuple(old_ids)
+        log_player_changes(conn, [(p, mid) for mid, p1, p2 in old for p in (p1, p2)])
         # Удаляем из set_scores, match_results, results
+        c.execute(f"DELETE FROM match_features WHERE match_id IN ({','.join(['?']*len(ids_tuple))})", ids_tuple)
+        c.execute(f"DELETE FROM player_matches WHERE match_id IN ({','.join(['?']*len(ids_tuple))})", ids_tuple)
         c.execute(f"DELETE FROM set_scores WHERE match_id IN ({','.join(['?']*len(ids_tuple))})", ids_tuple)
         c.execute(f"DELETE FROM match_results WHERE match_id IN ({','.join(['?']*len(ids_tuple))})", ids_tuple)
         c.execute(f"DELETE FROM results WHERE match_id IN ({','.join(['?']*len(ids_tuple))})", ids_tuple)
@@ -135,11 +148,17 @@ def parse_results(feed: dict) -> List[dict]:
     return events
 
 def save_to_db(events, db_path=DB_PATH):
+    """
+    Upsert матчей в results; возвращает (игрок, match_id) для новых и реально изменённых матчей —
+    и нынешние игроки, и прежние (при переименовании player1 / player2 паспорт старого имени тоже устарел).
+    """
     conn = sqlite3.connect(db_path)
     create_tables(db_path)
     c = conn.cursor()
+    changed = []
     for e in events:
         try:
+            old = c.execute("SELECT player1, player2 FROM results WHERE match_id = ?", (e['match_id'],)).fetchone()
             c.execute("""
                 INSERT INTO results (match_id, table_label, player1, player2, sc_ev, sc_ext_ev, finished)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
@@ -150,6 +169,12 @@ def save_to_db(events, db_path=DB_PATH):
                     sc_ev=excluded.sc_ev,
                     sc_ext_ev=excluded.sc_ext_ev,
                     finished=excluded.finished
+                WHERE results.table_label IS NOT excluded.table_label
+                   OR results.player1 IS NOT excluded.player1
+                   OR results.player2 IS NOT excluded.player2
+                   OR results.sc_ev IS NOT excluded.sc_ev
+                   OR results.sc_ext_ev IS NOT excluded.sc_ext_ev
+                   OR results.finished IS NOT excluded.finished
             """, (
                 e['match_id'],
                 e['table_label'],
@@ -159,10 +184,29 @@ def save_to_db(events, db_path=DB_PATH):
                 e['sc_ext_ev'],
                 e['finished']
             ))
+            if c.rowcount > 0:
+                players = [e['player1'], e['player2']]
+                players += [p for p in (old or ()) if p not in players]
+                changed += [(p, e['match_id']) for p in players]
         except Exception as ex:
             print("DB error:", ex)
     conn.commit()
     conn.close()
+    return changed
+
+def log_changes(changed, db_path=DB_PATH):
+    """
+    Журнал изменённых игроков для passport_service.py (инвалидация кэша паспортов).
+    Пишется после fill_match_results_and_sets, когда match_results / set_scores уже обновлены.
+    """
+    if not changed:
+        return
+    conn = sqlite3.connect(db_path)
+    try:
+        log_player_changes(conn, changed)
+        conn.commit()
+    finally:
+        conn.close()
 
 # --- Парсинг sc_ev, sc_ext_ev ---
 def parse_sets(sc_ev: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
@@ -238,7 +282,11 @@ def bulk_insert_set_scores(conn, match_id, set_scores: List[Tuple[int, int]]):
         """, (match_id, idx, p1_pts, p2_pts))
     conn.commit()
 
-def fill_match_results_and_sets(db_path=DB_PATH):
+def fill_match_results_and_sets(db_path=DB_PATH, match_ids=None):
+    """
+    Нормализует results в match_results / set_scores и обновляет player_matches и match_features
+    (признаки счёта из sc_ev / sc_ext_ev): по match_ids (новые / изменённые матчи из save_to_db), None — пересборка.
+    """
     conn = sqlite3.connect(db_path)
     create_tables(db_path)
     c = conn.cursor()
@@ -258,8 +306,10 @@ def fill_match_results_and_sets(db_path=DB_PATH):
         duration_sec, match_intensity = calc_duration_and_intensity(set_scores)
         upsert_match_results(conn, match_id, finished, p1_sets, p2_sets, winner_id, loser_id, duration_sec, match_intensity, progress, comeback)
         bulk_insert_set_scores(conn, match_id, set_scores)
+    sync_player_matches(conn, match_ids)
+    sync_match_features(conn, match_ids)
     conn.close()
-    print("match_results и set_scores успешно заполнены/обновлены!")
+    print("match_results, set_scores и player_matches успешно заполнены/обновлены!")
 
 # --- Live polling ---
 async def poll_results(interval_sec=60, db_path=DB_PATH):
@@ -271,8 +321,9 @@ async def poll_results(interval_sec=60, db_path=DB_PATH):
             feed = await fetch_json(url)
             evs = parse_results(feed)
             print(f"[{datetime.now().isoformat(timespec='seconds')}] Найдено {len(evs)} матчей за {date_str}.")
-            save_to_db(evs, db_path)
-            fill_match_results_and_sets(db_path)
+            changed = save_to_db(evs, db_path)
+            fill_match_results_and_sets(db_path, {mid for _, mid in changed})
+            log_changes(changed, db_path)
             prune_old_results(db_path)
         except Exception as ex:
             print(f"Ошибка на {date_str}: {ex}")
@@ -303,6 +354,7 @@ def run_main():
             start = datetime.strptime(args.from_date, "%Y-%m-%d")
             end = datetime.strptime(args.to_date, "%Y-%m-%d")
             curr = start
+            changed = []
             while curr <= end:
                 date_str = curr.strftime("%Y-%m-%d")
                 url = build_url(date_str)
@@ -311,12 +363,13 @@ def run_main():
                     feed = await fetch_json(url)
                     evs = parse_results(feed)
                     print(f"Найдено {len(evs)} матчей.")
-                    save_to_db(evs, args.db_path)
+                    changed += save_to_db(evs, args.db_path)
                 except Exception as ex:
                     print(f"Ошибка на {date_str}: {ex}")
                 curr += timedelta(days=1)
             print("Загрузка сырых данных завершена.")
-            fill_match_results_and_sets(args.db_path)
+            fill_match_results_and_sets(args.db_path, {mid for _, mid in changed})
+            log_changes(changed, args.db_path)
             prune_old_results(args.db_path)
             return
         if args.fill_matches:
@@ -82,3 +82,66 @@ def conn() -> sqlite3.Connection:
 #        # df = pd.read_sql_query(...) или SQL операции
 #    finally:
 #        conn.close()
+
+
+# --- Водяные знаки инкрементальных ETL ---
+
+def ensure_etl_state(conn: sqlite3.Connection) -> None:
+    """Таблица etl_state: до какого момента (watermark) каждый ETL уже обработал матчи."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS etl_state (
+            etl_name   TEXT PRIMARY KEY,
+            watermark  TEXT,
+            updated_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+
+
+def get_watermark(conn: sqlite3.Connection, etl_name: str):
+    """Возвращает watermark ETL или None, если ETL ещё не запускался (или сброшен)."""
+    ensure_etl_state(conn)
+    row = conn.execute("SELECT watermark FROM etl_state WHERE etl_name=?", (etl_name,)).fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(conn: sqlite3.Connection, etl_name: str, watermark) -> None:
+    """
+    Сохраняет watermark (None — сброс, следующий запуск будет полным).
+    Не коммитит: вызывающий код пишет watermark в одной транзакции с данными.
+    """
+    ensure_etl_state(conn)
+    conn.execute("""
+        INSERT INTO etl_state (etl_name, watermark, updated_at) VALUES (?, ?, datetime('now'))
+        ON CONFLICT(etl_name) DO UPDATE SET watermark=excluded.watermark, updated_at=excluded.updated_at
+    """, (etl_name, watermark))
+
+
+# --- Журнал изменённых игроков (инвалидация кэша паспортов) ---
+
+def ensure_player_changes(conn: sqlite3.Connection) -> None:
+    """Таблица player_changes: игроки новых/изменённых матчей в порядке записи (seq)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS player_changes (
+            seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_name TEXT,
+            match_id    INTEGER,
+            created_at  TEXT DEFAULT (datetime('now'))
+        )
+    """)
+
+
+def log_player_changes(conn: sqlite3.Connection, changes, keep_days: int = 1) -> None:
+    """
+    Записывает пары (player_name, match_id); записи старше keep_days удаляются.
+    Не коммитит.
+    """
+    ensure_player_changes(conn)
+    conn.executemany("INSERT INTO player_changes (player_name, match_id) VALUES (?, ?)",
+                     [(p, mid) for p, mid in changes if p])
+    conn.execute("DELETE FROM player_changes WHERE created_at < datetime('now', ?)", (f'-{keep_days} days',))
+
+
+def player_changes_since(conn: sqlite3.Connection, seq: int):
+    """Записи журнала после seq: [(seq, player_name)] по возрастанию seq."""
+    ensure_player_changes(conn)
+    return conn.execute("SELECT seq, player_name FROM player_changes WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
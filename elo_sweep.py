@@ -0,0 +1,176 @@
+"""
+elo_sweep.py
+------------
+Перебор параметров Elo (K-лестница, decay, MIN_ELO, масштаб) с бэктестом на истории матчей.
+
+- Матчи читаются из БД один раз, кодируются в массивы (encode_matches из player_elo_etl.py)
+  и раздаются воркерам пула процессов через initializer
+- Каждая конфигурация — полный прогон replay_kernel с нуля с её параметрами
+- Оценка: log-loss, Brier и accuracy ожидаемого результата player1 ДО матча (expected_score
+  по рейтингам на момент матча, т.е. прогноз следующего матча без заглядывания в будущее)
+- Первые --warmup-frac матчей (прогрев рейтингов) и матчи без победителя в оценку не идут
+- Текущая конфигурация (DEFAULT_PARAMS) всегда есть в сетке — видно, на каком она месте
+- Результат: таблица elo_sweep_results (дописывается; sweep_id + rank по log-loss внутри прогона)
+
+Запуск:
+    python elo_sweep.py                                   # сетка по умолчанию (384 конфигурации)
+    python elo_sweep.py --k-top 32,40 --k-bottom 16 --decay-rate 0,0.0003 --workers 8
+"""
+
+import argparse
+import itertools
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from db_utils import DB_PATH
+from epoch_schema import ensure_epoch_columns
+from etl_metrics import write_table
+from player_elo_etl import DEFAULT_PARAMS, encode_matches, initial_state, load_matches, load_players, replay_kernel
+
+EPS = 1e-15
+
+_DATA = {}  # матчи в массивах, заполняется в каждом воркере через _init_worker
+
+
+def _init_worker(data):
+    _DATA.update(data)
+
+
+def k_ladder(k_top, k_bottom, n_steps=len(DEFAULT_PARAMS['k_steps'])):
+    """Ступени K равномерно от k_top до k_bottom: (32, 16) -> (32, 28, 24, 20, 16)."""
+    return tuple(int(round(k)) for k in np.linspace(k_top, k_bottom, n_steps))
+
+
+def build_grid(k_tops, k_bottoms, decay_rates, graces, min_elos, scales):
+    grid = [DEFAULT_PARAMS]
+    for k_top, k_bottom, rate, grace, min_elo, scale in itertools.product(
+            k_tops, k_bottoms, decay_rates, graces, min_elos, scales):
+        params = dict(DEFAULT_PARAMS, k_steps=k_ladder(k_top, k_bottom), decay_rate=rate,
+                      decay_grace_days=grace, min_elo=min_elo, scale=scale)
+        if params != DEFAULT_PARAMS:
+            grid.append(params)
+    return grid
+
+
+def score(expected, s1, mask):
+    """log-loss / Brier / accuracy прогноза expected для исходов s1 (1/0) по маске оцениваемых матчей."""
+    p = np.clip(expected[mask], EPS, 1 - EPS)
+    y = s1[mask]
+    return {
+        'log_loss': float(-np.mean(y * np.log(p) + (1 - y) * np.log(1 - p))),
+        'brier': float(np.mean((p - y) ** 2)),
+        'accuracy': float(np.mean((p > 0.5) == (y == 1))),
+        'n_scored': int(mask.sum()),
+    }
+
+
+def evaluate(params):
+    """Один прогон истории с параметрами params (в воркере, данные из _DATA)."""
+    d = _DATA
+    t0 = time.perf_counter()
+    state = initial_state(range(d['n_players']), params['start_elo'])
+    out = replay_kernel(d['p1'], d['p2'], d['ts'], d['s1'], state, params)
+    res = score(out['expected'], d['s1'], d['mask'])
+    res['replay_sec'] = time.perf_counter() - t0
+    return res
+
+
+def load_data(conn, warmup_frac):
+    players = load_players(conn)
+    enc = encode_matches(load_matches(conn), players)
+    n = len(enc['s1'])
+    mask = (np.arange(n) >= int(n * warmup_frac)) & (enc['s1'] != 0.5)
+    return {
+        'n_players': len(players),
+        'p1': enc['p1'], 'p2': enc['p2'], 'ts': enc['ts'], 's1': enc['s1'],
+        'mask': mask,
+    }
+
+
+def run_sweep(data, grid, workers):
+    if workers <= 1:
+        _init_worker(data)
+        return [evaluate(p) for p in grid]
+    chunksize = max(1, len(grid) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as ex:
+        return list(ex.map(evaluate, grid, chunksize=chunksize))
+
+
+def results_frame(grid, scores, sweep_id):
+    rows = []
+    for params, res in zip(grid, scores):
+        rows.append({
+            'sweep_id': sweep_id,
+            'start_elo': params['start_elo'],
+            'min_elo': params['min_elo'],
+            'k_steps': '/'.join(str(k) for k in params['k_steps']),
+            'k_bounds': '/'.join(str(b) for b in params['k_bounds']),
+            'decay_rate': params['decay_rate'],
+            'decay_grace_days': params['decay_grace_days'],
+            'scale': params['scale'],
+            **res,
+            'is_default': int(params == DEFAULT_PARAMS),
+        })
+    df = pd.DataFrame(rows).sort_values(['log_loss', 'brier'], kind='mergesort').reset_index(drop=True)
+    df.insert(1, 'rank', np.arange(1, len(df) + 1))
+    return df
+
+
+def _floats(s):
+    return [float(x) for x in s.split(',')]
+
+
+def _ints(s):
+    return [int(x) for x in s.split(',')]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Перебор параметров Elo с бэктестом (log-loss / Brier)')
+    ap.add_argument('--db-path', default=DB_PATH)
+    ap.add_argument('--k-top', type=_floats, default=[24, 32, 40, 48], help='K новичка (первая ступень)')
+    ap.add_argument('--k-bottom', type=_floats, default=[8, 12, 16, 20], help='K опытного игрока (последняя ступень)')
+    ap.add_argument('--decay-rate', type=_floats, default=[0, 0.0001, 0.0003, 0.0006])
+    ap.add_argument('--grace', type=_ints, default=[1, 3, 7], help='Дней простоя без decay')
+    ap.add_argument('--min-elo', type=_floats, default=[0, 800])
+    ap.add_argument('--scale', type=_floats, default=[400])
+    ap.add_argument('--warmup-frac', type=float, default=0.1, help='Доля первых матчей, не идущих в оценку')
+    ap.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    ap.add_argument('--top', type=int, default=15, help='Сколько лучших конфигураций напечатать')
+    ap.add_argument('--no-save', action='store_true', help='Не писать elo_sweep_results')
+    args = ap.parse_args()
+
+    if not os.path.exists(args.db_path):
+        raise FileNotFoundError(f"База данных не найдена по пути: {args.db_path}")
+    conn = sqlite3.connect(args.db_path)
+    try:
+        ensure_epoch_columns(conn)
+        data = load_data(conn, args.warmup_frac)
+        grid = build_grid(args.k_top, args.k_bottom, args.decay_rate, args.grace, args.min_elo, args.scale)
+        print(f'Матчей: {len(data["s1"])}, в оценке: {int(data["mask"].sum())}, '
+              f'конфигураций: {len(grid)}, воркеров: {args.workers}')
+        t0 = time.perf_counter()
+        scores = run_sweep(data, grid, args.workers)
+        elapsed = time.perf_counter() - t0
+        sweep_id = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        df = results_frame(grid, scores, sweep_id)
+        print(f'Готово за {elapsed:.1f} с ({len(grid) / elapsed:.1f} конфигураций/с)')
+        with pd.option_context('display.width', 200, 'display.max_columns', None):
+            print(df.head(args.top).drop(columns=['sweep_id']).to_string(index=False))
+        default = df[df['is_default'] == 1].iloc[0]
+        print(f"\nТекущие параметры: место {default['rank']} из {len(df)}, "
+              f"log-loss {default['log_loss']:.5f}, Brier {default['brier']:.5f}")
+        if not args.no_save:
+            write_table(df, 'elo_sweep_results', conn, if_exists='append')
+            print('Результаты дописаны в elo_sweep_results')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+epoch_schema.py
+---------------
+Время матчей как целые epoch-секунды с индексом: разовая миграция схемы + чтение в ETL.
+
+- results.finished, match_results.finished_ts, player_matches.start_ts / finished_ts остаются TEXT —
+  парсер, внешние выгрузки и старые запросы работают как раньше
+- Рядом — сгенерированные колонки *_epoch INTEGER (GENERATED ALWAYS AS ... VIRTUAL, см. epoch_expr)
+  с индексом: значение считается SQLite из той же строки, разойтись с TEXT не может,
+  хранится только в индексе; нераспознанная строка / NULL -> NULL
+- Целое время (фолбэк парсера на date_ev) берётся как есть: в TEXT-колонке оно лежит строкой из цифр,
+  strftime('%s', ...) прочитал бы её как юлианский день и вернул NULL
+- Фильтр окна — `finished_epoch >= ?` (индексный range scan по целым), в pandas — epoch_to_datetime
+  (целые -> datetime64 без разбора строк) вместо pd.to_datetime(..., errors='coerce') по всей таблице
+- Семантика strftime('%s'): строка без зоны — как UTC, т.е. wall-clock сохраняется
+  (epoch_to_datetime даёт то же наивное время, что pd.to_datetime по строке 'YYYY-MM-DD HH:MM:SS')
+
+Миграция идемпотентна: ensure_epoch_columns добавляет недостающие колонки и индексы, а колонку,
+созданную с прежним выражением, пересоздаёт (create_tables в парсере результатов зовёт её при каждом старте).
+Нужен SQLite >= 3.35 (generated columns, DROP COLUMN).
+
+Запуск: python epoch_schema.py [--db-path betcity_results.db]
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from db_utils import DB_PATH
+from rating_index import table_exists
+
+# таблица -> [(TEXT-колонка, epoch-колонка)]
+EPOCH_COLUMNS = {
+    'results': [('finished', 'finished_epoch')],
+    'match_results': [('finished_ts', 'finished_epoch')],
+    'player_matches': [('start_ts', 'start_epoch'), ('finished_ts', 'finished_epoch')],
+}
+
+
+def epoch_expr(column):
+    return (f"CASE WHEN typeof({column}) = 'integer' THEN {column} "
+            f"WHEN {column} GLOB '[0-9]*' AND {column} NOT GLOB '*[^0-9]*' THEN CAST({column} AS INTEGER) "
+            f"ELSE CAST(strftime('%s', {column}) AS INTEGER) END")
+
+
+def _columns(conn, table):
+    # table_xinfo, а не table_info: сгенерированные колонки table_info не показывает
+    return {row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+
+
+def _table_sql(conn, table):
+    return conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+
+
+def ensure_epoch_columns(conn):
+    """
+    Добавляет недостающие epoch-колонки и индексы, пересоздаёт колонки с устаревшим выражением;
+    возвращает список добавленных/пересозданных 'таблица.колонка'. Коммитит.
+    """
+    added = []
+    for table, pairs in EPOCH_COLUMNS.items():
+        if not table_exists(conn, table):
+            continue
+        existing = _columns(conn, table)
+        for text_col, epoch_col in pairs:
+            if epoch_col in existing and epoch_expr(text_col) not in _table_sql(conn, table):
+                # Колонка от прежней версии миграции: индекс мешает DROP COLUMN, поэтому сначала он
+                conn.execute(f"DROP INDEX IF EXISTS idx_{table}_{epoch_col}")
+                conn.execute(f"ALTER TABLE {table} DROP COLUMN {epoch_col}")
+                existing.discard(epoch_col)
+            if epoch_col not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {epoch_col} INTEGER "
+                             f"GENERATED ALWAYS AS ({epoch_expr(text_col)}) VIRTUAL")
+                added.append(f'{table}.{epoch_col}')
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{epoch_col} ON {table}({epoch_col})")
+    conn.commit()
+    return added
+
+
+def to_epoch(ts):
+    """
+    Timestamp / строка -> epoch-секунды (int) для параметра `*_epoch >= ?`.
+    Округление вверх: для целых секунд `epoch >= to_epoch(ts)` <=> `время >= ts` и при дробном ts.
+    """
+    return int(-(-pd.Timestamp(ts).as_unit('ns').value // 10**9))
+
+
+def epoch_to_datetime(values):
+    """Колонка *_epoch (целые, NULL -> NaN) -> datetime64 (NaT для NULL)."""
+    values = pd.Series(values)
+    v = values.to_numpy(dtype=float)
+    ok = ~np.isnan(v)
+    out = np.full(len(v), np.datetime64('NaT'), dtype='datetime64[us]')
+    out[ok] = v[ok].astype(np.int64).astype('datetime64[s]')
+    return pd.Series(out, index=values.index)
+
+
+def epoch_hours(values):
+    """Час суток (0..23) по epoch-секундам; NULL -> -1."""
+    v = pd.Series(values).to_numpy(dtype=float)
+    return np.where(np.isnan(v), -1, np.floor_divide(np.nan_to_num(v), 3600) % 24).astype(np.int64)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Миграция: epoch-колонки (INTEGER, индекс) для времени матчей')
+    ap.add_argument('--db-path', default=DB_PATH)
+    args = ap.parse_args()
+    if not os.path.exists(args.db_path):
+        raise FileNotFoundError(f"База данных не найдена по пути: {args.db_path}")
+    conn = sqlite3.connect(args.db_path)
+    try:
+        t0 = time.perf_counter()
+        added = ensure_epoch_columns(conn)
+        print(f"Добавлено: {', '.join(added) if added else 'ничего (схема уже мигрирована)'} "
+              f"за {time.perf_counter() - t0:.1f} с")
+        for table, pairs in EPOCH_COLUMNS.items():
+            if table_exists(conn, table):
+                for text_col, epoch_col in pairs:
+                    bad = conn.execute(f"SELECT COUNT(*) FROM {table} "
+                                       f"WHERE {text_col} IS NOT NULL AND {epoch_col} IS NULL").fetchone()[0]
+                    if bad:
+                        print(f'  {table}.{text_col}: {bad} строк не распознаны SQLite как время ({epoch_col} = NULL)')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
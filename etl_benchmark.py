@@ -0,0 +1,425 @@
+"""
+etl_benchmark.py
+----------------
+Бенчмарк ETL-скриптов и write-путей парсеров на синтетической БД (synthetic_db.py).
+
+- Генерирует БД заданного масштаба (или берёт готовую через --db)
+- Прогоняет все player_*_etl.py, league_reference_etl_ultimate.py, player_passport_to_db.py
+  в порядке зависимостей, каждый в отдельном процессе
+- Замеряет wall/CPU, пиковую память, строки чтения/записи (через etl_metrics.py) и throughput (матчей/с)
+- Замеряет write-пути парсеров: results (save_to_db + fill_match_results_and_sets), line (process), live (write_tick)
+- Все ETL видят одно и то же замороженное pd.Timestamp.now() (--now), чтобы окна 1d/7d/... совпадали
+- --baseline-dir: прогоняет те же скрипты из другой ревизии (например, git worktree) на копии той же БД
+  и сверяет все выходные таблицы — оптимизированные версии должны давать идентичный результат
+- --elo-kernel N: matches/s ядра Elo (player_elo_etl.replay_kernel) на N синтетических матчей в памяти
+- --workers N: fix-скрипт паспортов (пул процессов etl_parallel) с --workers 1 и --workers N на копиях одной БД —
+  ускорение и проверка, что выход от числа процессов не зависит (таблицы должны совпасть точно)
+- Результаты дописываются в etl_runs файла --history-db (отчёт: python etl_metrics.py --db-path etl_bench.db)
+
+CLI:
+    python etl_benchmark.py --matches 100000 --players 400
+    python etl_benchmark.py --matches 1000000 --only player_fatigue_etl.py
+    python etl_benchmark.py --elo-kernel 3000000 --players 3000
+    python etl_benchmark.py --matches 300000 --workers 4
+    git worktree add ../qw122_base HEAD~5
+    python etl_benchmark.py --matches 200000 --baseline-dir ../qw122_base
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from etl_metrics import METRICS_ENV, ensure_runs_table, load_child_stats, record_run, snapshot
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_NAME = 'betcity_results.db'
+
+# Порядок важен: h2h читает player_style, паспорт — все player_*, SoS — player_elo
+BENCH_SCRIPTS = [
+    'player_elo_etl.py',
+    'player_glicko2_etl.py',
+    'player_fatigue_etl.py',
+    'player_style_etl.py',
+    'player_resilience_etl.py',
+    'player_h2h_etl.py',
+    'player_passport_etl.py',
+    'player_passport_etl_final_match_results_fix.py',
+    'league_reference_etl_ultimate.py',
+    'player_table_stats_etl.py',
+    'player_sos_windows_etl.py',
+]
+# player_passport_to_db.py пишет player_passports в другой схеме, чем fix-скрипт, — гоняем на отдельной копии
+ISOLATED_SCRIPTS = ['player_passport_to_db.py']
+
+OUTPUT_TABLES = {
+    'player_elo_etl.py': ['player_elo', 'player_elo_history'],
+    'player_glicko2_etl.py': ['glicko2_snapshot', 'glicko2_state'],
+    'player_fatigue_etl.py': ['player_fatigue'],
+    'player_style_etl.py': ['player_style'],
+    'player_resilience_etl.py': ['player_resilience'],
+    'player_h2h_etl.py': ['player_h2h'],
+    'player_passport_etl.py': ['player_passport'],
+    'player_passport_etl_final_match_results_fix.py': ['player_passports'],
+    'league_reference_etl_ultimate.py': ['league_reference_by_time'],
+    'player_table_stats_etl.py': ['player_table_stats'],
+    'player_sos_windows_etl.py': ['player_sos_windows'],
+    'player_passport_to_db.py': ['player_passports'],
+}
+VOLATILE_COLUMNS = {'last_updated'}
+PARSER_PATHS = ['results', 'line', 'live']
+# Скрипт, считающий игроков в пуле процессов (etl_parallel.run_sharded): сверка --workers 1 против --workers N
+PARALLEL_SCRIPT = 'player_passport_etl_final_match_results_fix.py'
+
+# Окна 1d/2d/... считаются от pd.Timestamp.now(): для честной сверки кандидат и baseline
+# запускаются с одним и тем же замороженным «сейчас»
+FROZEN_NOW_BOOT = (
+    "import os, runpy, sys\n"
+    "import pandas as pd\n"
+    "path, now = sys.argv[1], pd.Timestamp(sys.argv[2])\n"
+    "pd.Timestamp.now = classmethod(lambda cls, tz=None: now)\n"
+    "sys.argv = [path] + sys.argv[3:]\n"
+    "sys.path.insert(0, os.path.dirname(path))\n"
+    "runpy.run_path(path, run_name='__main__')\n"
+)
+
+
+# --- Запуск скриптов ---
+
+def run_script(code_dir, script, work_dir, now, args=()):
+    """Один ETL-скрипт в отдельном процессе; cwd = каталог с БД (скрипты открывают её по относительному пути)."""
+    fd, metrics_path = tempfile.mkstemp(prefix='bench_', suffix='.json')
+    os.close(fd)
+    env = {**os.environ, METRICS_ENV: metrics_path, 'BETCITY_DB_PATH': os.path.join(work_dir, DB_NAME)}
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', FROZEN_NOW_BOOT, os.path.join(code_dir, script), now, *args],
+                          cwd=work_dir, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    stats = load_child_stats(metrics_path) or {}
+    os.remove(metrics_path)
+    return {
+        'script': script,
+        'wall_sec': wall,
+        'cpu_sec': stats.get('cpu_sec'),
+        'peak_rss_kb': stats.get('peak_rss_kb'),
+        'rows_read': stats.get('rows_read'),
+        'rows_written': stats.get('rows_written'),
+        'lock_wait_sec': stats.get('lock_wait_sec'),
+        'returncode': proc.returncode,
+        'stderr': proc.stderr.strip().splitlines()[-1] if proc.returncode and proc.stderr.strip() else '',
+    }
+
+
+def run_pipeline(code_dir, db_path, work_root, scripts, now, verbose=True):
+    """Копирует БД в work_root и прогоняет скрипты по порядку; изолированные — каждый на своей копии."""
+    runs = []
+    main_dir = os.path.join(work_root, 'main')
+    os.makedirs(main_dir, exist_ok=True)
+    shutil.copy(db_path, os.path.join(main_dir, DB_NAME))
+    for script in scripts:
+        if not os.path.exists(os.path.join(code_dir, script)):
+            # Скрипта ещё нет в этом дереве (например, в baseline) — сверять нечего
+            runs.append({'script': script, 'wall_sec': None, 'returncode': None, 'db': None})
+            if verbose:
+                print(f"  {script:<50} {'-':>8}   нет в {code_dir}")
+            continue
+        if script in ISOLATED_SCRIPTS:
+            work_dir = os.path.join(work_root, script.replace('.py', ''))
+            os.makedirs(work_dir, exist_ok=True)
+            shutil.copy(db_path, os.path.join(work_dir, DB_NAME))
+        else:
+            work_dir = main_dir
+        run = run_script(code_dir, script, work_dir, now)
+        run['db'] = os.path.join(work_dir, DB_NAME)
+        runs.append(run)
+        if verbose:
+            status = 'ok' if run['returncode'] == 0 else f"FAIL: {run['stderr']}"
+            print(f"  {script:<50} {run['wall_sec']:8.2f}s  {status}")
+    return runs
+
+
+# --- Write-пути парсеров ---
+
+def bench_parser(path, db_path, n_matches, seed=42):
+    """Выполняется в дочернем процессе (--run-parser): генерирует фид и пишет его в пустую БД."""
+    import synthetic_db as syn
+    sim = syn.simulate_matches(max(20, n_matches // 20), n_matches, days=30, seed=seed)
+    names = syn.player_names(max(20, n_matches // 20))
+    rng = np.random.default_rng(seed)
+    if path == 'results':
+        import betcity_results_parser_all_in_one_rolling as parser
+        feed = syn.make_results_feed(sim, names, 0, n_matches)
+        t0 = time.perf_counter()
+        parser.save_to_db(parser.parse_results(feed), db_path)
+        parser.fill_match_results_and_sets(db_path)
+    elif path == 'line':
+        import line_parser_debug_v2 as parser
+        parser.DB = db_path
+        parser.create_tables()
+        feed = syn.make_line_feed(sim, names, 0, n_matches, rng)
+        t0 = time.perf_counter()
+        parser.process(parser.collect_events(feed))
+    elif path == 'live':
+        import live_parser_debug_v_3 as parser
+        parser.DB = db_path
+        parser.ensure_schema()
+        feed = syn.make_live_feed(sim, names, 0, n_matches, rng)
+        t0 = time.perf_counter()
+        asyncio.run(parser.write_tick(feed))
+    else:
+        raise ValueError(f'Неизвестный парсер: {path}')
+    wall = time.perf_counter() - t0
+    return {'wall_sec': wall, **snapshot()}
+
+
+def run_parser_bench(path, work_root, n_matches):
+    work_dir = os.path.join(work_root, f'parser_{path}')
+    os.makedirs(work_dir, exist_ok=True)
+    db_path = os.path.join(work_dir, DB_NAME)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-parser', path,
+                           '--db', db_path, '--parser-matches', str(n_matches)],
+                          cwd=work_dir, capture_output=True, text=True)
+    run = {'script': f'parser:{path}', 'returncode': proc.returncode,
+           'stderr': proc.stderr.strip().splitlines()[-1] if proc.returncode and proc.stderr.strip() else ''}
+    if proc.returncode == 0:
+        stats = json.loads(proc.stdout.strip().splitlines()[-1])
+        run.update(stats)
+        run['rows_written'] = n_matches
+    return run
+
+
+# --- Ядро Elo ---
+
+def bench_elo_kernel(n_matches, n_players, seed=42):
+    """matches/s у player_elo_etl.replay_kernel на синтетической истории в памяти (без БД)."""
+    import player_elo_etl
+    import synthetic_db as syn
+    sim = syn.simulate_matches(n_players, n_matches, days=360, seed=seed)
+    s1 = np.where(sim['p1_sets'] > sim['p2_sets'], 1.0, 0.0)
+    ts = sim['finished'].astype('datetime64[ns]').astype(np.int64)
+    state = player_elo_etl.initial_state(syn.player_names(n_players))
+    t0 = time.perf_counter()
+    player_elo_etl.replay_kernel(sim['p1'], sim['p2'], ts, s1, state)
+    wall = time.perf_counter() - t0
+    return {'script': 'elo:replay_kernel', 'wall_sec': wall, 'returncode': 0, **snapshot()}
+
+
+# --- Пул процессов (etl_parallel) ---
+
+def bench_workers(db_path, work_root, now, workers):
+    """
+    PARALLEL_SCRIPT с --full --workers 1 и --full --workers N, каждый на своей копии БД.
+    Возвращает (прогоны, {таблица: статус сверки}); сверка точная — порядок строк и значения.
+    """
+    runs = []
+    for w in (1, workers):
+        work_dir = os.path.join(work_root, f'workers_{w}')
+        os.makedirs(work_dir, exist_ok=True)
+        shutil.copy(db_path, os.path.join(work_dir, DB_NAME))
+        run = run_script(BASE_DIR, PARALLEL_SCRIPT, work_dir, now, ['--full', '--workers', str(w)])
+        run.update(script=f'{PARALLEL_SCRIPT} --workers {w}', db=os.path.join(work_dir, DB_NAME))
+        runs.append(run)
+    if any(r['returncode'] != 0 for r in runs):
+        return runs, {t: 'failed' for t in OUTPUT_TABLES[PARALLEL_SCRIPT]}
+    return runs, {t: compare_tables(runs[0]['db'], runs[1]['db'], t, exact=True) for t in OUTPUT_TABLES[PARALLEL_SCRIPT]}
+
+
+# --- Сверка выходных таблиц ---
+
+def _strip_volatile(df):
+    df = df.drop(columns=[c for c in df.columns if c in VOLATILE_COLUMNS])
+    if 'json_blob' in df.columns:
+        def strip(blob):
+            d = json.loads(blob)
+            for c in VOLATILE_COLUMNS:
+                d.pop(c, None)
+            return json.dumps(d, sort_keys=True, ensure_ascii=False)
+        df['json_blob'] = df['json_blob'].map(strip)
+    return df[sorted(df.columns)]
+
+
+def _normalize(a, b):
+    """
+    Пара таблиц к общему виду: числовая колонка с разным dtype (INTEGER в одной, REAL в другой) приводится
+    к общему — Int64, если все значения целые, иначе float64; ключи сортировки — общие не-float колонки,
+    т.е. обе таблицы сортируются по одним и тем же колонкам.
+    """
+    a, b = _strip_volatile(a), _strip_volatile(b)
+    for c in a.columns.intersection(b.columns):
+        if a[c].dtype != b[c].dtype and all(pd.api.types.is_numeric_dtype(x[c]) for x in (a, b)):
+            values = pd.concat([a[c], b[c]]).astype('float64')
+            integral = bool((values.dropna() % 1 == 0).all())
+            dtype = 'Int64' if integral else 'float64'
+            a[c], b[c] = a[c].astype('float64').astype(dtype), b[c].astype('float64').astype(dtype)
+    keys = [c for c in a.columns.intersection(b.columns)
+            if not pd.api.types.is_float_dtype(a[c]) and not pd.api.types.is_float_dtype(b[c])]
+    if keys:
+        a, b = a.sort_values(keys, kind='mergesort'), b.sort_values(keys, kind='mergesort')
+    return a.reset_index(drop=True), b.reset_index(drop=True)
+
+
+def compare_tables(db_a, db_b, table, exact=False):
+    """
+    'ok' | 'missing' | текст первого расхождения.
+    exact — без пересортировки строк и без допуска (одна ревизия кода, сравнивается только порядок исполнения).
+    """
+    ca, cb = sqlite3.connect(db_a), sqlite3.connect(db_b)
+    try:
+        try:
+            a = pd.read_sql_query(f"SELECT * FROM {table}", ca)
+            b = pd.read_sql_query(f"SELECT * FROM {table}", cb)
+        except Exception:
+            return 'missing'
+    finally:
+        ca.close()
+        cb.close()
+    try:
+        if exact:
+            pd.testing.assert_frame_equal(_strip_volatile(a), _strip_volatile(b), check_exact=True)
+        else:
+            pd.testing.assert_frame_equal(*_normalize(a, b), check_dtype=False,
+                                          check_exact=False, rtol=1e-9, atol=1e-9)
+    except AssertionError as e:
+        return ' '.join(str(e).split())[:200]
+    return 'ok'
+
+
+# --- Отчёт ---
+
+def record_history(history_db, batch_id, runs):
+    conn = sqlite3.connect(history_db)
+    try:
+        ensure_runs_table(conn)
+        for r in runs:
+            record_run(conn, batch_id, r['script'], batch_id, r.get('wall_sec'), r['returncode'], r)
+    finally:
+        conn.close()
+
+
+def print_report(runs, n_matches):
+    df = pd.DataFrame(runs)
+    df['matches_per_sec'] = np.where(df['wall_sec'] > 0, n_matches / df['wall_sec'], np.nan)
+    df['peak_rss_mb'] = df['peak_rss_kb'] / 1024
+    cols = ['script', 'wall_sec', 'cpu_sec', 'peak_rss_mb', 'rows_read', 'rows_written', 'matches_per_sec', 'returncode']
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(df[[c for c in cols if c in df.columns]].to_string(index=False, float_format=lambda x: f'{x:.2f}'))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Бенчмарк ETL и парсеров на синтетической БД')
+    ap.add_argument('--matches', type=int, default=100_000)
+    ap.add_argument('--players', type=int, default=400)
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--end-date', help='Конец синтетической истории YYYY-MM-DD (по умолчанию сегодня)')
+    ap.add_argument('--now', help='Замороженное «сейчас» для ETL (по умолчанию момент старта бенчмарка)')
+    ap.add_argument('--db', help='Готовая БД вместо генерации (копируется, оригинал не меняется)')
+    ap.add_argument('--only', nargs='*', help='Только эти скрипты (и/или parser:results|line|live)')
+    ap.add_argument('--parser-matches', type=int, default=5000, help='Матчей в фиде для write-путей парсеров')
+    ap.add_argument('--no-parsers', action='store_true')
+    ap.add_argument('--baseline-dir', help='Каталог с другой ревизией скриптов для сверки выходных таблиц')
+    ap.add_argument('--work-dir', help='Где держать копии БД (по умолчанию временный каталог, удаляется)')
+    ap.add_argument('--history-db', default='etl_bench.db', help='Куда дописывать результаты (таблица etl_runs)')
+    ap.add_argument('--elo-kernel', type=int, metavar='N', help='Только замер ядра Elo на N матчей')
+    ap.add_argument('--workers', type=int, metavar='N',
+                    help=f'Только {PARALLEL_SCRIPT}: --workers 1 против --workers N, выход должен совпасть')
+    ap.add_argument('--run-parser', choices=PARSER_PATHS, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run_parser:
+        print(json.dumps(bench_parser(args.run_parser, args.db, args.parser_matches, args.seed)))
+        return
+    if args.elo_kernel:
+        run = bench_elo_kernel(args.elo_kernel, args.players, args.seed)
+        print(f"replay_kernel: {args.elo_kernel} матчей за {run['wall_sec']:.2f}s — "
+              f"{args.elo_kernel / run['wall_sec']:,.0f} матчей/с, peak RSS {run['peak_rss_kb'] / 1024:.0f} MB")
+        record_history(args.history_db, f"bench:elo_kernel:{args.elo_kernel}", [run])
+        return
+
+    work_root = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='etl_bench_')
+    os.makedirs(work_root, exist_ok=True)
+    try:
+        if args.db:
+            src_db = os.path.abspath(args.db)
+            n_matches = sqlite3.connect(src_db).execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        else:
+            import synthetic_db
+            src_db = os.path.join(work_root, 'source.db')
+            print(f"Генерация: {args.players} игроков, {args.matches} матчей...")
+            t0 = time.perf_counter()
+            synthetic_db.generate_db(src_db, args.players, args.matches, end_date=args.end_date,
+                                     seed=args.seed, verbose=False)
+            print(f"  готово за {time.perf_counter() - t0:.1f}s")
+            n_matches = args.matches
+
+        now = args.now or datetime.now().isoformat(timespec='seconds')
+        if args.workers:
+            runs, statuses = bench_workers(src_db, work_root, now, args.workers)
+            for run in runs:
+                status = 'ok' if run['returncode'] == 0 else f"FAIL: {run['stderr']}"
+                print(f"  {run['script']:<60} {run['wall_sec']:8.2f}s  {status}")
+            print(f"  ускорение x{runs[0]['wall_sec'] / runs[1]['wall_sec']:.2f}")
+            record_history(args.history_db, f"bench:workers:{args.workers}:{n_matches}", runs)
+            print("\nСверка --workers 1 против --workers N:")
+            for table, status in statuses.items():
+                print(f"  {table:<28} {status}")
+            if any(status != 'ok' for status in statuses.values()):
+                print(f"\n⚠️ Выход {PARALLEL_SCRIPT} зависит от числа процессов")
+                sys.exit(1)
+            return
+
+        scripts = BENCH_SCRIPTS + ISOLATED_SCRIPTS
+        parsers = [] if args.no_parsers else PARSER_PATHS
+        if args.only:
+            scripts = [s for s in scripts if s in args.only]
+            parsers = [p for p in parsers if f'parser:{p}' in args.only]
+
+        print(f"ETL ({BASE_DIR}):")
+        runs = run_pipeline(BASE_DIR, src_db, os.path.join(work_root, 'candidate'), scripts, now)
+        for p in parsers:
+            run = run_parser_bench(p, work_root, args.parser_matches)
+            print(f"  parser:{p:<43} {run.get('wall_sec', float('nan')):8.2f}s")
+            runs.append(run)
+
+        batch_id = f"bench:{n_matches}:{datetime.now().isoformat(timespec='seconds')}"
+        print()
+        print_report([r for r in runs if not r['script'].startswith('parser:')], n_matches)
+        parser_runs = [r for r in runs if r['script'].startswith('parser:')]
+        if parser_runs:
+            print()
+            print_report(parser_runs, args.parser_matches)
+        record_history(args.history_db, batch_id, runs)
+
+        if args.baseline_dir:
+            base_dir = os.path.abspath(args.baseline_dir)
+            print(f"\nBaseline ({base_dir}):")
+            base_runs = run_pipeline(base_dir, src_db, os.path.join(work_root, 'baseline'), scripts, now)
+            print("\nСверка выходных таблиц:")
+            mismatches = 0
+            for cand, base in zip(runs, base_runs):
+                if base['db'] is None:
+                    continue
+                for table in OUTPUT_TABLES.get(cand['script'], []):
+                    status = compare_tables(cand['db'], base['db'], table)
+                    mismatches += status != 'ok'
+                    speedup = base['wall_sec'] / cand['wall_sec'] if cand['wall_sec'] else float('nan')
+                    print(f"  {table:<28} {status:<8} x{speedup:.1f} ({base['wall_sec']:.2f}s -> {cand['wall_sec']:.2f}s)")
+            if mismatches:
+                print(f"\n⚠️ Расхождений: {mismatches}")
+                sys.exit(1)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+etl_metrics.py
+--------------
+Инструментирование ETL-скриптов: время, CPU, память, строки, ожидание блокировок.
+
+Внутри ETL-скрипта:
+- read_sql(query, conn)          — pd.read_sql_query + учёт прочитанных строк
+- write_table(df, name, conn)    — to_sql + учёт записанных строк и времени ожидания блокировки БД
+- count_rows_read / count_rows_written — ручной учёт для чистого sqlite3
+- При завершении процесса (atexit) статистика пишется JSON-ом в файл из переменной
+  окружения ETL_METRICS_FILE. Если переменная не задана — ничего не пишется,
+  скрипты работают как раньше.
+
+В раннере (master_etl_runner.py):
+- ensure_runs_table(conn) / record_run(conn, ...) — таблица etl_runs (один ряд на запуск скрипта)
+
+CLI-отчёт по последним запускам (перцентили и регрессии):
+    python etl_metrics.py --last 20
+    python etl_metrics.py --last 50 --script player_sos_windows_etl.py --threshold 1.3
+"""
+
+import argparse
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource  # нет на Windows
+except ImportError:
+    resource = None
+
+METRICS_ENV = 'ETL_METRICS_FILE'
+DB_PATH = os.getenv('BETCITY_DB_PATH', 'betcity_results.db')
+
+_STATS = {
+    'rows_read': 0,
+    'rows_written': 0,
+    'lock_wait_sec': 0.0,
+}
+
+
+def count_rows_read(n):
+    _STATS['rows_read'] += int(n)
+
+
+def count_rows_written(n):
+    _STATS['rows_written'] += int(n)
+
+
+def read_sql(query, conn, **kwargs):
+    """pd.read_sql_query с учётом прочитанных строк."""
+    df = pd.read_sql_query(query, conn, **kwargs)
+    count_rows_read(len(df))
+    return df
+
+
+def acquire_write_lock(conn):
+    """
+    Открывает write-транзакцию (BEGIN IMMEDIATE) и учитывает, сколько ждали блокировку.
+    Ожидание ограничено timeout соединения (busy_timeout).
+    """
+    t0 = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    _STATS['lock_wait_sec'] += time.perf_counter() - t0
+
+
+def write_table(df, name, conn, if_exists='replace', index=False, **kwargs):
+    """
+    df.to_sql с учётом записанных строк и ожидания блокировки.
+    Блокировка берётся до DROP/CREATE, поэтому ожидание не смешивается со временем записи.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    acquire_write_lock(conn)
+    try:
+        df.to_sql(name, conn, if_exists=if_exists, index=index, **kwargs)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(df))
+
+
+def peak_rss_kb():
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS отдаёт байты, Linux — килобайты
+        return int(rss / 1024) if sys.platform == 'darwin' else int(rss)
+    try:
+        import psutil
+        mem = psutil.Process().memory_info()
+        return int(getattr(mem, 'peak_wset', mem.rss) / 1024)
+    except Exception:
+        return None
+
+
+def snapshot():
+    """Текущая статистика процесса (CPU, пиковая память, счётчики строк)."""
+    stats = dict(_STATS)
+    stats['cpu_sec'] = time.process_time()
+    stats['peak_rss_kb'] = peak_rss_kb()
+    return stats
+
+
+def _dump_on_exit():
+    path = os.getenv(METRICS_ENV)
+    if not path:
+        return
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot(), f)
+    except OSError:
+        pass
+
+
+atexit.register(_dump_on_exit)
+
+
+def load_child_stats(path):
+    """Читает JSON, записанный дочерним ETL-процессом (или None, если его нет)."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# --- Таблица etl_runs ---
+
+RUN_COLUMNS = [
+    'batch_id', 'script', 'started_at', 'wall_sec', 'cpu_sec', 'peak_rss_kb',
+    'rows_read', 'rows_written', 'lock_wait_sec', 'returncode',
+]
+
+
+def ensure_runs_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS etl_runs (
+            run_id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id      TEXT,
+            script        TEXT,
+            started_at    TEXT,
+            wall_sec      REAL,
+            cpu_sec       REAL,
+            peak_rss_kb   INTEGER,
+            rows_read     INTEGER,
+            rows_written  INTEGER,
+            lock_wait_sec REAL,
+            returncode    INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_etl_runs_script ON etl_runs(script, run_id)")
+    conn.commit()
+
+
+def record_run(conn, batch_id, script, started_at, wall_sec, returncode, stats=None):
+    stats = stats or {}
+    conn.execute(f"""
+        INSERT INTO etl_runs ({','.join(RUN_COLUMNS)})
+        VALUES ({','.join('?' * len(RUN_COLUMNS))})
+    """, (
+        batch_id, script, started_at, wall_sec,
+        stats.get('cpu_sec'), stats.get('peak_rss_kb'),
+        stats.get('rows_read'), stats.get('rows_written'), stats.get('lock_wait_sec'),
+        returncode,
+    ))
+    conn.commit()
+
+
+# --- Отчёт ---
+
+def runs_report(conn, last_n=20, script=None, threshold=1.25):
+    """
+    По каждому скрипту берёт последние last_n успешных запусков и считает
+    p50/p90/p99 wall, p50 CPU, максимум RSS, медианы строк и p90 ожидания блокировок.
+    Регрессия: последний запуск медленнее медианы предыдущих в threshold раз.
+    """
+    runs = pd.read_sql_query(
+        "SELECT * FROM etl_runs WHERE returncode = 0 ORDER BY run_id", conn)
+    if script:
+        runs = runs[runs['script'] == script]
+    rows = []
+    for name, g in runs.groupby('script', sort=True):
+        g = g.tail(last_n)
+        wall = g['wall_sec'].to_numpy(dtype=float)
+        prev = wall[:-1]
+        baseline = np.median(prev) if len(prev) else np.nan
+        ratio = wall[-1] / baseline if baseline and baseline > 0 else np.nan
+        rows.append({
+            'script': name,
+            'runs': len(g),
+            'wall_p50': np.percentile(wall, 50),
+            'wall_p90': np.percentile(wall, 90),
+            'wall_p99': np.percentile(wall, 99),
+            'wall_last': wall[-1],
+            'cpu_p50': g['cpu_sec'].median(),
+            'rss_max_mb': g['peak_rss_kb'].max() / 1024,
+            'rows_read_p50': g['rows_read'].median(),
+            'rows_written_p50': g['rows_written'].median(),
+            'lock_wait_p90': g['lock_wait_sec'].quantile(0.9),
+            'last_vs_p50': ratio,
+            'regression': '⚠️' if ratio > threshold else '',
+        })
+    return pd.DataFrame(rows)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Отчёт по таблице etl_runs')
+    ap.add_argument('--db-path', default=DB_PATH)
+    ap.add_argument('--last', type=int, default=20, help='Сколько последних запусков брать по каждому скрипту')
+    ap.add_argument('--script', help='Только один скрипт')
+    ap.add_argument('--threshold', type=float, default=1.25, help='Порог регрессии: last / median(prev)')
+    args = ap.parse_args()
+
+    conn = sqlite3.connect(args.db_path)
+    try:
+        ensure_runs_table(conn)
+        report = runs_report(conn, args.last, args.script, args.threshold)
+    finally:
+        conn.close()
+    if report.empty:
+        print('В etl_runs нет успешных запусков.')
+        return
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(report.sort_values('wall_p50', ascending=False).to_string(index=False, float_format=lambda x: f'{x:.2f}'))
+    regressed = report[report['regression'] != '']
+    if not regressed.empty:
+        print(f"\nРегрессии (> x{args.threshold}): {', '.join(regressed['script'])}")
+
+
+if __name__ == '__main__':
+    main()
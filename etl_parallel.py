@@ -0,0 +1,140 @@
+"""
+etl_parallel.py
+---------------
+Общий помощник для поигровых циклов ETL: игроки режутся на шарды и считаются в пуле процессов.
+
+- run_sharded(func, items, shared, workers): func(шард, shared) -> список строк; результаты склеиваются
+  в порядке items (шарды — непрерывные куски items, ex.map сохраняет порядок), т.е. вывод не зависит от workers
+- Общие данные только для чтения (shared) пишутся один раз в снимок во временном каталоге:
+    - DataFrame -> SharedFrame: колонка = .npy, читается воркером через np.load(mmap_mode='r');
+      object/str колонки — коды (.npy) + словарь уникальных значений (уходит воркеру один раз в initializer)
+    - np.ndarray (не object) -> .npy, в воркере — memmap
+    - прочее (числа, небольшие dict) — как есть через initializer
+  Воркер не получает DataFrame целиком: SharedFrame.take(rows) собирает только строки своего игрока
+- workers <= 1 — тот же код без пула и без снимка (SharedFrame поверх массивов в памяти)
+
+Пул — ProcessPoolExecutor с initializer, как в elo_sweep.py.
+Ускорение и независимость выхода от workers: python etl_benchmark.py --workers N (точная сверка с --workers 1).
+"""
+
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+SHARDS_PER_WORKER = 4
+
+_SHARED = {}  # общие данные воркера, заполняются в _init_worker
+
+
+class SharedFrame:
+    """Колонки DataFrame как numpy-массивы (в памяти или memmap); object-колонки — коды + uniques."""
+
+    def __init__(self, columns, arrays, uniques):
+        self.columns = columns
+        self.arrays = arrays      # колонка -> массив значений или кодов
+        self.uniques = uniques    # колонка -> массив уникальных значений (только для object-колонок)
+
+    def __len__(self):
+        return len(self.arrays[self.columns[0]]) if self.columns else 0
+
+    @classmethod
+    def from_frame(cls, df):
+        arrays, uniques = {}, {}
+        for col in df.columns:
+            values = df[col].to_numpy()
+            if values.dtype == object or not isinstance(values, np.ndarray):
+                codes, uniq = pd.factorize(df[col], use_na_sentinel=False)
+                arrays[col], uniques[col] = codes, np.asarray(uniq, dtype=object)
+            else:
+                arrays[col] = values
+        return cls(list(df.columns), arrays, uniques)
+
+    def save(self, path):
+        """Пишет колонки в path/<i>.npy; возвращает лёгкий SharedFrame, открывающий их через mmap."""
+        os.makedirs(path, exist_ok=True)
+        files = {}
+        for i, col in enumerate(self.columns):
+            files[col] = os.path.join(path, f'{i}.npy')
+            np.save(files[col], self.arrays[col])
+        return SharedFrame(self.columns, files, self.uniques)
+
+    def open(self):
+        """Файлы -> memmap (в воркере); массивы в памяти остаются как есть."""
+        arrays = {c: np.load(a, mmap_mode='r') if isinstance(a, str) else a for c, a in self.arrays.items()}
+        return SharedFrame(self.columns, arrays, self.uniques)
+
+    def take(self, rows):
+        """DataFrame из строк rows (порядок rows сохраняется)."""
+        data = {}
+        for col in self.columns:
+            values = np.asarray(self.arrays[col][rows])
+            data[col] = self.uniques[col][values] if col in self.uniques else values
+        return pd.DataFrame(data, columns=self.columns)
+
+
+def _snapshot(shared, path):
+    """shared -> то, что уходит воркерам: пути к .npy вместо DataFrame / массивов."""
+    out = {}
+    for i, (name, value) in enumerate(shared.items()):
+        if isinstance(value, pd.DataFrame):
+            out[name] = SharedFrame.from_frame(value).save(os.path.join(path, f'frame_{i}'))
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            out[name] = os.path.join(path, f'array_{i}.npy')
+            np.save(out[name], value)
+        else:
+            out[name] = value
+    return out
+
+
+def _open(snapshot):
+    out = {}
+    for name, value in snapshot.items():
+        if isinstance(value, SharedFrame):
+            out[name] = value.open()
+        elif isinstance(value, str) and value.endswith('.npy'):
+            out[name] = np.load(value, mmap_mode='r')
+        else:
+            out[name] = value
+    return out
+
+
+def _in_memory(shared):
+    return {name: SharedFrame.from_frame(v) if isinstance(v, pd.DataFrame) else v for name, v in shared.items()}
+
+
+def _init_worker(snapshot):
+    _SHARED.clear()
+    _SHARED.update(_open(snapshot))
+
+
+def _run_shard(func, shard):
+    return func(shard, _SHARED)
+
+
+def shards(items, n_shards):
+    """Непрерывные куски items (не больше n_shards, без пустых)."""
+    n_shards = max(1, min(n_shards, len(items)))
+    bounds = np.linspace(0, len(items), n_shards + 1).astype(int)
+    return [items[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def run_sharded(func, items, shared, workers=None):
+    """
+    func(шард items, shared) для каждого шарда; результаты (списки) склеиваются в порядке items.
+    func — функция уровня модуля (уходит в воркер по имени); DataFrame из shared приходят как SharedFrame.
+    """
+    items = list(items)
+    workers = min(workers or os.cpu_count() or 1, len(items))
+    if workers <= 1:
+        return list(func(items, _in_memory(shared))) if items else []
+    out = []
+    with tempfile.TemporaryDirectory(prefix='etl_parallel_') as path:
+        snapshot = _snapshot(shared, path)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(snapshot,)) as ex:
+            parts = shards(items, workers * SHARDS_PER_WORKER)
+            for part in ex.map(_run_shard, [func] * len(parts), parts):
+                out.extend(part)
+    return out
@@ -0,0 +1,203 @@
+"""
+h2h_store.py
+------------
+Разреженная матрица личных встреч (head-to-head) игроков ЛигиПро.
+
+- Хранятся только пары, которые встречались: ключ — (id, id) целочисленных id игроков,
+  значения — колонки numpy-массивов (встречи, победы, сеты, очки, последняя встреча)
+- Ориентация пары каноническая: lo — игрок с меньшим именем, hi — с большим
+- Сборка — один векторный проход по матчам (np.unique по ключу пары + np.bincount)
+- update(matches, sign=+1/-1) — добавить новые / вычесть выпавшие из окна матчи одним батчем
+- h2h(p1, p2) — O(1): словарь ключ пары -> строка, результат с точки зрения p1
+
+Последняя встреча при вычитании не пересчитывается: из окна выпадают самые старые матчи,
+поэтому, пока у пары остаются встречи, самая поздняя из них на месте.
+
+Персистентность: таблица player_h2h_pairs (по именам игроков).
+"""
+
+import numpy as np
+import pandas as pd
+
+PAIRS_TABLE = 'player_h2h_pairs'
+# Колонки-счётчики: *_lo — за игрока lo, *_hi — за игрока hi
+COUNT_COLUMNS = ['meetings', 'wins_lo', 'wins_hi', 'sets_lo', 'sets_hi', 'points_lo', 'points_hi']
+PAIR_COLUMNS = ['player_lo', 'player_hi'] + COUNT_COLUMNS + ['last_ts']
+NO_TS = np.iinfo(np.int64).min
+
+
+def match_contributions(matches):
+    """
+    Матчи (player1, player2, p1_sets, p2_sets, p1_pts, p2_pts, ts_sec) -> вклад в пары в ориентации lo/hi.
+    Матчи без одного из игроков пропускаются; NaN-сеты/очки дают 0 (и не дают победы никому).
+    """
+    m = matches[matches['player1'].notna() & matches['player2'].notna()]
+    p1 = m['player1'].to_numpy(dtype=object)
+    p2 = m['player2'].to_numpy(dtype=object)
+    swap = p2 < p1
+    s1 = m['p1_sets'].to_numpy(dtype=float)
+    s2 = m['p2_sets'].to_numpy(dtype=float)
+    pt1 = np.nan_to_num(m['p1_pts'].to_numpy(dtype=float))
+    pt2 = np.nan_to_num(m['p2_pts'].to_numpy(dtype=float))
+    win1, win2 = (s1 > s2).astype(np.int64), (s2 > s1).astype(np.int64)
+    s1, s2 = np.nan_to_num(s1).astype(np.int64), np.nan_to_num(s2).astype(np.int64)
+    return {
+        'lo': np.where(swap, p2, p1),
+        'hi': np.where(swap, p1, p2),
+        'meetings': np.ones(len(m), dtype=np.int64),
+        'wins_lo': np.where(swap, win2, win1),
+        'wins_hi': np.where(swap, win1, win2),
+        'sets_lo': np.where(swap, s2, s1),
+        'sets_hi': np.where(swap, s1, s2),
+        'points_lo': np.where(swap, pt2, pt1).astype(np.int64),
+        'points_hi': np.where(swap, pt1, pt2).astype(np.int64),
+        'last_ts': m['ts_sec'].to_numpy(dtype=np.int64),
+    }
+
+
+class H2HStore:
+    """Пары игроков в колоночных массивах; ids — имя -> целочисленный id, index — ключ пары -> строка."""
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.lo = np.zeros(0, dtype=np.int64)
+        self.hi = np.zeros(0, dtype=np.int64)
+        self.cols = {c: np.zeros(0, dtype=np.int64) for c in COUNT_COLUMNS + ['last_ts']}
+        self.index = {}
+
+    def __len__(self):
+        return len(self.lo)
+
+    def _player_ids(self, names):
+        codes, uniques = pd.factorize(pd.Series(names, dtype=object))
+        mapped = np.empty(len(uniques), dtype=np.int64)
+        for i, name in enumerate(uniques):
+            pid = self.ids.get(name)
+            if pid is None:
+                pid = self.ids[name] = len(self.names)
+                self.names.append(name)
+            mapped[i] = pid
+        return mapped[codes]
+
+    @staticmethod
+    def _key(lo, hi):
+        return (lo << 32) | hi
+
+    def _merge(self, contrib, sign):
+        """Сворачивает вклады по парам и прибавляет (sign=+1) / вычитает (sign=-1) из хранилища."""
+        if len(contrib['lo']) == 0:
+            return np.zeros(0, dtype=np.int64)
+        lo, hi = self._player_ids(contrib['lo']), self._player_ids(contrib['hi'])
+        keys, inv = np.unique(self._key(lo, hi), return_inverse=True)
+        sums = {c: np.bincount(inv, weights=contrib[c], minlength=len(keys)).astype(np.int64) for c in COUNT_COLUMNS}
+        last = np.full(len(keys), NO_TS)
+        np.maximum.at(last, inv, contrib['last_ts'])
+
+        rows = np.array([self.index.get(k, -1) for k in keys.tolist()], dtype=np.int64)
+        new = rows < 0
+        if new.any():
+            start = len(self.lo)
+            rows[new] = np.arange(start, start + new.sum())
+            self.lo = np.concatenate([self.lo, keys[new] >> 32])
+            self.hi = np.concatenate([self.hi, keys[new] & 0xFFFFFFFF])
+            for c in self.cols:
+                fill = NO_TS if c == 'last_ts' else 0
+                self.cols[c] = np.concatenate([self.cols[c], np.full(new.sum(), fill, dtype=np.int64)])
+            self.index.update(zip(keys[new].tolist(), rows[new].tolist()))
+        for c in COUNT_COLUMNS:
+            self.cols[c][rows] += sign * sums[c]
+        if sign > 0:
+            self.cols['last_ts'][rows] = np.maximum(self.cols['last_ts'][rows], last)
+        return rows
+
+    def update(self, matches, sign=1):
+        """Добавить (sign=+1) или вычесть (sign=-1) батч матчей; возвращает затронутые пары (lo, hi по именам)."""
+        rows = self._merge(match_contributions(matches), sign)
+        names = np.asarray(self.names, dtype=object)
+        return list(zip(names[self.lo[rows]], names[self.hi[rows]]))
+
+    def drop_empty(self):
+        """Убирает пары, у которых не осталось встреч; возвращает их (lo, hi по именам)."""
+        empty = self.cols['meetings'] <= 0
+        if not empty.any():
+            return []
+        names = np.asarray(self.names, dtype=object)
+        dropped = list(zip(names[self.lo[empty]], names[self.hi[empty]]))
+        keep = ~empty
+        self.lo, self.hi = self.lo[keep], self.hi[keep]
+        self.cols = {c: v[keep] for c, v in self.cols.items()}
+        self.index = dict(zip(self._key(self.lo, self.hi).tolist(), range(len(self.lo))))
+        return dropped
+
+    @classmethod
+    def from_matches(cls, matches):
+        store = cls()
+        store.update(matches)
+        return store
+
+    @classmethod
+    def from_frame(cls, df):
+        """Из сохранённой таблицы player_h2h_pairs."""
+        store = cls()
+        if df.empty:
+            return store
+        store.lo = store._player_ids(df['player_lo'])
+        store.hi = store._player_ids(df['player_hi'])
+        for c in COUNT_COLUMNS:
+            store.cols[c] = df[c].to_numpy(dtype=np.int64, copy=True)
+        last = pd.to_datetime(df['last_ts'], errors='coerce')
+        store.cols['last_ts'] = np.where(last.isna(), NO_TS, last.to_numpy(dtype='datetime64[s]').astype(np.int64))
+        store.index = dict(zip(store._key(store.lo, store.hi).tolist(), range(len(store.lo))))
+        return store
+
+    def h2h(self, p1, p2):
+        """Личные встречи с точки зрения p1 (None, если не встречались)."""
+        a, b = self.ids.get(p1), self.ids.get(p2)
+        if a is None or b is None:
+            return None
+        p1_is_lo = not (p2 < p1)
+        lo, hi = (a, b) if p1_is_lo else (b, a)
+        row = self.index.get(self._key(lo, hi))
+        if row is None:
+            return None
+        me, opp = ('lo', 'hi') if p1_is_lo else ('hi', 'lo')
+        c = self.cols
+        last = c['last_ts'][row]
+        return {
+            'meetings': int(c['meetings'][row]),
+            'wins': int(c[f'wins_{me}'][row]),
+            'losses': int(c[f'wins_{opp}'][row]),
+            'sets_won': int(c[f'sets_{me}'][row]),
+            'sets_lost': int(c[f'sets_{opp}'][row]),
+            'points_won': int(c[f'points_{me}'][row]),
+            'points_lost': int(c[f'points_{opp}'][row]),
+            'last_meeting': None if last == NO_TS else pd.Timestamp(int(last), unit='s'),
+        }
+
+    def to_frame(self, pairs=None):
+        """Таблица пар по именам; pairs — только эти пары (lo, hi)."""
+        names = np.asarray(self.names, dtype=object)
+        rows = np.arange(len(self.lo)) if pairs is None else np.array(
+            [self.index[self._key(self.ids[lo], self.ids[hi])] for lo, hi in pairs], dtype=np.int64)
+        last = self.cols['last_ts'][rows]
+        df = pd.DataFrame({'player_lo': names[self.lo[rows]], 'player_hi': names[self.hi[rows]]})
+        for c in COUNT_COLUMNS:
+            df[c] = self.cols[c][rows]
+        df['last_ts'] = pd.Series(pd.to_datetime(np.where(last == NO_TS, 0, last), unit='s')
+                                  .strftime('%Y-%m-%d %H:%M:%S')).where(last != NO_TS, None)
+        return df[PAIR_COLUMNS]
+
+    def player_view(self):
+        """
+        Две строки на пару (за каждого игрока): player, opponent, meetings, wins.
+        Пара игрока с самим собой — одна строка.
+        """
+        names = np.asarray(self.names, dtype=object)
+        own = self.lo != self.hi
+        return pd.DataFrame({
+            'player': np.concatenate([names[self.lo], names[self.hi[own]]]),
+            'opponent': np.concatenate([names[self.hi], names[self.lo[own]]]),
+            'meetings': np.concatenate([self.cols['meetings'], self.cols['meetings'][own]]),
+            'wins': np.concatenate([self.cols['wins_lo'], self.cols['wins_hi'][own]]),
+        })
@@ -0,0 +1,92 @@
+"""
+league_partials.py
+------------------
+Частичные агрегаты league_reference по ячейкам (день, слот, стол) для инкрементального расчёта окон 1d..365d.
+
+- league_reference_partials: на ячейку (day, slot, table_label) — счётчики и суммы
+  (матчи, камбэки, pts_diff < 8 / < 12, точные счета, сумма tot_points, попадания в тоталы ovXX_5)
+- league_reference_partials_hist: гистограмма tot_points ячейки (значение -> число матчей).
+  tot_points — целые, поэтому гистограмма — точный сливаемый «скетч» квантилей:
+  слияние ячеек — сложение счётчиков, медиана / min / max по слиянию те же, что по сырым матчам
+- Ячейки — куб (table_label, slot, day): окно = слияние ячеек по дням (GROUP BY в SQLite),
+  любой срез (стол x 7d x evening и т.п.) — то же слияние с фильтром, см. window_sums / window_hist
+- Обновление — только затронутые дни: ячейки дня читаются, складываются с вкладом новых матчей
+  и перезаписываются (replace_days); дни до начала самого длинного окна удаляются (prune)
+
+Вклад матчей в ячейки считает league_reference_etl_ultimate.match_cells; здесь — только хранение и слияние.
+"""
+
+import pandas as pd
+
+from etl_metrics import read_sql
+
+PARTIALS_TABLE = 'league_reference_partials'
+HIST_TABLE = 'league_reference_partials_hist'
+KEY_COLUMNS = ['day', 'slot', 'table_label']
+HIST_COLUMNS = KEY_COLUMNS + ['tot_points', 'matches']
+
+
+def merge(frames, keys):
+    """Слияние частичных агрегатов: сумма всех не-ключевых колонок по keys (NULL-стол — отдельная ячейка)."""
+    df = pd.concat([f for f in frames if len(f)] or frames[:1], ignore_index=True)
+    return df.groupby(keys, dropna=False, sort=True).sum().reset_index()
+
+
+def create_indexes(conn):
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{PARTIALS_TABLE}_day ON {PARTIALS_TABLE}(day)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{HIST_TABLE}_day ON {HIST_TABLE}(day)")
+
+
+def load_days(conn, days):
+    """Сохранённые ячейки (счётчики, гистограмма) за дни days."""
+    marks = ','.join('?' * len(days))
+    counts = read_sql(f"SELECT * FROM {PARTIALS_TABLE} WHERE day IN ({marks})", conn, params=tuple(days))
+    hist = read_sql(f"SELECT * FROM {HIST_TABLE} WHERE day IN ({marks})", conn, params=tuple(days))
+    return counts, hist
+
+
+def _insert(conn, table, df):
+    cols = list(df.columns)
+    conn.executemany(
+        f"INSERT INTO {table} ({','.join(cols)}) VALUES ({','.join('?' * len(cols))})",
+        df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def replace_days(conn, counts, hist, days):
+    """Перезаписывает ячейки дней days. Не коммитит: вызывающий код пишет watermark в той же транзакции."""
+    marks = ','.join('?' * len(days))
+    for table in (PARTIALS_TABLE, HIST_TABLE):
+        conn.execute(f"DELETE FROM {table} WHERE day IN ({marks})", tuple(days))
+    _insert(conn, PARTIALS_TABLE, counts)
+    _insert(conn, HIST_TABLE, hist[HIST_COLUMNS])
+
+
+def prune(conn, before_day):
+    """Удаляет ячейки дней раньше before_day (вне самого длинного окна); не коммитит."""
+    for table in (PARTIALS_TABLE, HIST_TABLE):
+        conn.execute(f"DELETE FROM {table} WHERE day < ?", (before_day,))
+
+
+def _where(after_day, filters):
+    """Условие по дням после after_day и фильтрам {колонка: значения}."""
+    clauses, params = ['day > ?'], [after_day]
+    for col, values in (filters or {}).items():
+        clauses.append(f"{col} IN ({','.join('?' * len(values))})")
+        params += list(values)
+    return ' AND '.join(clauses), tuple(params)
+
+
+def window_sums(conn, after_day, by, columns, filters=None):
+    """Суммы columns по by за дни после after_day — слияние ячеек в SQLite; filters — {колонка: значения}."""
+    keys = ', '.join(by)
+    sums = ', '.join(f'SUM({c}) AS {c}' for c in columns)
+    where, params = _where(after_day, filters)
+    return read_sql(f"SELECT {keys}, {sums} FROM {PARTIALS_TABLE} WHERE {where} GROUP BY {keys}", conn, params=params)
+
+
+def window_hist(conn, after_day, by, filters=None):
+    """Гистограмма tot_points по by за дни после after_day."""
+    keys = ', '.join(by + ['tot_points'])
+    where, params = _where(after_day, filters)
+    return read_sql(f"SELECT {keys}, SUM(matches) AS matches FROM {HIST_TABLE} WHERE {where} GROUP BY {keys}",
+                    conn, params=params)
@@ -2,151 +2,324 @@
 league_reference_etl_ultimate.py
 -------------------------------
 - Честная агрегация value-метрик лиги по всем окнам и слотам.
-- Вдохновлен рабочими версиями: только поштучная обработка!
+- Метрики — как в рабочих версиях с поштучной обработкой, расчёт — векторный (match_features + куб ячеек).
 - sc_ext_ev, sc_ev, finished - обязательны.
-- Нет Series внутри функций, все по apply(axis=1).
 - Тоталы: ov65_5, ov70_5, ov74_5, ov75_5, ov76_5, ov78_5, ov80_5, ov85_5.
 - dry_win_mu, точные счета, камбэк, равные игры, медиана, min, max tot_points.
 
+Разбор счёта (результат тот же, что у поштучной обработки):
+- tot_points, pts_diff, come_from_behind, score_code — из match_features (match_features.py): строки sc_ext_ev / sc_ev
+  разбираются один раз при нормализации results, а не на каждом запуске; перед чтением таблица дозаполняется
+
+Инкрементальный расчёт (league_partials.py):
+- матчи раскладываются в частичные агрегаты по ячейкам (день, слот, стол): счётчики, суммы, попадания
+  в тоталы, точные счета и гистограмма целых tot_points (точный сливаемый скетч для медианы, min/max)
+- запуск складывает в ячейки только новые матчи после watermark; полный пересчёт — --full,
+  первый запуск или поздние/исправленные матчи (по отпечатку results)
+- окно 1d..365d = слияние ячеек дней после граничного + граничный день по сырым матчам (finished_ts >= now - d),
+  поэтому league_reference_by_time совпадает с расчётом по всем results
+- league_reference_by_table: те же метрики по (окно, стол, слот) — базовая линия лиги по столам A3..A9
+  для edge игроков в player_table_stats_etl.py; league_reference_by_time — свёртка того же куба по столам
+- произвольный срез куба (стол x 7d x evening и т.п.) — cube_rollup / --rollup, только по ячейкам, без results
+- время матча — results.finished_epoch (epoch_schema.py): окна, граничные дни и отпечаток — индексные
+  диапазоны по целым секундам, без pd.to_datetime по строкам
+
 Author: GPT-4 + Кирилл
 """
+import argparse
+import json
 import sqlite3
 import pandas as pd
 import numpy as np
 import os
+from db_utils import DB_PATH, get_watermark, set_watermark
+from epoch_schema import ensure_epoch_columns, epoch_to_datetime, to_epoch
+from etl_metrics import acquire_write_lock, count_rows_written, read_sql, write_table
+from league_partials import (HIST_TABLE, KEY_COLUMNS, PARTIALS_TABLE, create_indexes, load_days, merge, prune,
+                             replace_days, window_hist, window_sums)
+from match_features import FEATURES_TABLE, sync_match_features
+from rating_index import table_exists
 
-def get_tot_points(row):
-    sc_ext_ev = row['sc_ext_ev']
-    if pd.isnull(sc_ext_ev): return np.nan
-    total = 0
-    for set_str in str(sc_ext_ev).split(','):
-        set_str = set_str.strip()
-        if not set_str: continue
-        if ':' in set_str:
-            try:
-                a, b = set_str.split(':')
-                total += int(a) + int(b)
-            except: continue
-        elif '-' in set_str:
-            try:
-                a, b = set_str.split('-')
-                total += int(a) + int(b)
-            except: continue
-    return total if total > 0 else np.nan
-
-def get_pts_diff(row):
-    sc_ext_ev = row['sc_ext_ev']
-    if pd.isnull(sc_ext_ev): return np.nan
-    p1, p2 = 0, 0
-    for set_str in str(sc_ext_ev).split(','):
-        set_str = set_str.strip()
-        if not set_str: continue
-        if ':' in set_str:
-            try:
-                a, b = set_str.split(':')
-                p1 += int(a)
-                p2 += int(b)
-            except: continue
-        elif '-' in set_str:
-            try:
-                a, b = set_str.split('-')
-                p1 += int(a)
-                p2 += int(b)
-            except: continue
-    return abs(p1 - p2) if (p1 > 0 or p2 > 0) else np.nan
-
-def come_from_behind(row):
-    try:
-        sets = str(row['sc_ext_ev']).split(',')
-        if not sets or len(sets) < 1: return np.nan
-        first_set = sets[0].strip()
-        if not first_set: return np.nan
-        sep = ':' if ':' in first_set else '-'
-        fs = [int(x) for x in first_set.split(sep)]
-        left, right = [int(x) for x in str(row['sc_ev']).replace(':','-').split('-')]
-        winner = 1 if left > right else 2
-        if (winner == 1 and fs[0] < fs[1]) or (winner == 2 and fs[1] < fs[0]):
-            return 1
-        return 0
-    except: return np.nan
-
-def get_score_code(row):
-    try:
-        left, right = [int(x) for x in str(row['sc_ev']).replace(':','-').split('-')]
-        s = f"{max(left,right)}-{min(left,right)}"
-        return s
-    except: return None
-
-def get_slot(row):
-    h = row['finished_ts'].hour if not pd.isnull(row['finished_ts']) else None
-    if h is None: return 'unknown'
-    if (h >= 23 or h < 7): return 'night'
-    if (h >= 7 and h < 10): return 'morning'
-    if (h >= 10 and h < 18): return 'day'
-    if (h >= 18 and h < 23): return 'evening'
-    return 'unknown'
-
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-df = pd.read_sql_query("SELECT * FROM results", conn)
-
-for col in ['sc_ext_ev','sc_ev','finished']:
-    if col not in df.columns:
-        raise Exception(f"В таблице results нет нужного столбца: {col}")
-
-df['finished_ts'] = pd.to_datetime(df['finished'], errors='coerce')
-df = df[df['finished_ts'].notna()].copy()
-df['slot'] = df.apply(get_slot, axis=1)
-now = pd.Timestamp.now()
-
-df['tot_points'] = df.apply(get_tot_points, axis=1)
-df['pts_diff'] = df.apply(get_pts_diff, axis=1)
-df['come_from_behind'] = df.apply(come_from_behind, axis=1)
-df['score_code'] = df.apply(get_score_code, axis=1)
-
-windows = {
+SLOTS = ['night', 'morning', 'day', 'evening']
+WINDOWS = {
     '1d': 1,
     '3d': 3,
     '7d': 7,
     '30d': 30,
     '365d': 365,
 }
-totals = [65.5, 70.5, 74.5, 75.5, 76.5, 78.5, 80.5, 85.5]
-rows = []
-for win_label, days in windows.items():
-    window_start = now - pd.Timedelta(days=days)
-    df_win = df[df['finished_ts'] >= window_start].copy()
-    for slot in ['night','morning','day','evening','all']:
-        if slot == 'all':
-            df_slot = df_win.copy()
-        else:
-            df_slot = df_win[df_win['slot']==slot]
-        if len(df_slot) == 0: continue
-        score_counts = df_slot['score_code'].value_counts(normalize=True)
-        rec = {
-            'window': win_label,
-            'slot': slot,
-            'n_matches': len(df_slot),
-            'mean_tot_points': df_slot['tot_points'].mean(),
-            'median_tot_points': df_slot['tot_points'].median(),
-            'min_tot_points': df_slot['tot_points'].min(),
-            'max_tot_points': df_slot['tot_points'].max(),
-            'dry_win_mu': score_counts.get('3-0', 0),
-            'score_3_2_mu': score_counts.get('3-2', 0),
-            'score_3_1_mu': score_counts.get('3-1', 0),
-            'score_3_0_mu': score_counts.get('3-0', 0),
-            'come_from_behind_mu': df_slot['come_from_behind'].mean(),
-            'pts_diff_lt8': (df_slot['pts_diff'] < 8).mean(),
-            'pts_diff_lt12': (df_slot['pts_diff'] < 12).mean(),
-        }
-        for t in totals:
-            rec[f'ov{str(t).replace(".","_")}_mu'] = (df_slot['tot_points'] > t).mean()
+TOTALS = [65.5, 70.5, 74.5, 75.5, 76.5, 78.5, 80.5, 85.5]
+SCORE_CODES = ['3-0', '3-1', '3-2']
+
+
+def slot_codes(finished_ts):
+    """Номер слота (индекс в SLOTS) по часу окончания: night 23-7, morning 7-10, day 10-18, evening 18-23."""
+    h = finished_ts.dt.hour.to_numpy()
+    return np.select([(h >= 23) | (h < 7), h < 10, h < 18], [0, 1, 2], 3)
+
+
+ETL_NAME = 'league_reference'
+META_NAME = 'league_reference_meta'  # первый хранимый день и отпечаток results (JSON в etl_state)
+SCORE_COLUMNS = {code: f'score_{code.replace("-", "_")}' for code in SCORE_CODES}
+OV_COLUMNS = {t: f'ov{str(t).replace(".", "_")}_hits' for t in TOTALS}
+COUNT_COLUMNS = (['n_matches', 'come_from_behind_sum', 'come_from_behind_n', 'pts_diff_lt8', 'pts_diff_lt12', 'score_n']
+                 + list(SCORE_COLUMNS.values()) + ['tot_points_n', 'tot_points_sum'] + list(OV_COLUMNS.values()))
+
+
+def day_strings(finished_ts):
+    return np.datetime_as_string(finished_ts.to_numpy(dtype='datetime64[D]'), unit='D').astype(object)
+
+
+def load_results(conn, where, params=()):
+    """Матчи results (where — условие на finished_epoch) с признаками из match_features; строки без даты отбрасываются."""
+    df = read_sql(f"""
+        SELECT r.match_id, r.table_label, r.finished, r.finished_epoch,
+               f.tot_points, f.pts_diff, f.come_from_behind, f.score_code
+        FROM results r JOIN {FEATURES_TABLE} f ON f.match_id = r.match_id
+        WHERE {where}
+    """, conn, params=params)
+    df['finished_ts'] = epoch_to_datetime(df['finished_epoch'])
+    return df[df['finished_ts'].notna()]
+
+
+def match_cells(df):
+    """Разобранные матчи -> вклад в ячейки (day, slot, table_label): счётчики COUNT_COLUMNS и гистограмма tot_points."""
+    keys = pd.DataFrame({
+        'day': day_strings(df['finished_ts']),
+        'slot': np.asarray(SLOTS, dtype=object)[slot_codes(df['finished_ts'])],
+        'table_label': df['table_label'].to_numpy(dtype=object),
+    })
+    tp = df['tot_points'].to_numpy(dtype=float)
+    pts_diff = df['pts_diff'].to_numpy(dtype=float)
+    cfb = df['come_from_behind'].to_numpy(dtype=float)
+    score = df['score_code'].to_numpy(dtype=object)
+    has_tp = ~np.isnan(tp)
+    cols = {
+        'n_matches': np.ones(len(df)),
+        'come_from_behind_sum': np.nan_to_num(cfb),
+        'come_from_behind_n': ~np.isnan(cfb),
+        'pts_diff_lt8': pts_diff < 8,
+        'pts_diff_lt12': pts_diff < 12,
+        'score_n': pd.notna(score),
+        **{col: score == code for code, col in SCORE_COLUMNS.items()},
+        'tot_points_n': has_tp,
+        'tot_points_sum': np.where(has_tp, tp, 0.0),
+        **{col: tp > t for t, col in OV_COLUMNS.items()},
+    }
+    counts = keys.assign(**{c: v.astype(float if c == 'tot_points_sum' else np.int64) for c, v in cols.items()})
+    hist = keys[has_tp].assign(tot_points=tp[has_tp], matches=1)
+    return merge([counts], KEY_COLUMNS), merge([hist], KEY_COLUMNS + ['tot_points'])
+
+
+def window_cells(conn, now, by):
+    """
+    Слитые счётчики и гистограмма tot_points по (window, *by).
+    Окно — finished_ts >= now - d: дни после граничного берутся из партиций, граничный день —
+    по матчам results этого дня с finished_ts >= now - d (ячейка дня попадает в окно лишь частично).
+    """
+    starts = {w: now - pd.Timedelta(days=d) for w, d in WINDOWS.items()}
+    edge_days = {w: str(start.date()) for w, start in starts.items()}
+    days = sorted(set(edge_days.values()))
+    bounds = [(to_epoch(day), to_epoch(day) + 86400) for day in days]
+    edge = load_results(conn, ' OR '.join(['(finished_epoch >= ? AND finished_epoch < ?)'] * len(days)),
+                        tuple(x for b in bounds for x in b))
+    edge_day = day_strings(edge['finished_ts'])
+    counts, hists = [], []
+    for w, start in starts.items():
+        e_counts, e_hist = match_cells(edge[(edge_day == edge_days[w]) & (edge['finished_ts'] >= start).to_numpy()])
+        counts.append(merge([window_sums(conn, edge_days[w], by, COUNT_COLUMNS), e_counts[by + COUNT_COLUMNS]], by)
+                      .assign(window=w))
+        hists.append(merge([window_hist(conn, edge_days[w], by), e_hist[by + ['tot_points', 'matches']]],
+                           by + ['tot_points']).assign(window=w))
+    return pd.concat(counts, ignore_index=True), pd.concat(hists, ignore_index=True)
+
+
+def league_metrics(c, values, hist):
+    """Метрики ячейки из слитых счётчиков c; values / hist — значения tot_points по возрастанию и число матчей."""
+    n, n_tp = c['n_matches'], hist.sum()
+    if n_tp:
+        cum = np.cumsum(hist)
+        mid = np.searchsorted(cum, [(n_tp - 1) // 2, n_tp // 2], side='right')
+        median = (values[mid[0]] + values[mid[1]]) / 2
+        mean = c['tot_points_sum'] / c['tot_points_n']
+        vmin, vmax = values[0], values[-1]
+    else:
+        mean = median = vmin = vmax = np.nan
+    score_n = c['score_n']
+    score_mu = {code: c[col] / score_n if score_n else 0 for code, col in SCORE_COLUMNS.items()}
+    cfb_n = c['come_from_behind_n']
+    rec = {
+        'n_matches': int(n),
+        'mean_tot_points': mean,
+        'median_tot_points': median,
+        'min_tot_points': vmin,
+        'max_tot_points': vmax,
+        'dry_win_mu': score_mu['3-0'],
+        'score_3_2_mu': score_mu['3-2'],
+        'score_3_1_mu': score_mu['3-1'],
+        'score_3_0_mu': score_mu['3-0'],
+        'come_from_behind_mu': c['come_from_behind_sum'] / cfb_n if cfb_n else np.nan,
+        'pts_diff_lt8': c['pts_diff_lt8'] / n,
+        'pts_diff_lt12': c['pts_diff_lt12'] / n,
+    }
+    for t, col in OV_COLUMNS.items():
+        rec[f'ov{str(t).replace(".","_")}_mu'] = c[col] / n
+    return rec
+
+
+def window_metrics(counts, hist, by, with_all=True):
+    """
+    Строки (window, *by) с метриками; при слоте в by и with_all — плюс слот 'all' (слияние слотов).
+    Порядок: окна как в WINDOWS, затем остальные ключи by, слоты как в SLOTS; пустые ячейки пропускаются.
+    """
+    group = ['window'] + by
+    rest = [k for k in group if k != 'slot']
+    if 'slot' in by and with_all:
+        counts = pd.concat([counts, merge([counts.drop(columns='slot')], rest).assign(slot='all')], ignore_index=True)
+        hist = pd.concat([hist, merge([hist.drop(columns='slot')], rest + ['tot_points']).assign(slot='all')],
+                         ignore_index=True)
+    counts = counts[counts['n_matches'] > 0]
+    order = counts.assign(w_order=counts['window'].map({w: i for i, w in enumerate(WINDOWS)}))
+    sort_keys = ['w_order'] + rest[1:]
+    if 'slot' in by:
+        order['s_order'] = order['slot'].map({s: i for i, s in enumerate(SLOTS + ['all'])})
+        sort_keys.append('s_order')
+    counts = counts.loc[order.sort_values(sort_keys, kind='mergesort').index].reset_index(drop=True)
+
+    # Гистограмма ячейки — непрерывный срез, tot_points по возрастанию
+    cells = hist.merge(counts[group].assign(cell=np.arange(len(counts))), on=group)
+    cells = cells.sort_values(['cell', 'tot_points'], kind='mergesort')
+    bounds = np.searchsorted(cells['cell'].to_numpy(), np.arange(len(counts) + 1))
+    values = cells['tot_points'].to_numpy(dtype=float)
+    matches = cells['matches'].to_numpy(dtype=np.int64)
+    rows = []
+    for i, c in enumerate(counts.to_dict('records')):
+        rec = {k: c[k] for k in group}
+        rec.update(league_metrics(c, values[bounds[i]:bounds[i + 1]], matches[bounds[i]:bounds[i + 1]]))
         rows.append(rec)
+    df = pd.DataFrame(rows)
+    # tot_points — целые: min/max пишутся INTEGER, как раньше (NULL — ячейка без tot_points)
+    for col in ('min_tot_points', 'max_tot_points'):
+        if col in df:
+            df[col] = df[col].astype('Int64')
+    return df
+
+
+def cube_rollup(conn, days, today, tables=None, slots=None, by=('table_label', 'slot')):
+    """
+    Произвольный срез куба без обращения к results: последние days календарных дней до today включительно,
+    столы tables и слоты slots (None — все), группировка by. Окно — целые дни, без поправки граничного дня.
+    """
+    by = list(by)
+    after_day = str((pd.Timestamp(today) - pd.Timedelta(days=days)).date())
+    filters = {col: values for col, values in [('table_label', tables), ('slot', slots)] if values}
+    counts = window_sums(conn, after_day, by, COUNT_COLUMNS, filters).assign(window=f'{days}d')
+    hist = window_hist(conn, after_day, by, filters).assign(window=f'{days}d')
+    return window_metrics(counts, hist, by, with_all=not slots)
+
+
+def fingerprint(conn, start_day, end):
+    """Отпечаток results за [start_day, end]: меняется при позднем/исправленном/удалённом матче."""
+    return list(conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(match_id), 0), COALESCE(SUM(LENGTH(sc_ext_ev)), 0),
+               COALESCE(SUM(LENGTH(sc_ev)), 0), COALESCE(SUM(UNICODE(sc_ev)), 0), COALESCE(SUM(LENGTH(table_label)), 0)
+        FROM results WHERE finished_epoch >= ? AND finished_epoch <= ?
+    """, (to_epoch(start_day), to_epoch(end))).fetchone())
+
+
+def save_meta(conn, start_day, end):
+    set_watermark(conn, ETL_NAME, end)
+    set_watermark(conn, META_NAME, json.dumps({'start': start_day, 'fingerprint': fingerprint(conn, start_day, end)}))
+
+
+def run_full(conn, start_day):
+    set_watermark(conn, ETL_NAME, None)
+    conn.commit()
+    df = load_results(conn, 'finished_epoch >= ?', (to_epoch(start_day),))
+    counts, hist = match_cells(df)
+    write_table(counts, PARTIALS_TABLE, conn)
+    write_table(hist, HIST_TABLE, conn)
+    create_indexes(conn)
+    if len(df):
+        save_meta(conn, start_day, df['finished'].max())
+    conn.commit()
+    print(f'{PARTIALS_TABLE}: полный пересчёт, {len(counts)} ячеек по {len(df)} матчам')
+
+
+def run_incremental(conn, start_day, watermark):
+    """Новые матчи после watermark складываются в ячейки своих дней; дни до start_day удаляются."""
+    new = load_results(conn, 'finished_epoch > ? AND finished_epoch >= ?', (to_epoch(watermark), to_epoch(start_day)))
+    counts, hist = match_cells(new)
+    days = sorted(set(counts['day']))
+    old_counts, old_hist = load_days(conn, days) if days else (counts[:0], hist[:0])
+    acquire_write_lock(conn)
+    try:
+        if days:
+            replace_days(conn, merge([old_counts, counts], KEY_COLUMNS),
+                         merge([old_hist, hist], KEY_COLUMNS + ['tot_points']), days)
+        prune(conn, start_day)
+        save_meta(conn, start_day, max(watermark, new['finished'].max()) if len(new) else watermark)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(counts) + len(hist))
+    print(f'{PARTIALS_TABLE}: +{len(new)} матчей, обновлено дней: {len(days)}')
+
+
+def rebuild_reason(conn, start_day, watermark):
+    """Почему нужен полный пересчёт партиций; None — можно инкрементально."""
+    if watermark is None or not (table_exists(conn, PARTIALS_TABLE) and table_exists(conn, HIST_TABLE)):
+        return 'нет сохранённых частичных агрегатов'
+    meta = json.loads(get_watermark(conn, META_NAME) or 'null')
+    if meta is None or meta.get('start') is None or meta['start'] > start_day:
+        return 'окно сдвинулось назад'
+    if meta.get('fingerprint') != fingerprint(conn, meta['start'], watermark):
+        return f'поздние/исправленные матчи до {watermark}'
+    return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description='league_reference_by_time / _by_table из куба (стол, слот, день)')
+    ap.add_argument('--full', action='store_true', help='Пересобрать частичные агрегаты с нуля')
+    ap.add_argument('--rollup', type=int, metavar='DAYS', help='Только напечатать срез куба за DAYS дней (без пересчёта)')
+    ap.add_argument('--table', action='append', help='Стол для --rollup (можно несколько раз)')
+    ap.add_argument('--slot', action='append', choices=SLOTS, help='Слот для --rollup (можно несколько раз)')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        if args.rollup:
+            print(cube_rollup(conn, args.rollup, pd.Timestamp.now(), args.table, args.slot).to_string(index=False))
+            return
+        sync_match_features(conn, ())  # дозаполнение признаков матчей, ещё не прошедших нормализацию
+        ensure_epoch_columns(conn)
+        now = pd.Timestamp.now()
+        # Первый день самого длинного окна: более ранние ячейки не нужны ни одному окну
+        start_day = str((now - pd.Timedelta(days=max(WINDOWS.values()))).date())
+        watermark = get_watermark(conn, ETL_NAME)
+        reason = '--full' if args.full else rebuild_reason(conn, start_day, watermark)
+        if reason:
+            print(f'{PARTIALS_TABLE}: {reason} — полный пересчёт')
+            run_full(conn, start_day)
+        else:
+            run_incremental(conn, start_day, watermark)
+
+        # Куб (стол, слот) по окнам; league_reference_by_time — его свёртка по столам
+        counts, hist = window_cells(conn, now, ['table_label', 'slot'])
+        league_df = window_metrics(merge([counts.drop(columns='table_label')], ['window', 'slot']),
+                                   merge([hist.drop(columns='table_label')], ['window', 'slot', 'tot_points']), ['slot'])
+        write_table(league_df, 'league_reference_by_time', conn)
+        # Матчи без стола в базовую линию по столам не входят
+        by_table = window_metrics(counts[counts['table_label'].notna()], hist[hist['table_label'].notna()],
+                                  ['table_label', 'slot'])
+        write_table(by_table, 'league_reference_by_table', conn)
+        print(f'Таблицы league_reference_by_time / league_reference_by_table обновлены! (окна из куба по дням)')
+    finally:
+        conn.close()
+
 
-league_df = pd.DataFrame(rows)
-league_df.to_sql('league_reference_by_time', conn, if_exists='replace', index=False)
-print(f'Таблица league_reference_by_time обновлена! (all value-метрики по results)')
-conn.close()
+if __name__ == '__main__':
+    main()
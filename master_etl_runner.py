@@ -4,12 +4,20 @@ run_all_etl.py
 
 Обновлённый мастер-скрипт, который запускает все ETL-скрипты и повторяет выполнение каждые 10 минут.
 Использует текущий интерпретатор Python (sys.executable) для кроссплатформенной совместимости.
+По каждому запуску пишет в таблицу etl_runs: wall/CPU-время, пиковую память, строки чтения/записи
+и ожидание блокировок (см. etl_metrics.py; отчёт: python etl_metrics.py --last 20).
 """
 import os
 import sys
+import sqlite3
 import subprocess
+import tempfile
 import time
 import logging
+from datetime import datetime
+
+from db_utils import DB_PATH as ETL_DB_PATH
+from etl_metrics import METRICS_ENV, ensure_runs_table, load_child_stats, record_run
 
 # Каталог, где лежат все ETL-скрипты (скрипт находится в том же каталоге)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -22,12 +30,17 @@ SCRIPTS = [
     'player_style_etl.py',
     'player_fatigue_etl.py',
     'player_elo_etl.py',
+    'player_glicko2_etl.py',
     'player_passport_etl_final_match_results_fix.py',
     'league_reference_etl_ultimate.py',
     'player_table_stats_etl.py',
     'player_sos_windows_etl.py',
 ]
 
+# Та же БД, что у ETL: они берут путь из db_utils (BETCITY_DB_PATH) и запускаются с cwd=BASE_DIR,
+# поэтому относительный путь считается от BASE_DIR
+DB_PATH = os.path.join(BASE_DIR, ETL_DB_PATH)
+
 # Настройка логирования
 log_file = os.path.join(BASE_DIR, 'etl_runner.log')
 logging.basicConfig(
@@ -40,23 +53,50 @@ logging.basicConfig(
 )
 
 
+def save_run_metrics(batch_id, script, started_at, wall_sec, returncode, metrics_path):
+    """Пишет строку в etl_runs; сбой записи метрик не должен ронять пакетный запуск."""
+    stats = load_child_stats(metrics_path)
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            ensure_runs_table(conn)
+            record_run(conn, batch_id, script, started_at, wall_sec, returncode, stats)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error(f'Не удалось записать etl_runs для {script}: {e}')
+    if stats:
+        logging.info(
+            f"{script}: wall={wall_sec:.1f}s cpu={stats['cpu_sec']:.1f}s rss={stats['peak_rss_kb'] or 0}KB "
+            f"read={stats['rows_read']} written={stats['rows_written']} lock_wait={stats['lock_wait_sec']:.2f}s"
+        )
+
+
 def run_all_etl():
     """Запускает все скрипты и логирует результаты"""
     logging.info('=== Начало пакетного запуска ETL ===')
+    batch_id = datetime.now().isoformat(timespec='seconds')
     for script in SCRIPTS:
         path = os.path.join(BASE_DIR, script)
         logging.info(f'Запуск {script}')
         if not os.path.isfile(path):
             logging.error(f'Не найден файл: {script}')
             continue
+        fd, metrics_path = tempfile.mkstemp(prefix='etl_metrics_', suffix='.json')
+        os.close(fd)
+        started_at = datetime.now().isoformat(timespec='seconds')
+        t0 = time.perf_counter()
+        returncode = None
         try:
             # Используем тот же интерпретатор, что запустил текущий скрипт
             result = subprocess.run(
                 [sys.executable, path],
                 cwd=BASE_DIR,
                 capture_output=True,
-                text=True
+                text=True,
+                env={**os.environ, METRICS_ENV: metrics_path},
             )
+            returncode = result.returncode
             if result.stdout:
                 logging.info(f'[STDOUT] {result.stdout.strip()}')
             if result.stderr:
@@ -67,6 +107,9 @@ def run_all_etl():
                 logging.info(f'{script} успешно выполнен')
         except Exception as e:
             logging.exception(f'Ошибка при запуске {script}: {e}')
+        finally:
+            save_run_metrics(batch_id, script, started_at, time.perf_counter() - t0, returncode, metrics_path)
+            os.remove(metrics_path)
     logging.info('=== Пакетный запуск ETL завершён ===')
 
 
@@ -0,0 +1,270 @@
+"""
+match_features.py
+-----------------
+Признаки матча, разобранные из строк счёта один раз — при нормализации results (fill_match_results_and_sets).
+
+Таблица match_features, строка на каждый матч results:
+- tot_points, pts_diff — сумма и |разность| очков по всем сетам sc_ext_ev (NULL, если очков нет)
+- first_set_winner — 1 / 2 по первому сету sc_ext_ev (NULL при ничьей или без сетов)
+- come_from_behind — победитель матча (по sc_ev) проиграл первый сет
+- score_code — '3-1' (большее-меньшее по sc_ev), dry_win — score_code == '3-0'
+- sets_left, sets_right — счёт по сетам из sc_ev
+
+Семантика — та же, что у поштучных парсеров league_reference_etl_ultimate.py / player_table_stats_etl.py
+(сеты через ':' или '-', все сеты строки), поэтому аналитика по таблице совпадает с разбором строк.
+Канонические строки ('11:8, 5:11', '3:1') разбираются векторно (токены по буферу байтов), остальные — поштучно.
+
+Обновление: sync_match_features(conn, match_ids) — эти матчи + матчи без строки (дозаполнение),
+None — пересборка по всем results. ETL перед чтением зовут sync_match_features(conn, ()) — только дозаполнение.
+"""
+
+import numpy as np
+import pandas as pd
+
+FEATURES_TABLE = 'match_features'
+FEATURE_COLUMNS = ['tot_points', 'pts_diff', 'first_set_winner', 'come_from_behind', 'score_code', 'dry_win',
+                   'sets_left', 'sets_right']
+CHUNK = 200_000
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS {FEATURES_TABLE} (
+    match_id INTEGER PRIMARY KEY,
+    tot_points REAL,
+    pts_diff REAL,
+    first_set_winner INTEGER,
+    come_from_behind INTEGER,
+    score_code TEXT,
+    dry_win INTEGER,
+    sets_left INTEGER,
+    sets_right INTEGER
+)
+"""
+
+def get_tot_points(row):
+    sc_ext_ev = row['sc_ext_ev']
+    if pd.isnull(sc_ext_ev): return np.nan
+    total = 0
+    for set_str in str(sc_ext_ev).split(','):
+        set_str = set_str.strip()
+        if not set_str: continue
+        if ':' in set_str:
+            try:
+                a, b = set_str.split(':')
+                total += int(a) + int(b)
+            except: continue
+        elif '-' in set_str:
+            try:
+                a, b = set_str.split('-')
+                total += int(a) + int(b)
+            except: continue
+    return total if total > 0 else np.nan
+
+def get_pts_diff(row):
+    sc_ext_ev = row['sc_ext_ev']
+    if pd.isnull(sc_ext_ev): return np.nan
+    p1, p2 = 0, 0
+    for set_str in str(sc_ext_ev).split(','):
+        set_str = set_str.strip()
+        if not set_str: continue
+        if ':' in set_str:
+            try:
+                a, b = set_str.split(':')
+                p1 += int(a)
+                p2 += int(b)
+            except: continue
+        elif '-' in set_str:
+            try:
+                a, b = set_str.split('-')
+                p1 += int(a)
+                p2 += int(b)
+            except: continue
+    return abs(p1 - p2) if (p1 > 0 or p2 > 0) else np.nan
+
+def come_from_behind(row):
+    try:
+        sets = str(row['sc_ext_ev']).split(',')
+        if not sets or len(sets) < 1: return np.nan
+        first_set = sets[0].strip()
+        if not first_set: return np.nan
+        sep = ':' if ':' in first_set else '-'
+        fs = [int(x) for x in first_set.split(sep)]
+        left, right = [int(x) for x in str(row['sc_ev']).replace(':','-').split('-')]
+        winner = 1 if left > right else 2
+        if (winner == 1 and fs[0] < fs[1]) or (winner == 2 and fs[1] < fs[0]):
+            return 1
+        return 0
+    except: return np.nan
+
+def get_score_code(row):
+    try:
+        left, right = [int(x) for x in str(row['sc_ev']).replace(':','-').split('-')]
+        s = f"{max(left,right)}-{min(left,right)}"
+        return s
+    except: return None
+
+def get_sets(row):
+    try:
+        left, right = [int(x) for x in str(row['sc_ev']).replace(':','-').split('-')]
+        return left, right
+    except: return None
+
+def get_first_set_winner(row):
+    try:
+        first_set = str(row['sc_ext_ev']).split(',')[0].strip()
+        sep = ':' if ':' in first_set else '-'
+        fs = [int(x) for x in first_set.split(sep)]
+        return 1 if fs[0] > fs[1] else 2 if fs[1] > fs[0] else np.nan
+    except: return np.nan
+
+
+# Токены строки счёта: группа цифр, разделитель счёта (':' или '-'), разделитель сетов (',')
+DIGITS, SEP, COMMA = 0, 1, 2
+SETS_PATTERN = [DIGITS, SEP, DIGITS, COMMA]  # 'a:b, a:b, ...'; счёт матча 'a:b' — первые три токена
+MAX_DIGITS = 15  # длиннее — в поштучный разбор (точность float)
+
+
+def scan_tokens(strings):
+    """
+    Токенизация всех строк сразу: строки склеиваются в один буфер байтов, дальше — только numpy.
+    Пробелы между токенами пропускаются (int() в поштучных парсерах их тоже срезает).
+    Возвращает токены (row, kind, k — номер токена в строке, value — число для DIGITS) и маску
+    строк, состоящих только из допустимых символов (цифры, ':', '-', ',', пробел) с числами <= MAX_DIGITS цифр.
+    """
+    n = len(strings)
+    enc = [x.encode('utf-8') for x in strings]
+    lens = np.fromiter(map(len, enc), dtype=np.int64, count=n)
+    buf = np.frombuffer(b''.join(enc), dtype=np.uint8)
+    row = np.repeat(np.arange(n), lens)
+    is_digit = (buf >= ord('0')) & (buf <= ord('9'))
+    is_sep = (buf == ord(':')) | (buf == ord('-'))
+    is_comma = buf == ord(',')
+    bad = ~(is_digit | is_sep | is_comma | (buf == ord(' ')))
+
+    first_in_row = np.r_[True, row[1:] != row[:-1]] if len(buf) else np.zeros(0, dtype=bool)
+    prev_digit = np.r_[False, is_digit[:-1]] if len(buf) else np.zeros(0, dtype=bool)
+    start = (is_digit & (first_in_row | ~prev_digit)) | is_sep | is_comma
+    pos = np.flatnonzero(start)
+    tok_row = row[pos]
+    kind = np.where(is_digit[pos], DIGITS, np.where(is_sep[pos], SEP, COMMA))
+    row_first = np.searchsorted(tok_row, tok_row)
+    k = np.arange(len(pos)) - row_first
+
+    # Значения групп цифр: позиция цифры от конца группы -> степень 10
+    tok_of = np.cumsum(start) - 1
+    d = np.flatnonzero(is_digit)
+    run_len = np.bincount(tok_of[d], minlength=len(pos))
+    exp = run_len[tok_of[d]] - 1 - (d - pos[tok_of[d]])
+    value = np.bincount(tok_of[d], weights=(buf[d] - ord('0')) * 10.0 ** exp, minlength=len(pos))
+
+    ok = (np.bincount(row[bad], minlength=n) == 0) & (np.bincount(tok_row[run_len > MAX_DIGITS], minlength=n) == 0)
+    return tok_row, kind, k, value, ok
+
+
+def canonical_rows(tok_row, kind, k, ok, pattern, n, exact_len=None):
+    """
+    Строки, чьи токены повторяют pattern по кругу (и заканчиваются на DIGITS), — разбираются векторно.
+    exact_len — точное число токенов (для sc_ev: 'a:b' — 3 токена).
+    """
+    pattern = np.asarray(pattern)
+    count = np.bincount(tok_row, minlength=n)
+    mismatch = np.bincount(tok_row[kind != pattern[k % len(pattern)]], minlength=n)
+    good = ok & (mismatch == 0) & (count % len(pattern) == len(pattern) - 1)
+    return good & (count == exact_len) if exact_len else good
+
+
+def parse_scores(df):
+    """
+    Колонки FEATURE_COLUMNS по sc_ev / sc_ext_ev одним векторным разбором.
+    Векторно — строки канонического вида: sc_ext_ev 'a:b, a:b, ...' (или через '-'), sc_ev 'a:b';
+    остальные (NULL, пустые сеты, знаки, не-ASCII и т.п.) — прежними поштучными парсерами.
+    """
+    n = len(df)
+    ext_null = df['sc_ext_ev'].isna().to_numpy()
+    ev_null = df['sc_ev'].isna().to_numpy()
+    ext = scan_tokens(df['sc_ext_ev'].astype(object).where(~ext_null, '').astype(str).tolist())
+    ev = scan_tokens(df['sc_ev'].astype(object).where(~ev_null, '').astype(str).tolist())
+    canon = (~ext_null & ~ev_null &
+             canonical_rows(*ext[:3], ext[4], SETS_PATTERN, n) &
+             canonical_rows(*ev[:3], ev[4], SETS_PATTERN, n, exact_len=3))
+
+    # Сеты: k % 4 == 0 — очки player1, k % 4 == 2 — player2; первый сет — k == 0 и k == 2
+    tok_row, kind, k, value, _ = ext
+    num = canon[tok_row] & (kind == DIGITS)
+    a, b = num & (k % 4 == 0), num & (k % 4 == 2)
+    p1 = np.bincount(tok_row[a], weights=value[a], minlength=n)
+    p2 = np.bincount(tok_row[b], weights=value[b], minlength=n)
+    f1 = np.bincount(tok_row[num & (k == 0)], weights=value[num & (k == 0)], minlength=n)
+    f2 = np.bincount(tok_row[num & (k == 2)], weights=value[num & (k == 2)], minlength=n)
+    ev_row, _, ev_k, ev_value, _ = ev
+    first = canon[ev_row] & (ev_k == 0)
+    last = canon[ev_row] & (ev_k == 2)
+    left = np.bincount(ev_row[first], weights=ev_value[first], minlength=n)
+    right = np.bincount(ev_row[last], weights=ev_value[last], minlength=n)
+
+    total = p1 + p2
+    hi, lo = np.maximum(left, right).astype(np.int64), np.minimum(left, right).astype(np.int64)
+    tot_points = np.where(total > 0, total, np.nan)
+    pts_diff = np.where((p1 > 0) | (p2 > 0), np.abs(p1 - p2), np.nan)
+    cfb = np.where(left > right, f1 < f2, f2 < f1).astype(float)
+    fsw = np.select([f1 > f2, f2 > f1], [1.0, 2.0], np.nan)
+    sets_left, sets_right = np.where(canon, left, np.nan), np.where(canon, right, np.nan)
+    score_code = np.char.add(np.char.add(hi.astype(str), '-'), lo.astype(str)).astype(object)
+
+    rest = np.flatnonzero(~canon)
+    if len(rest):
+        r = df.iloc[rest]
+        tot_points[rest] = r.apply(get_tot_points, axis=1).astype(float)
+        pts_diff[rest] = r.apply(get_pts_diff, axis=1).astype(float)
+        cfb[rest] = r.apply(come_from_behind, axis=1).astype(float)
+        score_code[rest] = r.apply(get_score_code, axis=1).astype(object)
+        fsw[rest] = r.apply(get_first_set_winner, axis=1).astype(float)
+        sets = [get_sets(row) for _, row in r.iterrows()]
+        sets_left[rest] = [s[0] if s else np.nan for s in sets]
+        sets_right[rest] = [s[1] if s else np.nan for s in sets]
+    score_code = pd.Series(score_code, index=df.index, dtype=object)
+    return pd.DataFrame({
+        'tot_points': tot_points,
+        'pts_diff': pts_diff,
+        'first_set_winner': fsw,
+        'come_from_behind': cfb,
+        'score_code': score_code,
+        'dry_win': (score_code == '3-0').astype(float).where(score_code.notna()),
+        'sets_left': sets_left,
+        'sets_right': sets_right,
+    }, index=df.index)
+
+
+def sync_match_features(conn, match_ids=None):
+    """
+    Пересчитывает match_features: по всем results (match_ids=None) или по match_ids + матчам без строки в таблице
+    (match_ids=() — только дозаполнение). Коммитит.
+    """
+    c = conn.cursor()
+    c.execute(DDL)
+    if match_ids is None:
+        c.execute(f"DELETE FROM {FEATURES_TABLE}")
+        c.execute("SELECT match_id, sc_ev, sc_ext_ev FROM results")
+    else:
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS _mf_ids (match_id INTEGER PRIMARY KEY)")
+        c.execute("DELETE FROM _mf_ids")
+        c.executemany("INSERT OR IGNORE INTO _mf_ids VALUES (?)", [(mid,) for mid in match_ids])
+        c.execute(f"""
+            INSERT OR IGNORE INTO _mf_ids SELECT r.match_id FROM results r
+            WHERE NOT EXISTS (SELECT 1 FROM {FEATURES_TABLE} f WHERE f.match_id = r.match_id)
+        """)
+        c.execute("SELECT r.match_id, r.sc_ev, r.sc_ext_ev FROM results r JOIN _mf_ids i ON i.match_id = r.match_id")
+    write = conn.cursor()
+    n = 0
+    while True:
+        chunk = c.fetchmany(CHUNK)
+        if not chunk:
+            break
+        df = pd.DataFrame(chunk, columns=['match_id', 'sc_ev', 'sc_ext_ev'], dtype=object)
+        df = df[['match_id']].join(parse_scores(df))
+        write.executemany(f"INSERT OR REPLACE INTO {FEATURES_TABLE} ({','.join(df.columns)}) "
+                          f"VALUES ({','.join('?' * len(df.columns))})",
+                          df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+        n += len(df)
+    conn.commit()
+    return n
+
@@ -0,0 +1,170 @@
+"""
+passport_service.py
+-------------------
+Паспорт игрока по запросу: долгоживущий процесс с LRU-кэшем вместо запуска player_passport_to_db.py <имя>.
+
+- В процессе: PassportService(db_path).get(имя); по localhost: GET /passport?player=<имя>, GET /metrics
+- Кэш — LRU (OrderedDict) на capacity игроков; промах — сборка паспорта по матчам игрока
+  (индексы results.player1 / player2, сеты — по первичному ключу set_scores), расчёт тот же, что в player_passport_to_db
+- Инвалидация: парсер результатов пишет игроков новых/изменённых матчей (вместе с прежними именами
+  при переименовании) и удалённых старых матчей (prune_old_results) в журнал player_changes
+  (db_utils.log_player_changes); сервис читает журнал не чаще раза в poll_sec и выкидывает этих игроков из кэша,
+  паспорт пересобирается лениво — при следующем запросе
+- Метрики: hits / misses / hit_rate, p50 / p99 задержки get() по последним LATENCY_WINDOW запросам
+
+Запуск: python passport_service.py [--port 8765] [--capacity 2048]
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from db_utils import ensure_player_changes, player_changes_since
+from epoch_schema import ensure_epoch_columns
+from player_passport_to_db import DB_PATH, passport_for
+
+HOST = '127.0.0.1'
+PORT = 8765
+CAPACITY = 2048
+POLL_SEC = 0.5
+LATENCY_WINDOW = 10_000
+
+
+def ensure_player_indexes(conn):
+    """Индексы для выборки матчей одного игрока (WHERE player1 = ? OR player2 = ?)."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_player1 ON results(player1)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_player2 ON results(player2)")
+    conn.commit()
+
+
+class PassportService:
+    """LRU-кэш паспортов поверх одного соединения; все обращения — под lock (сервер многопоточный)."""
+
+    def __init__(self, db_path=DB_PATH, capacity=CAPACITY, poll_sec=POLL_SEC):
+        self.capacity = capacity
+        self.poll_sec = poll_sec
+        self.conn = sqlite3.connect(db_path, timeout=5.0, check_same_thread=False)
+        ensure_player_indexes(self.conn)
+        ensure_epoch_columns(self.conn)
+        ensure_player_changes(self.conn)
+        self.conn.commit()
+        # Кэш пуст — журнал до текущего момента не нужен
+        self.seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM player_changes").fetchone()[0]
+        self.next_poll = 0.0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.invalidated = 0
+        self.latency = deque(maxlen=LATENCY_WINDOW)
+
+    def _poll_changes(self):
+        """Выкидывает из кэша игроков, появившихся в журнале player_changes после self.seq."""
+        changes = player_changes_since(self.conn, self.seq)
+        for _, player in changes:
+            self.invalidated += self.cache.pop(player, False) is not False
+        if changes:
+            self.seq = changes[-1][0]
+
+    def invalidate(self, players):
+        """Инвалидация в процессе (когда парсер и сервис живут вместе)."""
+        with self.lock:
+            for player in players:
+                self.invalidated += self.cache.pop(player, False) is not False
+
+    def get(self, player):
+        """Паспорт игрока (dict) или None, если матчей нет; None тоже кэшируется до инвалидации."""
+        t0 = time.perf_counter()
+        with self.lock:
+            if time.monotonic() >= self.next_poll:
+                self._poll_changes()
+                self.next_poll = time.monotonic() + self.poll_sec
+            if player in self.cache:
+                self.cache.move_to_end(player)
+                self.hits += 1
+                passport = self.cache[player]
+            else:
+                self.misses += 1
+                passport = self.cache[player] = passport_for(self.conn, player)
+                if len(self.cache) > self.capacity:
+                    self.cache.popitem(last=False)
+            self.latency.append(time.perf_counter() - t0)
+        return passport
+
+    def metrics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            lat_ms = np.asarray(self.latency) * 1000
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else None,
+                'p50_ms': round(float(np.percentile(lat_ms, 50)), 3) if len(lat_ms) else None,
+                'p99_ms': round(float(np.percentile(lat_ms, 99)), 3) if len(lat_ms) else None,
+                'cached': len(self.cache),
+                'capacity': self.capacity,
+                'invalidated': self.invalidated,
+            }
+
+
+class PassportHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/passport':
+            player = parse_qs(url.query).get('player', [''])[0]
+            if not player:
+                return self._reply(400, {'error': 'нужен параметр player'})
+            passport = self.service.get(player)
+            if passport is None:
+                return self._reply(404, {'error': 'нет данных по игроку', 'player': player})
+            return self._reply(200, passport)
+        if url.path == '/metrics':
+            return self._reply(200, self.service.metrics())
+        return self._reply(404, {'error': 'неизвестный путь'})
+
+    def _reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # без строки в stdout на каждый запрос; задержки — в /metrics
+
+
+def make_server(service, host=HOST, port=PORT):
+    handler = type('BoundPassportHandler', (PassportHandler,), {'service': service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Паспорта игроков по запросу: LRU-кэш + HTTP на localhost')
+    ap.add_argument('--db-path', default=DB_PATH)
+    ap.add_argument('--host', default=HOST)
+    ap.add_argument('--port', type=int, default=PORT)
+    ap.add_argument('--capacity', type=int, default=CAPACITY, help='Сколько паспортов держать в кэше')
+    ap.add_argument('--poll-sec', type=float, default=POLL_SEC, help='Как часто читать журнал player_changes')
+    args = ap.parse_args()
+
+    service = PassportService(args.db_path, args.capacity, args.poll_sec)
+    server = make_server(service, args.host, args.port)
+    print(f'passport_service: http://{args.host}:{args.port}/passport?player=<имя>, /metrics')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f'Остановлено пользователем. Метрики: {service.metrics()}')
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,32 +11,38 @@ player_elo_etl.py
 - История Elo по матчам сохраняется в таблицу 'player_elo_history' (для графиков и ML)
 - Таблица player_elo: итоговый рейтинг на сегодня
 
+Инкрементальный режим (по умолчанию):
+- player_elo — это и есть состояние игрока (elo_final, total_matches, last_match_ts, total_decay_penalty),
+  watermark (finished_ts последнего применённого матча) хранится в etl_state
+- Применяются только матчи с finished_ts > watermark, в player_elo_history дописываются только новые строки,
+  в player_elo обновляются только сыгравшие игроки — всё в одной транзакции
+- Полный пересчёт: --full, либо автоматически, если до watermark появились поздние матчи
+  или исправленные результаты (матч без строки в player_elo_history или с другим result/игроками)
+- Фильтр и порядок матчей — по match_results.finished_epoch (целые с индексом, epoch_schema.py),
+  время в массивы — epoch_to_datetime без разбора строк
+
 Author: GPT-4 + Твои правки
 """
 
+import argparse
 import sqlite3
 import pandas as pd
 import numpy as np
 import os
 from datetime import datetime, timedelta
+from db_utils import DB_PATH, get_watermark, set_watermark
+from epoch_schema import ensure_epoch_columns, epoch_to_datetime, to_epoch
+from etl_metrics import acquire_write_lock, count_rows_written, read_sql, write_table
 
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-
-# Берём игроков из results
-results = pd.read_sql_query("SELECT * FROM results", conn)
-match_results = pd.read_sql_query("SELECT * FROM match_results", conn)
-
-# Датафрейм для истории эло
-elo_history = []
+ETL_NAME = 'player_elo'
 
 # Стартовые значения
 START_ELO = 1000
 MIN_ELO = 800
 
+HISTORY_COLUMNS = ['player', 'match_id', 'elo_before', 'elo_after', 'opponent', 'date', 'result', 'k', 'decay_penalty']
+ELO_COLUMNS = ['player_name', 'elo_final', 'total_matches', 'last_match_ts', 'total_decay_penalty']
+
 def k_factor(n_games):
     if n_games <= 30:
         return 32
@@ -60,102 +66,329 @@ def apply_decay(elo, days_idle):
     new_elo = max(MIN_ELO, elo - penalty)
     return new_elo, penalty
 
-# Хронологический список матчей
-all_matches = match_results.merge(
-    results[['match_id', 'player1', 'player2']],
-    on='match_id', how='left'
-).sort_values('finished_ts')
-
-# Собираем список всех игроков
-players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
-player_elo = {p: START_ELO for p in players}
-player_last_match = {p: None for p in players}
-player_games = {p: 0 for p in players}
-player_decay = {p: 0 for p in players}
-
-# Проход по всем матчам по хронологии
-for idx, row in all_matches.iterrows():
-    p1, p2 = row['player1'], row['player2']
-    ts = row['finished_ts']
-    if pd.isna(ts):
-        continue
-    ts = pd.to_datetime(ts, errors='coerce')
-    # Decay если с прошлого матча прошло >3 дня
-    for p in [p1, p2]:
-        last_ts = player_last_match[p]
-        if last_ts is not None:
-            days_idle = (ts - last_ts).days
-            old_elo = player_elo[p]
-            new_elo, penalty = apply_decay(old_elo, days_idle)
-            player_elo[p] = new_elo
-            player_decay[p] += penalty
-    # Текущий эло
-    elo1, elo2 = player_elo[p1], player_elo[p2]
-    # Считаем, кто выиграл
-    if (row['p1_sets'] > row['p2_sets'] and row['player1'] == p1) or \
-       (row['p2_sets'] > row['p1_sets'] and row['player2'] == p1):
-        s1, s2 = 1, 0
-    elif (row['p2_sets'] > row['p1_sets'] and row['player1'] == p1) or \
-         (row['p1_sets'] > row['p2_sets'] and row['player2'] == p1):
-        s1, s2 = 0, 1
-    else:
-        s1 = s2 = 0.5  # draw, если ничья (теоретически)
-
-    # Текущий K
-    k1, k2 = k_factor(player_games[p1]), k_factor(player_games[p2])
-    e1 = expected_score(elo1, elo2)
-    e2 = expected_score(elo2, elo1)
-    # Обновляем рейтинг
-    new_elo1 = max(MIN_ELO, elo1 + k1 * (s1 - e1))
-    new_elo2 = max(MIN_ELO, elo2 + k2 * (s2 - e2))
-    # Запоминаем
-    elo_history.append({
-        'player': p1,
-        'match_id': row['match_id'],
-        'elo_before': elo1,
-        'elo_after': new_elo1,
-        'opponent': p2,
-        'date': ts,
-        'result': s1,
-        'k': k1,
-        'decay_penalty': player_decay[p1],
-    })
-    elo_history.append({
-        'player': p2,
-        'match_id': row['match_id'],
-        'elo_before': elo2,
-        'elo_after': new_elo2,
-        'opponent': p1,
-        'date': ts,
-        'result': s2,
-        'k': k2,
-        'decay_penalty': player_decay[p2],
-    })
-    player_elo[p1] = new_elo1
-    player_elo[p2] = new_elo2
-    player_last_match[p1] = ts
-    player_last_match[p2] = ts
-    player_games[p1] += 1
-    player_games[p2] += 1
-
-# Сохраняем финальные эло в DataFrame
-elo_list = []
-for p in players:
-    last_ts = player_last_match[p]
-    elo_list.append({
-        'player_name': p,
-        'elo_final': player_elo[p],
-        'total_matches': player_games[p],
-        'last_match_ts': last_ts,
-        'total_decay_penalty': player_decay[p]
-    })
-df_elo = pd.DataFrame(elo_list)
-df_elo.to_sql('player_elo', conn, if_exists='replace', index=False)
-print(f'Таблица player_elo обновлена: {len(df_elo)} игроков')
-
-# Сохраняем историю
-df_hist = pd.DataFrame(elo_history)
-df_hist.to_sql('player_elo_history', conn, if_exists='replace', index=False)
-print(f'Таблица player_elo_history обновлена: {len(df_hist)} записей (по всем матчам)')
-
-conn.close()
+
+def load_matches(conn, after=None):
+    """Матчи в хронологии (по finished_epoch, затем match_id); after — только строго позже watermark."""
+    query = """
+        SELECT mr.match_id, mr.finished_epoch, mr.p1_sets, mr.p2_sets, r.player1, r.player2
+        FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch IS NOT NULL {}
+        ORDER BY mr.finished_epoch, mr.match_id
+    """
+    if after is None:
+        return read_sql(query.format(''), conn)
+    return read_sql(query.format('AND mr.finished_epoch > ?'), conn, params=(to_epoch(after),))
+
+
+def last_finished(matches):
+    """watermark — время последнего матча строкой 'YYYY-MM-DD HH:MM:SS', как и прежде."""
+    return str(epoch_to_datetime(matches['finished_epoch'].iloc[-1:]).iloc[0])
+
+
+def load_players(conn):
+    results = read_sql("SELECT player1, player2 FROM results", conn)
+    # Порядок как раньше: все player1, затем новые из player2
+    return pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
+
+
+NO_MATCH = np.iinfo(np.int64).min  # last_ts игрока, который ещё не играл
+NS_PER_DAY = 86_400 * 10**9
+
+# Параметры модели (значения по умолчанию = константы и функции выше); перебираются в elo_sweep.py
+DEFAULT_PARAMS = {
+    'start_elo': START_ELO,
+    'min_elo': MIN_ELO,
+    'k_bounds': (30, 100, 300, 600),   # верхние границы числа сыгранных матчей для ступеней K
+    'k_steps': (32, 28, 24, 20, 16),   # K на каждой ступени, последняя — для всех остальных
+    'decay_rate': 0.0003,              # доля Elo за день простоя
+    'decay_grace_days': 3,             # дней простоя без decay
+    'scale': 400,
+}
+
+
+def k_table(params):
+    """K по числу сыгранных матчей: список для n <= max(k_bounds) + 1, дальше — последний элемент."""
+    bounds, steps = params['k_bounds'], params['k_steps']
+    table = []
+    for n in range(bounds[-1] + 2):
+        tier = next((i for i, b in enumerate(bounds) if n <= b), len(bounds))
+        table.append(steps[tier])
+    return table
+
+
+K_TABLE = k_table(DEFAULT_PARAMS)  # == [k_factor(n) for n in range(602)]
+
+
+def initial_state(players, start_elo=START_ELO):
+    """Состояние всех игроков в массивах, индекс = целочисленный id игрока (позиция в players)."""
+    n = len(players)
+    return {
+        'players': list(players),
+        'elo': np.full(n, float(start_elo)),
+        'last_ts': np.full(n, NO_MATCH, dtype=np.int64),
+        'games': np.zeros(n, dtype=np.int64),
+        'decay': np.zeros(n),
+    }
+
+
+def load_state(conn, players):
+    """Состояние из player_elo; новые игроки (ещё не было в player_elo) стартуют с START_ELO."""
+    state = initial_state(players)
+    df = read_sql("SELECT * FROM player_elo", conn)
+    pos = pd.Index(state['players']).get_indexer(df['player_name'])
+    df, pos = df[pos >= 0], pos[pos >= 0]
+    last_ts = pd.to_datetime(df['last_match_ts'], errors='coerce')
+    state['elo'][pos] = df['elo_final'].to_numpy(dtype=float)
+    state['games'][pos] = df['total_matches'].to_numpy(dtype=np.int64)
+    state['decay'][pos] = df['total_decay_penalty'].to_numpy(dtype=float)
+    state['last_ts'][pos] = np.where(last_ts.isna(), NO_MATCH, last_ts.to_numpy(dtype='datetime64[ns]').astype(np.int64))
+    return state
+
+
+def encode_matches(all_matches, players):
+    """Матчи -> целочисленные массивы: id игроков, время (ns), очки результата s1 для player1."""
+    ts = epoch_to_datetime(all_matches['finished_epoch'])
+    ok = ts.notna().to_numpy()
+    m = all_matches[ok]
+    idx = pd.Index(players)
+    p1s = m['p1_sets'].to_numpy(dtype=float)
+    p2s = m['p2_sets'].to_numpy(dtype=float)
+    # Как сравнения row['player1'] == p1 в исходном цикле: матч «сам с собой» — всегда победа player1,
+    # NULL-player1 (NaN != NaN) — ничья
+    self_win = (m['player1'] == m['player2']).to_numpy() & ((p1s > p2s) | (p1s < p2s))
+    no_p1 = m['player1'].isna().to_numpy()
+    return {
+        'match_id': m['match_id'].to_numpy(),
+        'p1': idx.get_indexer(m['player1']),
+        'p2': idx.get_indexer(m['player2']),
+        'ts': ts[ok].to_numpy(dtype='datetime64[ns]').astype(np.int64),
+        # NaN-сеты дают ничью, как и сравнения в исходном цикле
+        's1': np.where(no_p1, 0.5, np.where((p1s > p2s) | self_win, 1.0, np.where(p1s < p2s, 0.0, 0.5))),
+    }
+
+
+def replay_kernel(p1, p2, ts, s1, state, params=None):
+    """
+    Проход по матчам в хронологии над массивами состояния (обновляются на месте).
+    С DEFAULT_PARAMS семантика k_factor / apply_decay / MIN_ELO та же, что у функций выше; expected_score,
+    apply_decay и max(MIN_ELO, ...) развёрнуты inline теми же выражениями.
+    Скалярное состояние внутри цикла держим в списках — поэлементный доступ к numpy в CPython медленнее.
+    Возвращает колонки истории по матчам: elo_before/elo_after/k/decay для обоих игроков
+    и expected — ожидаемый результат player1 до матча (для бэктеста в elo_sweep.py).
+    """
+    params = params or DEFAULT_PARAMS
+    K = K_TABLE if params is DEFAULT_PARAMS else k_table(params)
+    min_elo, scale = params['min_elo'], params['scale']
+    rate, grace = params['decay_rate'], params['decay_grace_days']
+    n = len(p1)
+    elo = state['elo'].tolist()
+    last = state['last_ts'].tolist()
+    games = state['games'].tolist()
+    decay = state['decay'].tolist()
+    p1, p2, ts, s1 = p1.tolist(), p2.tolist(), ts.tolist(), s1.tolist()
+    KN, K_LAST = len(K), K[-1]
+    no_match = NO_MATCH
+    exp1 = [0.0] * n
+    eb1, ea1, k1o, d1o = [0.0] * n, [0.0] * n, [0] * n, [0.0] * n
+    eb2, ea2, k2o, d2o = [0.0] * n, [0.0] * n, [0] * n, [0.0] * n
+
+    for i in range(n):
+        a, b, t, r1 = p1[i], p2[i], ts[i], s1[i]
+        # Decay если с прошлого матча прошло > grace дней (по умолчанию 3)
+        la = last[a]
+        if la != no_match:
+            days_idle = (t - la) // NS_PER_DAY
+            if days_idle > grace:
+                penalty = elo[a] * rate * (days_idle - grace)
+                elo[a] = max(min_elo, elo[a] - penalty)
+                decay[a] += penalty
+        lb = last[b]
+        if lb != no_match:
+            days_idle = (t - lb) // NS_PER_DAY
+            if days_idle > grace:
+                penalty = elo[b] * rate * (days_idle - grace)
+                elo[b] = max(min_elo, elo[b] - penalty)
+                decay[b] += penalty
+        elo1, elo2 = elo[a], elo[b]
+        ga, gb = games[a], games[b]
+        k1 = K[ga] if ga < KN else K_LAST
+        k2 = K[gb] if gb < KN else K_LAST
+        e1 = 1.0 / (1.0 + 10**((elo2 - elo1) / scale))
+        e2 = 1.0 / (1.0 + 10**((elo1 - elo2) / scale))
+        new1 = elo1 + k1 * (r1 - e1)
+        if new1 < min_elo:
+            new1 = min_elo
+        new2 = elo2 + k2 * ((1.0 - r1) - e2)
+        if new2 < min_elo:
+            new2 = min_elo
+        exp1[i] = e1
+        eb1[i], ea1[i], k1o[i], d1o[i] = elo1, new1, k1, decay[a]
+        eb2[i], ea2[i], k2o[i], d2o[i] = elo2, new2, k2, decay[b]
+        elo[a], elo[b] = new1, new2
+        last[a] = last[b] = t
+        # Последовательно, как в исходном цикле: матч «сам с собой» — +2 игры
+        games[a] += 1
+        games[b] += 1
+
+    state['elo'][:] = elo
+    state['last_ts'][:] = last
+    state['games'][:] = games
+    state['decay'][:] = decay
+    return {
+        'elo_before': (np.array(eb1), np.array(eb2)),
+        'elo_after': (np.array(ea1), np.array(ea2)),
+        'k': (np.array(k1o, dtype=np.int64), np.array(k2o, dtype=np.int64)),
+        'decay_penalty': (np.array(d1o), np.array(d2o)),
+        'expected': np.array(exp1),
+    }
+
+
+def _interleave(pair, dtype=None):
+    a, b = pair
+    out = np.empty(2 * len(a), dtype=dtype or a.dtype)
+    out[0::2], out[1::2] = a, b
+    return out
+
+
+def replay(all_matches, state):
+    """Прогон матчей через replay_kernel; история — две строки на матч (player1, затем player2)."""
+    enc = encode_matches(all_matches, state['players'])
+    out = replay_kernel(enc['p1'], enc['p2'], enc['ts'], enc['s1'], state)
+    names = np.asarray(state['players'], dtype=object)
+    s1 = enc['s1']
+    result = _interleave((s1, 1.0 - s1))
+    if not (result % 1).any():
+        result = result.astype(np.int64)
+    return pd.DataFrame({
+        'player': _interleave((names[enc['p1']], names[enc['p2']])),
+        'match_id': np.repeat(enc['match_id'], 2),
+        'elo_before': _interleave(out['elo_before']),
+        'elo_after': _interleave(out['elo_after']),
+        'opponent': _interleave((names[enc['p2']], names[enc['p1']])),
+        'date': pd.to_datetime(np.repeat(enc['ts'], 2)),
+        'result': result,
+        'k': _interleave(out['k']),
+        'decay_penalty': _interleave(out['decay_penalty']),
+    }, columns=HISTORY_COLUMNS)
+
+
+def state_frame(state, players=None):
+    idx = np.arange(len(state['players'])) if players is None else pd.Index(state['players']).get_indexer(players)
+    last_ts = state['last_ts'][idx]
+    return pd.DataFrame({
+        'player_name': np.asarray(state['players'], dtype=object)[idx],
+        'elo_final': state['elo'][idx],
+        'total_matches': state['games'][idx],
+        'last_match_ts': pd.Series(pd.to_datetime(np.where(last_ts == NO_MATCH, 0, last_ts))).where(last_ts != NO_MATCH, None),
+        'total_decay_penalty': state['decay'][idx],
+    }, columns=ELO_COLUMNS)
+
+
+def needs_rebuild(conn, watermark):
+    """
+    True, если до watermark есть матч, которого нет в player_elo_history с тем же результатом и составом:
+    поздно пришедший результат, исправленный счёт или переименованный игрок.
+    """
+    row = conn.execute("""
+        SELECT 1 FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch <= ?
+          AND NOT EXISTS (
+              SELECT 1 FROM player_elo_history h
+              WHERE h.match_id = mr.match_id AND h.player IS r.player1 AND h.opponent IS r.player2
+                AND h.result = CASE WHEN r.player1 IS NULL THEN 0.5
+                                    WHEN mr.p1_sets > mr.p2_sets
+                                         OR (r.player1 = r.player2 AND mr.p2_sets > mr.p1_sets) THEN 1
+                                    WHEN mr.p1_sets < mr.p2_sets THEN 0 ELSE 0.5 END)
+        LIMIT 1
+    """, (to_epoch(watermark),)).fetchone()
+    return row is not None
+
+
+def ensure_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_player_elo_history_match ON player_elo_history(match_id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_player_elo_player ON player_elo(player_name)")
+    conn.commit()
+
+
+def run_full(conn):
+    # Сбрасываем watermark до записи: если запись оборвётся, следующий запуск снова будет полным
+    set_watermark(conn, ETL_NAME, None)
+    conn.commit()
+    players = load_players(conn)
+    all_matches = load_matches(conn)
+    state = initial_state(players)
+    df_hist = replay(all_matches, state)
+
+    # Сохраняем финальные эло в DataFrame
+    df_elo = state_frame(state)
+    write_table(df_elo, 'player_elo', conn)
+    print(f'Таблица player_elo обновлена: {len(df_elo)} игроков')
+
+    # Сохраняем историю
+    write_table(df_hist, 'player_elo_history', conn)
+    print(f'Таблица player_elo_history обновлена: {len(df_hist)} записей (по всем матчам)')
+
+    ensure_indexes(conn)
+    if len(all_matches):
+        set_watermark(conn, ETL_NAME, last_finished(all_matches))
+        conn.commit()
+
+
+def run_incremental(conn, watermark):
+    players = load_players(conn)
+    new_matches = load_matches(conn, after=watermark)
+    if new_matches.empty:
+        print(f'player_elo: новых матчей после {watermark} нет')
+        return
+    state = load_state(conn, players)
+    df_hist = replay(new_matches, state)
+    touched = pd.unique(pd.concat([new_matches['player1'], new_matches['player2']])).tolist()
+    df_elo = state_frame(state, touched)
+    df_elo['last_match_ts'] = df_elo['last_match_ts'].map(lambda ts: None if pd.isna(ts) else str(ts))
+    df_hist['date'] = df_hist['date'].astype(str)
+
+    acquire_write_lock(conn)
+    try:
+        conn.executemany(
+            f"INSERT INTO player_elo_history ({','.join(HISTORY_COLUMNS)}) VALUES ({','.join('?' * len(HISTORY_COLUMNS))})",
+            df_hist.astype(object).itertuples(index=False, name=None))
+        conn.executemany(
+            f"INSERT OR REPLACE INTO player_elo ({','.join(ELO_COLUMNS)}) VALUES ({','.join('?' * len(ELO_COLUMNS))})",
+            df_elo.astype(object).itertuples(index=False, name=None))
+        set_watermark(conn, ETL_NAME, last_finished(new_matches))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(df_hist) + len(df_elo))
+    print(f'player_elo: +{len(new_matches)} матчей, обновлено {len(df_elo)} игроков, +{len(df_hist)} строк истории')
+
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Elo-рейтинг игроков ЛигиПро')
+    ap.add_argument('--full', action='store_true', help='Полный пересчёт истории с 1000')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        ensure_epoch_columns(conn)
+        watermark = get_watermark(conn, ETL_NAME)
+        if args.full or watermark is None or not table_exists(conn, 'player_elo_history'):
+            run_full(conn)
+        elif needs_rebuild(conn, watermark):
+            print(f'player_elo: поздние/исправленные матчи до {watermark} — полный пересчёт')
+            run_full(conn)
+        else:
+            run_incremental(conn, watermark)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,13 @@ player_fatigue_etl.py
 - Все метрики — за 365 дней (или по всей истории, если мало матчей)
 - Сохраняет таблицу player_fatigue
 
+Расчёт одним проходом без цикла по игрокам: long-формат «игрок — матч» читается готовым из player_matches
+(player_matches.py), отдых — разность стартов соседних матчей внутри игрока (groupby.diff),
+ночь/победы — векторные флаги, back-to-back — число матчей по (игрок, дата окончания).
+Семантика прежнего цикла сохранена: старт = finished_ts - duration_sec (930 с, если длительности нет),
+back-to-back считается по датам finished_ts, ночь — по часу старта.
+Окно года — индексный диапазон по player_matches.finished_epoch (epoch_schema.py).
+
 Author: GPT-4 + Кирилл
 """
 
@@ -18,95 +25,97 @@ import sqlite3
 import pandas as pd
 import numpy as np
 import os
-from datetime import datetime, timedelta
-
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-results = pd.read_sql_query("SELECT * FROM results", conn)
-match_results = pd.read_sql_query("SELECT * FROM match_results", conn)
-
-# Мерджим имена игроков в матчах
-match_results = match_results.merge(
-    results[['match_id', 'player1', 'player2']],
-    on='match_id', how='left'
-)
-
-# Время окончания матча
-match_results['finished_ts'] = pd.to_datetime(match_results['finished_ts'], errors='coerce')
-
-# За год
-last_year = match_results[match_results['finished_ts'] >= pd.Timestamp.now() - pd.Timedelta(days=365)]
-
-# Список игроков
-players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
-
-fatigue_rows = []
-for player in players:
-    pm = last_year[(last_year['player1'] == player) | (last_year['player2'] == player)]
-    pm = pm.sort_values('finished_ts')
-    if len(pm) < 3:
-        continue
-    # Вычисляем интервалы отдыха (между start-таймами)
-    rest_hours = []
-    back_to_back_days = set()
-    last_start = None
-    night_matches = 0
-    night_wins = 0
-    total_wins = 0
-    for idx, row in pm.iterrows():
-        # Старт = финиш - длительность
-        dur = row['duration_sec'] if row['duration_sec'] and row['duration_sec'] > 0 else 930
-        start_ts = row['finished_ts'] - pd.Timedelta(seconds=dur)
-        # Отдых между матчами
-        if last_start is not None:
-            rest = (start_ts - last_start).total_seconds() / 3600
-            rest_hours.append(rest)
-        last_start = start_ts
-        # Ночные матчи (старт в 22:00–07:00)
-        if 22 <= start_ts.hour or start_ts.hour < 7:
-            night_matches += 1
-            # Победа
-            is_win = (row['player1'] == player and row['p1_sets'] > row['p2_sets']) or (row['player2'] == player and row['p2_sets'] > row['p1_sets'])
-            if is_win:
-                night_wins += 1
-        # Все победы
-        is_win = (row['player1'] == player and row['p1_sets'] > row['p2_sets']) or (row['player2'] == player and row['p2_sets'] > row['p1_sets'])
-        if is_win:
-            total_wins += 1
-        # Back-to-back
-        date = start_ts.date()
-        if date in back_to_back_days:
-            pass  # уже был матч в этот день
-        else:
-            back_to_back_days.add(date)
-
-    avg_rest_h = np.mean(rest_hours) if rest_hours else np.nan
-    pct_rest_lt4h = np.mean(np.array(rest_hours) < 4) if rest_hours else np.nan
-    pct_rest_lt8h = np.mean(np.array(rest_hours) < 8) if rest_hours else np.nan
-    pct_back_to_back = np.nan
-    if len(pm) > 1:
-        btb_count = sum([list(pm['finished_ts'].dt.date).count(d) > 1 for d in set(pm['finished_ts'].dt.date)])
-        pct_back_to_back = btb_count / len(set(pm['finished_ts'].dt.date))
-    pct_night_matches = night_matches / len(pm)
-    winrate_night = night_wins / night_matches if night_matches else np.nan
-    winrate_all = total_wins / len(pm)
-
-    fatigue_rows.append({
-        'player_name': player,
-        'matches_played': len(pm),
-        'avg_rest_hours': avg_rest_h,
-        'pct_rest_lt4h': pct_rest_lt4h,
-        'pct_rest_lt8h': pct_rest_lt8h,
-        'pct_back_to_back_days': pct_back_to_back,
-        'pct_night_matches': pct_night_matches,
-        'winrate_night': winrate_night,
-        'winrate_all': winrate_all,
+from db_utils import DB_PATH
+from epoch_schema import epoch_to_datetime, to_epoch
+from etl_metrics import read_sql, write_table
+from player_matches import read_player_matches, sync_player_matches
+
+DEFAULT_DURATION_SEC = 930
+MIN_MATCHES = 3
+
+
+# Колонки player_matches для расчёта; матч «сам с собой» — победа при любом победителе, как в прежнем цикле
+PLAYER_MATCH_COLUMNS = ['match_id', 'player', 'finished_epoch', 'duration_sec',
+                        'COALESCE(is_win OR (player = opponent AND sets_against > sets_for), 0) AS is_win']
+
+
+def player_match_frame(player_matches):
+    """Строки player_matches -> (match_id, player, finished_ts, duration_sec, is_win — победа этого игрока)."""
+    pm = player_matches.assign(is_win=player_matches['is_win'].astype(bool))
+    pm.insert(2, 'finished_ts', epoch_to_datetime(pm.pop('finished_epoch')))
+    return pm
+
+
+def fatigue_metrics(pm, players):
+    pm = pm.sort_values(['player', 'finished_ts', 'match_id'], kind='mergesort').reset_index(drop=True)
+    g = pm.groupby('player', sort=False)
+    n = g['match_id'].transform('size')
+    pm = pm[(n >= MIN_MATCHES).to_numpy()].reset_index(drop=True)
+
+    # Старт = финиш - длительность
+    dur = pm['duration_sec'].astype(float)
+    dur = dur.where(dur > 0, DEFAULT_DURATION_SEC)
+    start = pm['finished_ts'] - pd.to_timedelta(dur, unit='s')
+    # Отдых между соседними матчами игрока (первый матч игрока — NaN)
+    rest = start.groupby(pm['player'], sort=False).diff().dt.total_seconds() / 3600
+    hour = start.dt.hour
+    night = ((hour >= 22) | (hour < 7)).to_numpy()
+    has_rest = rest.notna()
+
+    agg = pd.DataFrame({
+        'player': pm['player'],
+        'matches_played': 1,
+        'rest': rest,
+        'rest_n': has_rest.astype(int),
+        'lt4': ((rest < 4) & has_rest).astype(int),
+        'lt8': ((rest < 8) & has_rest).astype(int),
+        'night': night.astype(int),
+        'night_win': (night & pm['is_win'].to_numpy()).astype(int),
+        'win': pm['is_win'].astype(int),
+    }).groupby('player', sort=False).agg(
+        matches_played=('matches_played', 'sum'), avg_rest_hours=('rest', 'mean'), rest_n=('rest_n', 'sum'),
+        lt4=('lt4', 'sum'), lt8=('lt8', 'sum'), night=('night', 'sum'), night_win=('night_win', 'sum'),
+        win=('win', 'sum'))
+
+    # Back-to-back: доля дат (по finished_ts), в которые у игрока 2+ матча
+    per_day = pm.groupby(['player', pm['finished_ts'].dt.date], sort=False).size()
+    days = per_day.groupby(level=0, sort=False).agg(['size', lambda c: (c > 1).sum()])
+    days.columns = ['days', 'btb_days']
+    agg = agg.join(days)
+
+    present = set(agg.index)
+    agg = agg.reindex([p for p in players if p in present])
+    rest_n = agg['rest_n'].to_numpy()
+    night_n = agg['night'].to_numpy()
+    played = agg['matches_played'].to_numpy()
+    return pd.DataFrame({
+        'player_name': agg.index,
+        'matches_played': played,
+        'avg_rest_hours': agg['avg_rest_hours'].to_numpy(),
+        'pct_rest_lt4h': np.where(rest_n > 0, agg['lt4'].to_numpy() / np.maximum(rest_n, 1), np.nan),
+        'pct_rest_lt8h': np.where(rest_n > 0, agg['lt8'].to_numpy() / np.maximum(rest_n, 1), np.nan),
+        'pct_back_to_back_days': np.where(played > 1, agg['btb_days'].to_numpy() / agg['days'].to_numpy(), np.nan),
+        'pct_night_matches': night_n / played,
+        'winrate_night': np.where(night_n > 0, agg['night_win'].to_numpy() / np.maximum(night_n, 1), np.nan),
+        'winrate_all': agg['win'].to_numpy() / played,
     })
 
-fatigue_df = pd.DataFrame(fatigue_rows)
-fatigue_df.to_sql('player_fatigue', conn, if_exists='replace', index=False)
-print(f'Таблица player_fatigue обновлена: {len(fatigue_df)} игроков')
-conn.close()
+
+if __name__ == '__main__':
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+
+    conn = sqlite3.connect(DB_PATH)
+    results = read_sql("SELECT player1, player2 FROM results", conn)
+    sync_player_matches(conn, ())  # дозаполнение матчей, ещё не прошедших нормализацию
+    # За год: окно — индексный диапазон по finished_epoch, время — из целых без разбора строк
+    last_year = read_player_matches(conn, PLAYER_MATCH_COLUMNS, since=to_epoch(pd.Timestamp.now() - pd.Timedelta(days=365)),
+                                    read=read_sql)
+
+    # Список игроков
+    players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
+
+    fatigue_df = fatigue_metrics(player_match_frame(last_year), players)
+    write_table(fatigue_df, 'player_fatigue', conn)
+    print(f'Таблица player_fatigue обновлена: {len(fatigue_df)} игроков')
+    conn.close()
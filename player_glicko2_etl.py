@@ -0,0 +1,392 @@
+"""
+player_glicko2_etl.py
+---------------------
+Рейтинг Glicko-2 (Glickman, 2013) по рейтинговым периодам — по умолчанию сутки (игровой день ЛигиПро).
+
+- Старт: rating 1500, RD 350, volatility 0.06; tau = 0.5
+- Все матчи периода считаются против рейтингов на начало периода; обновление векторное сразу
+  по всем сыгравшим в периоде игрокам (волатильность — итерация Illinois, тоже векторно)
+- Простой: RD растёт как sqrt(RD^2 + k * sigma^2) за k пропущенных периодов, но не выше 350;
+  считается лениво — при следующем матче игрока (last_period хранится в состоянии)
+- glicko2_snapshot: снапшот (rating, rd, volatility) каждого сыгравшего игрока на конец периода (snap_ts);
+  для as-of запросов (rating_index.py) снапшот периода виден только матчам после его окончания
+- glicko2_state: состояние игроков после последнего закрытого периода
+
+Инкрементальный режим (по умолчанию):
+- watermark в etl_state = начало первого незакрытого периода; закрытые периоды не пересчитываются,
+  новый день стоит только своих матчей
+- текущий (открытый) период считается заново при каждом запуске, его снапшоты перезаписываются,
+  в состояние он не попадает
+- Полный пересчёт: --full, смена --period, либо поздние/исправленные матчи в закрытых периодах
+  (по отпечатку: число матчей, сумма match_id и разниц сетов до watermark)
+- Матчи фильтруются и упорядочиваются по match_results.finished_epoch (целые с индексом, epoch_schema.py)
+
+Запуск:
+    python player_glicko2_etl.py               # инкрементально, периоды по 1 дню
+    python player_glicko2_etl.py --full --period 12h
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from db_utils import DB_PATH, get_watermark, set_watermark
+from epoch_schema import ensure_epoch_columns, epoch_to_datetime, to_epoch
+from etl_metrics import acquire_write_lock, count_rows_written, read_sql
+
+ETL_NAME = 'player_glicko2'
+META_NAME = 'player_glicko2_meta'  # отпечаток закрытых периодов и длина периода (JSON в etl_state)
+
+START_RATING = 1500.0
+START_RD = 350.0
+START_VOL = 0.06
+TAU = 0.5
+GLICKO_SCALE = 173.7178
+VOL_EPS = 1e-6
+DEFAULT_PERIOD = '1D'
+
+SNAPSHOT_COLUMNS = ['player_name', 'snap_ts', 'rating', 'rd', 'volatility', 'period']
+STATE_COLUMNS = ['player_name', 'rating', 'rd', 'volatility', 'last_period', 'total_matches']
+
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def load_matches(conn, after=None):
+    """Матчи в хронологии; after — только с finished_epoch >= after (начало незакрытого периода)."""
+    query = """
+        SELECT mr.match_id, mr.finished_epoch, mr.p1_sets, mr.p2_sets, r.player1, r.player2
+        FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch IS NOT NULL {}
+        ORDER BY mr.finished_epoch, mr.match_id
+    """
+    if after is None:
+        return read_sql(query.format(''), conn)
+    return read_sql(query.format('AND mr.finished_epoch >= ?'), conn, params=(to_epoch(after),))
+
+
+def load_players(conn):
+    results = read_sql("SELECT player1, player2 FROM results", conn)
+    return pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
+
+
+def fingerprint(conn, before):
+    """Отпечаток матчей до watermark: меняется при позднем/исправленном/удалённом матче."""
+    n, sum_id, sum_diff = conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(mr.match_id), 0),
+               COALESCE(SUM(COALESCE(mr.p1_sets, 0) - COALESCE(mr.p2_sets, 0)), 0)
+        FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch < ?
+    """, (to_epoch(before),)).fetchone()
+    return [n, sum_id, sum_diff]
+
+
+# --- Состояние ---
+
+def initial_state(players):
+    """Массивы состояния по id игрока (позиция в players); last_period = -1 — ещё не играл."""
+    n = len(players)
+    return {
+        'players': list(players),
+        'rating': np.full(n, START_RATING),
+        'rd': np.full(n, START_RD),
+        'vol': np.full(n, START_VOL),
+        'last_period': np.full(n, -1, dtype=np.int64),
+        'games': np.zeros(n, dtype=np.int64),
+    }
+
+
+def load_state(conn, players, origin, period):
+    state = initial_state(players)
+    df = read_sql("SELECT * FROM glicko2_state", conn)
+    pos = pd.Index(state['players']).get_indexer(df['player_name'])
+    df, pos = df[pos >= 0], pos[pos >= 0]
+    state['rating'][pos] = df['rating'].to_numpy(dtype=float)
+    state['rd'][pos] = df['rd'].to_numpy(dtype=float)
+    state['vol'][pos] = df['volatility'].to_numpy(dtype=float)
+    state['games'][pos] = df['total_matches'].to_numpy(dtype=np.int64)
+    last = pd.to_datetime(df['last_period'], errors='coerce')
+    state['last_period'][pos] = np.where(last.isna(), -1, period_index(last, origin, period))
+    return state
+
+
+def copy_state(state):
+    return {k: (v.copy() if isinstance(v, np.ndarray) else list(v)) for k, v in state.items()}
+
+
+def state_frame(state, origin, period):
+    played = state['last_period'] >= 0
+    last = pd.Series(period_start(state['last_period'], origin, period).strftime(TS_FORMAT))
+    return pd.DataFrame({
+        'player_name': state['players'],
+        'rating': state['rating'],
+        'rd': state['rd'],
+        'volatility': state['vol'],
+        'last_period': last.where(played, None),
+        'total_matches': state['games'],
+    }, columns=STATE_COLUMNS)
+
+
+# --- Периоды ---
+
+ORIGIN = pd.Timestamp('2000-01-01')  # общая точка отсчёта периодов (полночь)
+
+
+def period_index(ts, origin, period):
+    """Номер периода для времени ts (Series/DatetimeIndex) — целое число длин period от origin."""
+    delta = (pd.DatetimeIndex(ts).as_unit('ns') - origin).asi8
+    return np.floor_divide(delta, pd.Timedelta(period).value)
+
+
+def period_start(idx, origin, period):
+    return pd.DatetimeIndex(origin + np.asarray(idx, dtype=np.int64) * pd.Timedelta(period))
+
+
+# --- Glicko-2 ---
+
+def _g(phi):
+    return 1.0 / np.sqrt(1.0 + 3.0 * phi ** 2 / np.pi ** 2)
+
+
+def _new_volatility(sigma, phi, v, delta, tau=TAU):
+    """Шаг 5 Glicko-2: новая волатильность методом Illinois, векторно по игрокам."""
+    a = np.log(sigma ** 2)
+    phi2, d2 = phi ** 2, delta ** 2
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (d2 - phi2 - v - ex) / (2.0 * (phi2 + v + ex) ** 2) - (x - a) / tau ** 2
+
+    A = a.copy()
+    big = d2 > phi2 + v
+    B = np.where(big, np.log(np.where(big, d2 - phi2 - v, 1.0)), a - tau)
+    k = np.ones_like(a)
+    todo = ~big & (f(a - k * tau) < 0)
+    while todo.any():
+        k[todo] += 1
+        todo &= f(a - k * tau) < 0
+    B = np.where(big, B, a - k * tau)
+
+    fA, fB = f(A), f(B)
+    active = np.abs(B - A) > VOL_EPS
+    for _ in range(100):
+        if not active.any():
+            break
+        C = A + (A - B) * fA / (fB - fA)
+        fC = f(C)
+        swap = fC * fB <= 0
+        A = np.where(active & swap, B, A)
+        fA = np.where(active & swap, fB, np.where(active, fA / 2.0, fA))
+        B = np.where(active, C, B)
+        fB = np.where(active, fC, fB)
+        active &= np.abs(B - A) > VOL_EPS
+    return np.exp(A / 2.0)
+
+
+def rate_period(state, a, b, s1, p):
+    """
+    Один рейтинговый период p: матчи (a, b, s1) — id игроков и очки player1 (1 / 0 / 0.5).
+    Обновляет state на месте, возвращает id сыгравших игроков.
+    """
+    active = np.unique(np.concatenate([a, b]))
+    # Ленивый рост RD за пропущенные периоды (для новичков — стартовый RD)
+    idle = np.where(state['last_period'][active] >= 0, p - state['last_period'][active] - 1, 0)
+    phi_idle = np.sqrt((state['rd'][active] / GLICKO_SCALE) ** 2 + idle * state['vol'][active] ** 2)
+    state['rd'][active] = np.minimum(GLICKO_SCALE * phi_idle, START_RD)
+
+    mu = (state['rating'] - START_RATING) / GLICKO_SCALE
+    phi = state['rd'] / GLICKO_SCALE
+    # Обе стороны каждого матча: игрок, соперник, результат
+    me = np.concatenate([a, b])
+    opp = np.concatenate([b, a])
+    s = np.concatenate([s1, 1.0 - s1])
+    g_opp = _g(phi[opp])
+    E = 1.0 / (1.0 + np.exp(-g_opp * (mu[me] - mu[opp])))
+    n = len(state['players'])
+    v_inv = np.bincount(me, weights=g_opp ** 2 * E * (1.0 - E), minlength=n)[active]
+    score_sum = np.bincount(me, weights=g_opp * (s - E), minlength=n)[active]
+
+    v = 1.0 / v_inv
+    delta = v * score_sum
+    mu_a, phi_a = mu[active], phi[active]
+    sigma = _new_volatility(state['vol'][active], phi_a, v, delta)
+    phi_star = np.sqrt(phi_a ** 2 + sigma ** 2)
+    phi_new = 1.0 / np.sqrt(1.0 / phi_star ** 2 + 1.0 / v)
+    mu_new = mu_a + phi_new ** 2 * score_sum
+
+    state['rating'][active] = GLICKO_SCALE * mu_new + START_RATING
+    state['rd'][active] = GLICKO_SCALE * phi_new
+    state['vol'][active] = sigma
+    state['last_period'][active] = p
+    state['games'] += np.bincount(me, minlength=n)
+    return active
+
+
+def encode_matches(matches, players, origin, period):
+    ts = epoch_to_datetime(matches['finished_epoch'])
+    ok = ts.notna().to_numpy()
+    m = matches[ok]
+    idx = pd.Index(players)
+    p1s = m['p1_sets'].to_numpy(dtype=float)
+    p2s = m['p2_sets'].to_numpy(dtype=float)
+    return {
+        'p1': idx.get_indexer(m['player1']),
+        'p2': idx.get_indexer(m['player2']),
+        'period': period_index(ts[ok], origin, period),
+        's1': np.where(p1s > p2s, 1.0, np.where(p1s < p2s, 0.0, 0.5)),
+    }
+
+
+def run_periods(state, enc, origin, period):
+    """Прогон периодов по порядку; возвращает снапшоты [(period, id игроков, rating, rd, vol)]."""
+    snaps = []
+    periods = enc['period']
+    if len(periods) == 0:
+        return snaps
+    bounds = np.flatnonzero(np.diff(periods)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(periods)]])
+    for lo, hi in zip(starts, ends):
+        p = int(periods[lo])
+        active = rate_period(state, enc['p1'][lo:hi], enc['p2'][lo:hi], enc['s1'][lo:hi], p)
+        snaps.append((p, active, state['rating'][active].copy(), state['rd'][active].copy(),
+                      state['vol'][active].copy()))
+    return snaps
+
+
+def snapshot_frame(snaps, players, origin, period):
+    if not snaps:
+        return pd.DataFrame(columns=SNAPSHOT_COLUMNS)
+    names = np.asarray(players, dtype=object)
+    p = np.concatenate([np.full(len(s[1]), s[0]) for s in snaps])
+    start = period_start(p, origin, period)
+    return pd.DataFrame({
+        'player_name': names[np.concatenate([s[1] for s in snaps])],
+        'snap_ts': (start + pd.Timedelta(period)).strftime(TS_FORMAT),
+        'rating': np.concatenate([s[2] for s in snaps]),
+        'rd': np.concatenate([s[3] for s in snaps]),
+        'volatility': np.concatenate([s[4] for s in snaps]),
+        'period': start.strftime(TS_FORMAT),
+    }, columns=SNAPSHOT_COLUMNS)
+
+
+# --- Запись ---
+
+def ensure_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS glicko2_snapshot (
+            player_name TEXT,
+            snap_ts     TEXT,
+            rating      REAL,
+            rd          REAL,
+            volatility  REAL,
+            period      TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_glicko2_snapshot_player ON glicko2_snapshot(player_name, snap_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_glicko2_snapshot_ts ON glicko2_snapshot(snap_ts)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS glicko2_state (
+            player_name   TEXT PRIMARY KEY,
+            rating        REAL,
+            rd            REAL,
+            volatility    REAL,
+            last_period   TEXT,
+            total_matches INTEGER
+        )
+    """)
+    conn.commit()
+
+
+def _insert(conn, table, df, columns, verb='INSERT'):
+    conn.executemany(
+        f"{verb} INTO {table} ({','.join(columns)}) VALUES ({','.join('?' * len(columns))})",
+        df[columns].astype(object).where(df[columns].notna(), None).itertuples(index=False, name=None))
+
+
+def run(conn, period, full=False):
+    now = pd.Timestamp.now()
+    open_p = int(period_index(pd.DatetimeIndex([now]), ORIGIN, period)[0])
+    open_start = period_start([open_p], ORIGIN, period)[0].strftime(TS_FORMAT)
+
+    watermark = get_watermark(conn, ETL_NAME)
+    meta = json.loads(get_watermark(conn, META_NAME) or 'null')
+    players = load_players(conn)
+    if not full and watermark is not None and meta is not None:
+        if meta.get('period') != period:
+            print(f'glicko2: длина периода изменилась ({meta.get("period")} -> {period}) — полный пересчёт')
+            full = True
+        elif meta.get('fingerprint') != fingerprint(conn, watermark):
+            print(f'glicko2: поздние/исправленные матчи до {watermark} — полный пересчёт')
+            full = True
+    else:
+        full = True
+
+    ensure_tables(conn)
+    if full:
+        state = initial_state(players)
+        matches = load_matches(conn)
+    else:
+        state = load_state(conn, players, ORIGIN, period)
+        matches = load_matches(conn, after=watermark)
+
+    enc = encode_matches(matches, players, ORIGIN, period)
+    closed = enc['period'] < open_p
+    closed_enc = {k: v[closed] for k, v in enc.items()}
+    open_enc = {k: v[~closed] for k, v in enc.items()}
+    closed_snaps = run_periods(state, closed_enc, ORIGIN, period)
+    # Открытый период — на копии состояния: в glicko2_state не попадает
+    open_snaps = run_periods(copy_state(state), open_enc, ORIGIN, period)
+    df_snap = snapshot_frame(closed_snaps + open_snaps, players, ORIGIN, period)
+    # Состояние пишем только для игроков, сыгравших в новых закрытых периодах (при полном — всех)
+    df_state = state_frame(state, ORIGIN, period)
+    if not full:
+        touched = np.unique(np.concatenate([s[1] for s in closed_snaps])) if closed_snaps else []
+        df_state = df_state.iloc[touched]
+    # Все периоды до открытого теперь в состоянии (если часы ушли назад — watermark не откатываем)
+    new_watermark = open_start if full or watermark is None else max(open_start, watermark)
+
+    acquire_write_lock(conn)
+    try:
+        if full:
+            conn.execute("DELETE FROM glicko2_snapshot")
+            conn.execute("DELETE FROM glicko2_state")
+        else:
+            # Снапшоты прошлого открытого периода (и всё после watermark) пересчитаны заново
+            conn.execute("DELETE FROM glicko2_snapshot WHERE period >= ?", (watermark,))
+        _insert(conn, 'glicko2_snapshot', df_snap, SNAPSHOT_COLUMNS)
+        _insert(conn, 'glicko2_state', df_state, STATE_COLUMNS, verb='INSERT OR REPLACE')
+        set_watermark(conn, ETL_NAME, new_watermark)
+        set_watermark(conn, META_NAME, json.dumps({
+            'period': period, 'fingerprint': fingerprint(conn, new_watermark)}))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(df_snap) + len(df_state))
+    mode = 'полный пересчёт' if full else 'инкремент'
+    print(f'glicko2 ({mode}): матчей {len(matches)}, периодов {len(closed_snaps)} закрытых + '
+          f'{len(open_snaps)} открытых, снапшотов {len(df_snap)}, игроков в состоянии {len(df_state)}')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Glicko-2 рейтинг игроков ЛигиПро по периодам')
+    ap.add_argument('--full', action='store_true', help='Полный пересчёт с нуля')
+    ap.add_argument('--period', default=DEFAULT_PERIOD, help='Длина рейтингового периода (pandas: 1D, 12h, 7D)')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        ensure_epoch_columns(conn)
+        run(conn, args.period, full=args.full)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,8 @@ player_h2h_etl.py
     - balanced
     - chaotic
 - Стили соперников берутся из таблицы player_style
-- Только матчи за год (finished_ts)
+- Только матчи за год: строки player_matches за player1 (player_matches.py) — индексный диапазон
+  по finished_epoch (epoch_schema.py), сеты и суммы очков посчитаны при нормализации
 - В таблице player_h2h сохраняет:
     player_name,
     h2h_vs_aggressive_winrate,
@@ -18,63 +19,171 @@ player_h2h_etl.py
     h2h_vs_chaotic_winrate,
     ... (всё аналогично)
 
+Считается из разреженной матрицы личных встреч (h2h_store.py) за год:
+- пары (игрок, соперник) -> встречи и победы, стиль соперника из player_style, groupby по (игрок, стиль)
+- матрица пар за окно 365 дней хранится в player_h2h_pairs и обновляется инкрементально:
+  новые матчи после watermark добавляются, выпавшие из окна — вычитаются
+- полный пересчёт: --full, первый запуск или поздние/исправленные матчи в окне (по отпечатку)
+
 Author: GPT-4 + Кирилл
 """
 
+import argparse
+import json
 import sqlite3
 import pandas as pd
 import numpy as np
 import os
-from datetime import datetime
-
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-results = pd.read_sql_query("SELECT * FROM results", conn)
-match_results = pd.read_sql_query("SELECT * FROM match_results", conn)
-player_style = pd.read_sql_query("SELECT * FROM player_style", conn)
-
-match_results = match_results.merge(
-    results[['match_id', 'player1', 'player2']],
-    on='match_id', how='left')
-match_results['finished_ts'] = pd.to_datetime(match_results['finished_ts'], errors='coerce')
-last_year = match_results[match_results['finished_ts'] >= pd.Timestamp.now() - pd.Timedelta(days=365)]
-
-# Получаем стили соперников
-style_dict = dict(zip(player_style['player_name'], player_style['style']))
-
-players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
-
-rows = []
-for player in players:
-    pm = last_year[(last_year['player1'] == player) | (last_year['player2'] == player)].copy()
-    pm = pm.sort_values('finished_ts')
-    if len(pm) < 5:
-        continue
-    h2h = {s: {'win': 0, 'total': 0} for s in ['aggressive', 'defensive', 'balanced', 'chaotic']}
-    for idx, row in pm.iterrows():
-        # Определяем соперника
-        if row['player1'] == player:
-            opp = row['player2']
-            is_win = row['p1_sets'] > row['p2_sets']
+from db_utils import DB_PATH, get_watermark, set_watermark
+from epoch_schema import ensure_epoch_columns, to_epoch
+from etl_metrics import acquire_write_lock, count_rows_written, read_sql, write_table
+from h2h_store import PAIR_COLUMNS, PAIRS_TABLE, H2HStore
+from player_matches import PLAYER_MATCHES_TABLE, sync_player_matches
+from rating_index import table_exists
+
+ETL_NAME = 'player_h2h'
+META_NAME = 'player_h2h_meta'  # начало окна и отпечаток матчей в окне (JSON в etl_state)
+WINDOW_DAYS = 365
+MIN_MATCHES = 5
+STYLES = ['aggressive', 'defensive', 'balanced', 'chaotic']
+
+
+def load_matches(conn, where, params):
+    """
+    Матчи с игроками, сетами и суммой очков — строки player_matches за player1; where — условие на finished_epoch
+    (epoch_schema.py), границы — строки времени, переводятся в epoch-секунды здесь.
+    """
+    return read_sql(f"""
+        SELECT match_id, finished_ts, sets_for AS p1_sets, sets_against AS p2_sets,
+               player AS player1, opponent AS player2, pts_for AS p1_pts, pts_against AS p2_pts,
+               finished_epoch AS ts_sec
+        FROM {PLAYER_MATCHES_TABLE}
+        WHERE is_p1 = 1 AND {where}
+        ORDER BY finished_epoch, match_id
+    """, conn, params=[to_epoch(p) for p in params])
+
+
+def fingerprint(conn, start, end):
+    """Отпечаток матчей окна [start, end]: меняется при позднем/исправленном/удалённом матче."""
+    return list(conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(mr.match_id), 0),
+               COALESCE(SUM(COALESCE(mr.p1_sets, 0) - COALESCE(mr.p2_sets, 0)), 0),
+               COALESCE(SUM(COALESCE(mr.p1_sets, 0)), 0)
+        FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch >= ? AND mr.finished_epoch <= ?
+    """, (to_epoch(start), to_epoch(end))).fetchone())
+
+
+def style_winrates(store, players, styles):
+    """player_h2h из матрицы пар: winrate против каждого стиля; игроки с >= MIN_MATCHES встреч в окне."""
+    view = store.player_view()
+    totals = view.groupby('player')['meetings'].sum()
+    view['style'] = view['opponent'].map(styles)
+    eligible = [p for p in players if totals.get(p, 0) >= MIN_MATCHES]
+    cells = pd.MultiIndex.from_product([eligible, STYLES], names=['player', 'style'])
+    by_style = (view[view['style'].isin(STYLES)].groupby(['player', 'style'])[['wins', 'meetings']].sum()
+                .reindex(cells, fill_value=0))
+    wins = by_style['wins'].to_numpy().reshape(len(eligible), len(STYLES))
+    total = by_style['meetings'].to_numpy().reshape(len(eligible), len(STYLES))
+    out = pd.DataFrame({'player_name': eligible})
+    for i, style in enumerate(STYLES):
+        out[f'h2h_vs_{style}_winrate'] = np.where(total[:, i] > 0, wins[:, i] / np.maximum(total[:, i], 1), np.nan)
+    return out
+
+
+def save_meta(conn, start, end):
+    set_watermark(conn, ETL_NAME, end)
+    set_watermark(conn, META_NAME, json.dumps({'start': start, 'fingerprint': fingerprint(conn, start, end)}))
+
+
+def write_pairs(conn, df, verb='INSERT OR REPLACE'):
+    conn.executemany(
+        f"{verb} INTO {PAIRS_TABLE} ({','.join(PAIR_COLUMNS)}) VALUES ({','.join('?' * len(PAIR_COLUMNS))})",
+        df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def run_full(conn, start):
+    set_watermark(conn, ETL_NAME, None)
+    conn.commit()
+    matches = load_matches(conn, 'finished_epoch >= ?', (start,))
+    store = H2HStore.from_matches(matches)
+    pairs = store.to_frame()
+    write_table(pairs, PAIRS_TABLE, conn)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{PAIRS_TABLE} ON {PAIRS_TABLE}(player_lo, player_hi)")
+    if len(matches):
+        save_meta(conn, start, matches['finished_ts'].iloc[-1])
+    conn.commit()
+    print(f'{PAIRS_TABLE}: полный пересчёт, {len(pairs)} пар по {len(matches)} матчам')
+    return store
+
+
+def run_incremental(conn, start, watermark, old_start):
+    store = H2HStore.from_frame(read_sql(f"SELECT * FROM {PAIRS_TABLE}", conn))
+    new = load_matches(conn, 'finished_epoch > ? AND finished_epoch >= ?', (watermark, start))
+    expired = load_matches(conn, 'finished_epoch >= ? AND finished_epoch < ? AND finished_epoch <= ?',
+                           (old_start, start, watermark))
+    touched = set(store.update(new, +1)) | set(store.update(expired, -1))
+    dropped = store.drop_empty()
+    touched -= set(dropped)
+
+    acquire_write_lock(conn)
+    try:
+        write_pairs(conn, store.to_frame(sorted(touched)))
+        conn.executemany(f"DELETE FROM {PAIRS_TABLE} WHERE player_lo = ? AND player_hi = ?", dropped)
+        save_meta(conn, start, new['finished_ts'].iloc[-1] if len(new) else watermark)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(touched) + len(dropped))
+    print(f'{PAIRS_TABLE}: +{len(new)} / -{len(expired)} матчей, обновлено {len(touched)} пар, удалено {len(dropped)}')
+    return store
+
+
+def rebuild_reason(conn, start, watermark):
+    """Почему нужен полный пересчёт матрицы пар; None — можно инкрементально."""
+    if watermark is None or not table_exists(conn, PAIRS_TABLE):
+        return 'нет сохранённой матрицы пар'
+    meta = json.loads(get_watermark(conn, META_NAME) or 'null')
+    if meta is None or meta.get('start') is None or meta['start'] > start:
+        return 'окно сдвинулось назад'
+    if meta.get('fingerprint') != fingerprint(conn, meta['start'], watermark):
+        return f'поздние/исправленные матчи до {watermark}'
+    return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description='H2H winrate против стилей соперников + матрица личных встреч')
+    ap.add_argument('--full', action='store_true', help='Пересобрать матрицу пар с нуля')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        ensure_epoch_columns(conn)
+        sync_player_matches(conn, ())  # дозаполнение матчей, ещё не прошедших нормализацию
+        # Окно как раньше: finished_ts >= now - 365 дней
+        start = str(pd.Timestamp.now() - pd.Timedelta(days=WINDOW_DAYS))
+        watermark = get_watermark(conn, ETL_NAME)
+        reason = '--full' if args.full else rebuild_reason(conn, start, watermark)
+        if reason:
+            print(f'{PAIRS_TABLE}: {reason} — полный пересчёт')
+            store = run_full(conn, start)
         else:
-            opp = row['player1']
-            is_win = row['p2_sets'] > row['p1_sets']
-        style = style_dict.get(opp)
-        if style in h2h:
-            h2h[style]['total'] += 1
-            if is_win:
-                h2h[style]['win'] += 1
-    result = {'player_name': player}
-    for style in h2h:
-        key = f'h2h_vs_{style}_winrate'
-        total = h2h[style]['total']
-        result[key] = h2h[style]['win'] / total if total else np.nan
-    rows.append(result)
-
-df_h2h = pd.DataFrame(rows)
-df_h2h.to_sql('player_h2h', conn, if_exists='replace', index=False)
-print(f'Таблица player_h2h обновлена: {len(df_h2h)} игроков')
-conn.close()
+            store = run_incremental(conn, start, watermark, json.loads(get_watermark(conn, META_NAME))['start'])
+
+        results = read_sql("SELECT player1, player2 FROM results", conn)
+        player_style = read_sql("SELECT player_name, style FROM player_style", conn)
+        players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
+        # Получаем стили соперников
+        style_dict = dict(zip(player_style['player_name'], player_style['style']))
+        df_h2h = style_winrates(store, players, style_dict)
+        write_table(df_h2h, 'player_h2h', conn)
+        print(f'Таблица player_h2h обновлена: {len(df_h2h)} игроков')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+player_matches.py
+-----------------
+Матч с точки зрения игрока (long-формат «игрок — матч») — материализуется при нормализации results
+(fill_match_results_and_sets), per-player ETL читают его индексным диапазоном вместо сборки из match_results.
+
+Таблица player_matches, строка на (матч, сторона):
+- is_p1 = 1 — строка за player1, 0 — за player2; NULL-игрок пропускается
+- матч «сам с собой» (player1 == player2) — одна строка за player1, как в ETL (фильтр player1 == p | player2 == p)
+- is_win, sets_for / sets_against, pts_for / pts_against (сумма очков по set_scores) — за игрока строки
+- start_ts = finished_ts - duration_sec; целое время (фолбэк парсера) остаётся целым
+- finished_epoch / start_epoch и индекс — epoch_schema.py; индекс (player, finished_ts) — для выборок по игроку
+
+Обновление: sync_player_matches(conn, match_ids) — эти матчи + матчи match_results без строк (дозаполнение),
+None — пересборка. ETL перед чтением зовут sync_player_matches(conn, ()) — только дозаполнение.
+Чтение: read_player_matches — строки окна `finished_epoch >= ?`; match_view — обратно к колонкам матча
+(player1 / player2, p1_sets / p2_sets) для расчётов, которые смотрят на обе стороны матча.
+"""
+
+import pandas as pd
+
+from epoch_schema import ensure_epoch_columns
+
+PLAYER_MATCHES_TABLE = 'player_matches'
+
+DDL = f"""
+CREATE TABLE IF NOT EXISTS {PLAYER_MATCHES_TABLE} (
+    match_id INTEGER,
+    is_p1 INTEGER,
+    player TEXT,
+    opponent TEXT,
+    is_win INTEGER,
+    sets_for INTEGER,
+    sets_against INTEGER,
+    pts_for INTEGER,
+    pts_against INTEGER,
+    start_ts TEXT,
+    finished_ts TEXT,
+    table_label TEXT,
+    duration_sec INTEGER,
+    PRIMARY KEY (match_id, is_p1)
+)
+"""
+INDEX_DDL = f"CREATE INDEX IF NOT EXISTS idx_player_matches_player_ts ON {PLAYER_MATCHES_TABLE}(player, finished_ts)"
+
+SIDE_SELECT = """
+    SELECT m.match_id, {is_p1}, r.{me}, r.{opp},
+           m.{me_sets} > m.{opp_sets}, m.{me_sets}, m.{opp_sets},
+           (SELECT SUM({me_pts}) FROM set_scores s WHERE s.match_id = m.match_id),
+           (SELECT SUM({opp_pts}) FROM set_scores s WHERE s.match_id = m.match_id),
+           CASE WHEN m.finished_ts GLOB '[0-9]*' AND m.finished_ts NOT GLOB '*[^0-9]*'
+                THEN CAST(m.finished_ts AS INTEGER) - m.duration_sec
+                ELSE datetime(m.finished_ts, '-' || m.duration_sec || ' seconds') END,
+           m.finished_ts, r.table_label, m.duration_sec
+    FROM match_results m JOIN results r ON r.match_id = m.match_id
+    WHERE r.{me} IS NOT NULL {where}
+"""
+SIDES = [
+    dict(is_p1=1, me='player1', opp='player2', me_sets='p1_sets', opp_sets='p2_sets', me_pts='p1_pts', opp_pts='p2_pts'),
+    dict(is_p1=0, me='player2', opp='player1', me_sets='p2_sets', opp_sets='p1_sets', me_pts='p2_pts', opp_pts='p1_pts'),
+]
+# Матч «сам с собой» — только строка за player1
+SELF_MATCH_FILTER = {1: '', 0: 'AND r.player2 IS NOT r.player1'}
+
+
+def create_table(conn):
+    """Таблица, индекс по игроку и epoch-колонки (без них нет индексного диапазона по finished_epoch). Коммитит."""
+    conn.execute(DDL)
+    conn.execute(INDEX_DDL)
+    ensure_epoch_columns(conn)
+
+
+def sync_player_matches(conn, match_ids=None):
+    """
+    Пересобирает строки player_matches: по всем match_results (match_ids=None) или по match_ids + матчам
+    без строк в таблице (match_ids=() — только дозаполнение). Коммитит.
+    """
+    c = conn.cursor()
+    create_table(conn)
+    where = ''
+    if match_ids is None:
+        c.execute(f"DELETE FROM {PLAYER_MATCHES_TABLE}")
+    else:
+        # Вторая строка матча «сам с собой» — от прежней версии таблицы
+        c.execute(f"DELETE FROM {PLAYER_MATCHES_TABLE} WHERE is_p1 = 0 AND player = opponent")
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS _pm_ids (match_id INTEGER PRIMARY KEY)")
+        c.execute("DELETE FROM _pm_ids")
+        c.executemany("INSERT OR IGNORE INTO _pm_ids VALUES (?)", [(mid,) for mid in match_ids])
+        c.execute(f"""
+            INSERT OR IGNORE INTO _pm_ids SELECT m.match_id FROM match_results m
+            WHERE NOT EXISTS (SELECT 1 FROM {PLAYER_MATCHES_TABLE} p WHERE p.match_id = m.match_id)
+        """)
+        c.execute(f"DELETE FROM {PLAYER_MATCHES_TABLE} WHERE match_id IN (SELECT match_id FROM _pm_ids)")
+        where = 'AND m.match_id IN (SELECT match_id FROM _pm_ids)'
+    for side in SIDES:
+        c.execute(f"INSERT INTO {PLAYER_MATCHES_TABLE} (match_id, is_p1, player, opponent, is_win, sets_for, "
+                  "sets_against, pts_for, pts_against, start_ts, finished_ts, table_label, duration_sec)"
+                  + SIDE_SELECT.format(where=f"{where} {SELF_MATCH_FILTER[side['is_p1']]}", **side))
+    conn.commit()
+
+
+def read_player_matches(conn, columns, since=None, after=None, order=None, read=pd.read_sql_query):
+    """
+    Строки player_matches (columns — колонки или SQL-выражения): since — finished_epoch >= since,
+    after — finished_epoch > after (epoch-секунды, индексный диапазон); order — ORDER BY, None — порядок индекса.
+    """
+    where, params = [], []
+    if since is not None:
+        where.append('finished_epoch >= ?')
+        params.append(since)
+    if after is not None:
+        where.append('finished_epoch > ?')
+        params.append(after)
+    query = f"SELECT {', '.join(columns)} FROM {PLAYER_MATCHES_TABLE} WHERE {' AND '.join(where) or '1'}"
+    if order:
+        query += f" ORDER BY {order}"
+    return read(query, conn, params=params)
+
+
+def match_view(pm):
+    """Строки игрока + колонки матча: player1 / player2, p1_sets / p2_sets по is_p1."""
+    is_p1 = pm['is_p1'].astype(bool)
+    return pm.assign(
+        is_p1=is_p1,
+        player1=pm['player'].where(is_p1, pm['opponent']),
+        player2=pm['opponent'].where(is_p1, pm['player']),
+        p1_sets=pm['sets_for'].where(is_p1, pm['sets_against']),
+        p2_sets=pm['sets_against'].where(is_p1, pm['sets_for']),
+    )
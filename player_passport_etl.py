@@ -12,37 +12,64 @@ player_passport_etl.py
 - Объединяет по player_name (left join)
 - Сохраняет результат в player_passport (готов к ML/аналитике/выгрузке)
 
+Инкрементально (player_upsert): по каждому игроку хранится отпечаток его строк во всех пяти таблицах;
+пересобираются и upsert'ятся (ключ player_name) только игроки, чьи строки изменились, исчезнувшие — удаляются.
+Полная пересборка — при первом запуске, смене набора колонок или с --full.
+
 Author: GPT-4 + Кирилл
 """
 
+import argparse
 import sqlite3
 import pandas as pd
 import os
+from db_utils import DB_PATH
+from etl_metrics import read_sql
+from player_upsert import changed_players, input_hashes, publish_changed, publish_full, rebuild_reason
+
+SOURCES = ['player_elo', 'player_fatigue', 'player_style', 'player_resilience', 'player_h2h']
+OUTPUT_TABLE = 'player_passport'
+STATE_TABLE = 'player_passport_state'
+
+
+def merge_passport(frames, players):
+    # object, а не вывод типа: пустой список игроков дал бы float64 и merge по ключу не сработал бы
+    passport = pd.DataFrame({'player_name': pd.Series(players, dtype=object)})
+    for df in frames:
+        passport = passport.merge(df, on='player_name', how='left')
+    return passport
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Паспорт игрока: merge player_elo/fatigue/style/resilience/h2h')
+    ap.add_argument('--full', action='store_true', help='Полная пересборка player_passport')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+
+    conn = sqlite3.connect(DB_PATH)
+    frames = [read_sql(f"SELECT * FROM {table}", conn) for table in SOURCES]
+
+    # Собираем master-list игроков (все кто был хотя бы в одном из модулей)
+    players = pd.unique(pd.concat([df['player_name'] for df in frames])).tolist()
+    hashes = input_hashes(frames)
+    columns = merge_passport([df[:0] for df in frames], []).columns
+
+    reason = '--full' if args.full else rebuild_reason(conn, OUTPUT_TABLE, STATE_TABLE, columns)
+    if reason:
+        passport = merge_passport(frames, players)
+        publish_full(conn, OUTPUT_TABLE, STATE_TABLE, passport, hashes)
+        print(f'Паспорт игроков собран ({reason}): {len(passport)} строк. Таблица player_passport обновлена!')
+    else:
+        changed, removed = changed_players(conn, STATE_TABLE, hashes)
+        subset = set(changed)
+        passport = merge_passport([df[df['player_name'].isin(subset)] for df in frames],
+                                  [p for p in players if p in subset])
+        updated, deleted = publish_changed(conn, OUTPUT_TABLE, STATE_TABLE, passport, hashes, changed, removed)
+        print(f'Паспорт игроков: обновлено {updated}, удалено {deleted} строк. Таблица player_passport обновлена!')
+    conn.close()
+
 
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-elo = pd.read_sql_query("SELECT * FROM player_elo", conn)
-fatigue = pd.read_sql_query("SELECT * FROM player_fatigue", conn)
-style = pd.read_sql_query("SELECT * FROM player_style", conn)
-resilience = pd.read_sql_query("SELECT * FROM player_resilience", conn)
-h2h = pd.read_sql_query("SELECT * FROM player_h2h", conn)
-
-# Собираем master-list игроков (все кто был хотя бы в одном из модулей)
-players = pd.unique(pd.concat([
-    elo['player_name'], fatigue['player_name'], style['player_name'],
-    resilience['player_name'], h2h['player_name']
-])).tolist()
-
-passport = pd.DataFrame({'player_name': players})
-passport = passport.merge(elo, on='player_name', how='left')
-passport = passport.merge(fatigue, on='player_name', how='left')
-passport = passport.merge(style, on='player_name', how='left')
-passport = passport.merge(resilience, on='player_name', how='left')
-passport = passport.merge(h2h, on='player_name', how='left')
-
-passport.to_sql('player_passport', conn, if_exists='replace', index=False)
-print(f'Паспорт игроков собран: {len(passport)} строк. Таблица player_passport обновлена!')
-conn.close()
+if __name__ == '__main__':
+    main()
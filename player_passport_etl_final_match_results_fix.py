@@ -1,14 +1,50 @@
+"""
+player_passport_etl_final_match_results_fix.py
+----------------------------------------------
+Паспорта игроков (таблица player_passports) по match_results / set_scores за последние 365 дней:
+winrate, маржа по сетам, попадания в тоталы, покрытия фор, длительность матчей, отдых между матчами.
+Игроки с < 3 матчами в окне пропускаются.
+
+Инкрементально (player_upsert): отпечаток входа игрока — его матчи в окне (счёт, время, длительность,
+очки по сетам) и средняя длительность лиги, если она подставлялась вместо пропущенной длительности.
+Пересчитываются и upsert'ятся (ключ player_name) только игроки с изменившимся отпечатком:
+новый матч, правка счёта, выход матча из окна. Игроки без паспорта (< 3 матчей) удаляются.
+Полная пересборка — при первом запуске, смене набора колонок или с --full.
+
+Игроки считаются шардами в пуле процессов (etl_parallel, --workers): матчи окна и сеты уходят воркерам
+снимком .npy (memmap), порядок паспортов — как в однопроцессном прогоне.
+
+Матчи окна и матчи каждого игрока — из одного индексного чтения player_matches (player_matches.py)
+по finished_epoch: строка матча — первая его строка (за player1), позиции матчей игрока — его строки таблицы.
+"""
+
+import argparse
 import sqlite3
 import pandas as pd
 import numpy as np
 import os
 from datetime import datetime, timedelta
+from db_utils import DB_PATH
+from epoch_schema import epoch_to_datetime, to_epoch
+from etl_metrics import read_sql
+from etl_parallel import run_sharded
+from player_matches import match_view, read_player_matches, sync_player_matches
+from player_upsert import changed_players, input_hashes, publish_changed, publish_full, rebuild_reason
+from set_store import SetScoreStore
 
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}\nСкопируй файл betcity_results.db в эту же папку.")
+OUTPUT_TABLE = 'player_passports'
+STATE_TABLE = 'player_passports_state'
+OUTPUT_COLUMNS = [
+    'player_name', 'matches_played', 'win_pct_all', 'win_pct_20', 'avg_set_margin', 'set_margin_sd',
+    'ov70_5_hit_pct', 'ov72_5_hit_pct', 'ov74_5_hit_pct', 'ov75_5_hit_pct', 'ov78_5_hit_pct', 'ov80_5_hit_pct',
+    'cover_set_m1_5_pct', 'cover_set_p1_5_pct', 'cover_pt_m3_5_pct', 'cover_pt_p3_5_pct',
+    'avg_match_duration_sec', 'pct_matches_gt18min', 'avg_rest_hours', 'pct_rest_lt8h',
+]
+# Колонки матча, от которых зависит паспорт
+MATCH_COLUMNS = ['match_id', 'finished_ts', 'player1', 'player2', 'p1_sets', 'p2_sets', 'duration_sec']
+PLAYER_MATCH_COLUMNS = ['match_id', 'is_p1', 'player', 'opponent', 'sets_for', 'sets_against', 'finished_epoch',
+                        'duration_sec']
 
-conn = sqlite3.connect(DB_PATH)
 
 def table_and_columns(conn):
     tbls = pd.read_sql_query("SELECT name FROM sqlite_master WHERE type='table'", conn)['name'].tolist()
@@ -21,56 +57,57 @@ def table_and_columns(conn):
             info[t] = [f"Could not read columns: {e}"]
     return info
 
-info = table_and_columns(conn)
-print('\nВ базе найдены таблицы и столбцы:')
-for t, cols in info.items():
-    print(f'  {t}: {cols}')
-
-# --- Грузим match_results и set_scores ---
-match_results = pd.read_sql_query("SELECT * FROM match_results", conn)
-set_scores = pd.read_sql_query("SELECT * FROM set_scores", conn)
-
-# --- Грузим имена игроков из results ---
-results = pd.read_sql_query("SELECT * FROM results", conn)
-
-# Получаем мапу: match_id -> (player1, player2)
-matchid2players = results.set_index('match_id')[['player1', 'player2']].to_dict('index')
-
-# Добавляем player1/player2 к match_results (мердж по match_id)
-match_results = match_results.merge(
-    results[['match_id', 'player1', 'player2']],
-    how='left', on='match_id',
-)
-
-match_results['finished_ts'] = pd.to_datetime(match_results['finished_ts'], errors='coerce')
-recent_matches = match_results[
-    (match_results['finished_ts'] >= pd.Timestamp.now() - pd.Timedelta(days=365))
-].copy()
-
-# Список всех игроков по results
-players = pd.unique(pd.concat([
-    results['player1'],
-    results['player2']
-])).tolist()
-
-# League rolling avg duration
-recent_30d = match_results[
-    match_results['finished_ts'] >= pd.Timestamp.now() - pd.Timedelta(days=30)
-]
-league_avg_duration_30d = recent_30d['duration_sec'].replace(0, np.nan).dropna().mean()
-if np.isnan(league_avg_duration_30d):
-    league_avg_duration_30d = 930
 
 def safe_div(a, b):
     return float(a)/b if b else np.nan
 
-passports = []
-for player in players:
-    pm = recent_matches[(recent_matches['player1'] == player) | (recent_matches['player2'] == player)].sort_values('finished_ts')
+
+def player_match_rows(player_matches):
+    """
+    Строки player_matches окна (по match_id, в матче сначала за player1) -> (матчи окна по match_id с MATCH_COLUMNS,
+    игрок -> позиции его матчей в них по возрастанию). NULL-игрок и матч «сам с собой» — по правилам таблицы.
+    """
+    pm = match_view(player_matches)
+    pm['finished_ts'] = epoch_to_datetime(pm.pop('finished_epoch'))
+    first = ~pm['match_id'].duplicated().to_numpy()
+    matches = pm.loc[first, MATCH_COLUMNS].reset_index(drop=True)
+    row = np.cumsum(first) - 1
+    long = pd.DataFrame({'player': pm['player'].to_numpy(dtype=object), 'row': row})
+    return matches, {p: row[idx] for p, idx in long.groupby('player', sort=False).indices.items()}
+
+
+def passport_input_hashes(recent_matches, rows_by_player, set_store, league_avg_duration_30d):
+    """Отпечаток входа игрока: строки его матчей в окне + очки по сетам + подставляемая средняя длительность."""
+    p1_tot, p2_tot, n_sets = set_store.totals(recent_matches['match_id'])
+    matches = recent_matches[MATCH_COLUMNS].assign(p1_tot=p1_tot, p2_tot=p2_tot, n_sets=n_sets)
+    matches['rolling_avg'] = np.where(matches['duration_sec'] > 0, np.nan, league_avg_duration_30d)
+    players = list(rows_by_player)
+    rows = np.concatenate([rows_by_player[p] for p in players]) if players else np.zeros(0, dtype=np.int64)
+    long = matches.iloc[rows].reset_index(drop=True)
+    long.insert(0, 'player_name', np.repeat(np.array(players, dtype=object),
+                                            [len(rows_by_player[p]) for p in players]))
+    return input_hashes([long])
+
+
+def passport_shard(players, shared):
+    """Паспорта шарда игроков (в воркере etl_parallel): матчи игрока — его строки общего снимка окна."""
+    matches, rows, bounds = shared['matches'], shared['rows'], shared['bounds']
+    set_store = SetScoreStore(shared['set_match_ids'], shared['set_offsets'], shared['set_p1'], shared['set_p2'])
+    passports = []
+    for player in players:
+        a, b = bounds[player]
+        passport = player_passport(player, matches.take(rows[a:b]), set_store, shared['league_avg_duration_30d'])
+        if passport is not None:
+            passports.append(passport)
+    return passports
+
+
+def player_passport(player, pm, set_store, league_avg_duration_30d):
+    """Паспорт игрока по его матчам в окне (pm) или None, если матчей < 3."""
+    pm = pm.sort_values('finished_ts')
     if len(pm) < 3:
-        continue
+        return None
 
-    pm = pm.copy()
     pm['is_win'] = np.where(
         ((pm['player1'] == player) & (pm['p1_sets'] > pm['p2_sets'])) |
         ((pm['player2'] == player) & (pm['p2_sets'] > pm['p1_sets'])), 1, 0
@@ -82,13 +119,8 @@ for player in players:
     win_pct_all = safe_div(pm['is_win'].sum(), matches_played)
     win_pct_20 = safe_div(pm.tail(20)['is_win'].sum(), min(20, matches_played))
 
-    total_pts = []
-    for idx, row in pm.iterrows():
-        mid = row['match_id']
-        s = set_scores[set_scores['match_id'] == mid]
-        pts = s['p1_pts'].sum() + s['p2_pts'].sum() if not s.empty else np.nan
-        total_pts.append(pts)
-    pm['total_pts'] = total_pts
+    p1_tot, p2_tot, n_sets = set_store.totals(pm['match_id'])
+    pm['total_pts'] = np.where(n_sets > 0, p1_tot + p2_tot, np.nan)
 
     ov70_5_hit_pct = safe_div((pm['total_pts'] > 70.5).sum(), matches_played)
     ov72_5_hit_pct = safe_div((pm['total_pts'] > 72.5).sum(), matches_played)
@@ -102,18 +134,9 @@ for player in players:
     cover_set_m1_5_pct = safe_div(set_covers_m1_5, matches_played)
     cover_set_p1_5_pct = safe_div(set_covers_p1_5, matches_played)
 
-    p_points, o_points = [], []
-    for idx, row in pm.iterrows():
-        mid = row['match_id']
-        s = set_scores[set_scores['match_id'] == mid]
-        if row['player1'] == player:
-            ppts, opts = s['p1_pts'].sum(), s['p2_pts'].sum()
-        else:
-            ppts, opts = s['p2_pts'].sum(), s['p1_pts'].sum()
-        p_points.append(ppts)
-        o_points.append(opts)
-    pm['player_pts'] = p_points
-    pm['opp_pts'] = o_points
+    is_p1 = (pm['player1'] == player).to_numpy()
+    pm['player_pts'] = np.where(is_p1, p1_tot, p2_tot)
+    pm['opp_pts'] = np.where(is_p1, p2_tot, p1_tot)
     pt_margin = pm['player_pts'] - pm['opp_pts']
     cover_pt_m3_5_pct = safe_div(((pt_margin >= 4) & (pm['is_win'] == 1)).sum(), (pm['is_win'] == 1).sum())
     cover_pt_p3_5_pct = safe_div(((pt_margin >= -3) & (pm['is_win'] == 0)).sum(), (pm['is_win'] == 0).sum())
@@ -171,12 +194,87 @@ for player in players:
         'avg_rest_hours': avg_rest_hours,
         'pct_rest_lt8h': pct_rest_lt8h,
     }
-    passports.append(passport)
-
-df_pass = pd.DataFrame(passports)
-if not df_pass.empty:
-    df_pass.to_sql('player_passports', conn, if_exists='replace', index=False)
-    print(f"Готово: {len(df_pass)} паспортов обновлено. Файл БД: {DB_PATH}")
-else:
-    print(f"Нет данных для паспортов (слишком мало матчей или фильтрация). Файл БД: {DB_PATH}")
-conn.close()
+    return passport
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Паспорта игроков (player_passports) по match_results за 365 дней')
+    ap.add_argument('--full', action='store_true', help='Полная пересборка player_passports')
+    ap.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Процессов для расчёта паспортов')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}\nСкопируй файл betcity_results.db в эту же папку.")
+
+    conn = sqlite3.connect(DB_PATH)
+
+    info = table_and_columns(conn)
+    print('\nВ базе найдены таблицы и столбцы:')
+    for t, cols in info.items():
+        print(f'  {t}: {cols}')
+
+    # --- Грузим player_matches и set_scores ---
+    # За год: окно — индексный диапазон по finished_epoch (epoch_schema.py), время — из целых без разбора строк
+    sync_player_matches(conn, ())  # дозаполнение матчей, ещё не прошедших нормализацию
+    now = pd.Timestamp.now()
+    recent_matches, rows_by_player = player_match_rows(read_player_matches(
+        conn, PLAYER_MATCH_COLUMNS, since=to_epoch(now - pd.Timedelta(days=365)), order='match_id, is_p1 DESC',
+        read=read_sql))
+    set_store = SetScoreStore.from_db(conn, read=read_sql)
+
+    # --- Грузим имена игроков из results ---
+    results = read_sql("SELECT player1, player2 FROM results", conn)
+
+    # Список всех игроков по results
+    players = pd.unique(pd.concat([
+        results['player1'],
+        results['player2']
+    ])).tolist()
+
+    # League rolling avg duration — по всем матчам 30 дней, в том числе без игроков
+    recent_30d = read_sql("SELECT duration_sec FROM match_results WHERE finished_epoch >= ? ORDER BY match_id",
+                          conn, params=(to_epoch(now - pd.Timedelta(days=30)),))
+    league_avg_duration_30d = recent_30d['duration_sec'].replace(0, np.nan).dropna().mean()
+    if np.isnan(league_avg_duration_30d):
+        league_avg_duration_30d = 930
+
+    hashes = passport_input_hashes(recent_matches, rows_by_player, set_store, league_avg_duration_30d)
+
+    reason = '--full' if args.full else rebuild_reason(conn, OUTPUT_TABLE, STATE_TABLE, OUTPUT_COLUMNS)
+    if reason:
+        targets = players
+    else:
+        changed, removed = changed_players(conn, STATE_TABLE, hashes)
+        targets = [p for p in players if p in set(changed)]
+
+    # Матчи игрока — строки recent_matches в исходном порядке (как булева маска), затем sort_values
+    targets = [p for p in targets if p in rows_by_player]
+    sizes = np.array([len(rows_by_player[p]) for p in targets], dtype=np.int64)
+    ends = np.cumsum(sizes)
+    shared = {
+        'matches': recent_matches[MATCH_COLUMNS],
+        'rows': np.concatenate([rows_by_player[p] for p in targets]) if targets else np.zeros(0, dtype=np.int64),
+        'bounds': {p: (int(e - n), int(e)) for p, n, e in zip(targets, sizes, ends)},
+        'set_match_ids': set_store.match_ids,
+        'set_offsets': set_store.offsets,
+        'set_p1': set_store.p1_pts,
+        'set_p2': set_store.p2_pts,
+        'league_avg_duration_30d': league_avg_duration_30d,
+    }
+    passports = run_sharded(passport_shard, targets, shared, args.workers)
+
+    df_pass = pd.DataFrame(passports, columns=OUTPUT_COLUMNS)
+    if reason:
+        if not df_pass.empty:
+            publish_full(conn, OUTPUT_TABLE, STATE_TABLE, df_pass, hashes)
+            print(f"Готово ({reason}): {len(df_pass)} паспортов обновлено. Файл БД: {DB_PATH}")
+        else:
+            print(f"Нет данных для паспортов (слишком мало матчей или фильтрация). Файл БД: {DB_PATH}")
+    else:
+        updated, deleted = publish_changed(conn, OUTPUT_TABLE, STATE_TABLE, df_pass, hashes, changed, removed)
+        print(f"Готово: {updated} паспортов обновлено, {deleted} удалено. Файл БД: {DB_PATH}")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,40 @@
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime
 import numpy as np
+import pandas as pd
 import sys
 import json
+from db_utils import DB_PATH
+from epoch_schema import ensure_epoch_columns, epoch_hours
+from etl_metrics import count_rows_written, read_sql
+from set_store import SetScoreStore
 
-DB_PATH = 'betcity_results.db'
 TABLES = ['A3','A4','A5','A6','A9']
 NIGHT_START = 0
 NIGHT_END = 7
 FATIGUE_THRESHOLD = 0.8
 ROLLING_N = 120
 
+# Матчи с исходами, новые сверху: один упорядоченный запрос вместо запросов на каждый матч
+MATCHES_QUERY = """
+    SELECT r.match_id, r.player1, r.player2, r.table_label, mr.finished_ts, mr.finished_epoch, mr.p1_sets, mr.p2_sets,
+           mr.duration_sec, mr.match_intensity, mr.comeback
+    FROM results r JOIN match_results mr ON mr.match_id = r.match_id
+    {where}
+    ORDER BY mr.finished_ts DESC
+"""
+
 # Вспомогательные
 
-def is_night(ts: str) -> bool:
-    try:
-        dt = datetime.fromisoformat(ts)
-        return NIGHT_START <= dt.hour < NIGHT_END
-    except Exception:
-        return False
-
-def streak_calc(results):
-    max_streak = streak = 0
-    for win in results:
-        if win:
-            streak += 1
-            max_streak = max(max_streak, streak)
-        else:
-            streak = 0
-    return max_streak
+def is_night(epochs):
+    # Час — из finished_epoch (epoch_schema.py), без разбора строк; NULL (нераспознанное время) — не ночь
+    hours = epoch_hours(epochs)
+    return (NIGHT_START <= hours) & (hours < NIGHT_END)
+
+def truthy(values):
+    # Как if x: в Python — NULL и 0 ложны
+    v = values.to_numpy(dtype=float)
+    return ~np.isnan(v) & (v != 0)
 
 # Создать таблицу для паспортов игроков
 
@@ -45,146 +51,167 @@ def ensure_passport_table(db_path=DB_PATH):
     conn.commit()
     conn.close()
 
-# Построение паспорта по игроку
+# Загрузка: матчи + сеты (SetScoreStore) — все или только матчи одного игрока
+
+def load_matches(conn, player_name=None):
+    if player_name is None:
+        matches = read_sql(MATCHES_QUERY.format(where=''), conn)
+        return matches, SetScoreStore.from_db(conn, read=read_sql)
+    matches = read_sql(MATCHES_QUERY.format(where='WHERE r.player1 = ? OR r.player2 = ?'), conn,
+                       params=(player_name, player_name))
+    sets = read_sql("""
+        SELECT match_id, set_no, p1_pts, p2_pts FROM set_scores
+        WHERE match_id IN (SELECT match_id FROM results WHERE player1 = ? OR player2 = ?)
+    """, conn, params=(player_name, player_name))
+    return matches, SetScoreStore.from_frame(sets)
+
+# Признаки матча (одна строка на матч, порядок matches)
+
+def match_features(matches, set_store):
+    p1_pts, p2_pts, n_sets = set_store.padded(matches['match_id'])
+    valid = np.arange(p1_pts.shape[1]) < n_sets[:, None]
+    # Сеты с NULL-очками не сдаются, матч с ними не входит в volatility
+    complete = ~(valid & (np.isnan(p1_pts) | np.isnan(p2_pts))).any(axis=1)
+    # np.std(|p1 - p2|) по сетам матча; матч без сетов — 0
+    diff = np.where(valid, np.abs(p1_pts - p2_pts), 0.0)
+    n = np.maximum(n_sets, 1)
+    with np.errstate(invalid='ignore'):
+        mean = diff.sum(axis=1) / n
+        vol = np.sqrt(np.where(valid, (diff - mean[:, None]) ** 2, 0.0).sum(axis=1) / n)
+    duration = matches['duration_sec'].to_numpy(dtype=float)
+    intensity = matches['match_intensity'].to_numpy(dtype=float)
+    return {
+        'night': is_night(matches['finished_epoch']),
+        'fatigue': truthy(matches['duration_sec']) & ((duration > 1200) | (intensity > FATIGUE_THRESHOLD)),
+        'comeback': truthy(matches['comeback']),
+        'surrender_p1': ((p1_pts <= 1) & (p2_pts >= 11)).sum(axis=1),
+        'surrender_p2': ((p2_pts <= 1) & (p1_pts >= 11)).sum(axis=1),
+        'vol': np.where(n_sets > 0, vol, 0.0),
+        'has_vol': complete,
+    }
+
+# Построение паспортов всех игроков matches за один проход
+
+def build_passports(matches, set_store, last_updated=None, only=None):
+    """
+    Записи «игрок — матч»: за player1 и за player2 (матч «сам с собой» — одна запись, за player1),
+    у каждого игрока — в порядке matches (новые сверху). Счётчики — bincount по игроку,
+    форма и серии — по номеру записи внутри игрока. Возвращает паспорта по алфавиту игроков
+    (only — только этот игрок).
+    """
+    last_updated = last_updated or datetime.now().isoformat(timespec='seconds')
+    m = matches.reset_index(drop=True)
+    f = match_features(m, set_store)
+    p1 = m['player1'].to_numpy(dtype=object)
+    p2 = m['player2'].to_numpy(dtype=object)
+    # Игроки — непустые имена (как if row[0] при выборе игроков)
+    named = lambda col: np.fromiter((bool(x) and isinstance(x, str) and (only is None or x == only) for x in col),
+                                    dtype=bool, count=len(col))
+    side1 = named(p1)
+    side2 = named(p2) & (p2 != p1)
+    row = np.concatenate([np.flatnonzero(side1), np.flatnonzero(side2)])
+    is_p1 = np.concatenate([np.ones(side1.sum(), dtype=bool), np.zeros(side2.sum(), dtype=bool)])
+    # Номер игрока по алфавиту: factorize (хеш) + сортировка уникальных имён
+    code, names = pd.factorize(np.concatenate([p1[side1], p2[side2]]))
+    alpha = np.argsort(np.asarray(names, dtype=object))
+    names = np.asarray(names, dtype=object)[alpha]
+    code = np.argsort(alpha)[code]
+    order = np.lexsort((row, code))
+    row, is_p1, code = row[order], is_p1[order], code[order]
+    bounds = np.searchsorted(code, np.arange(len(names) + 1))
+    rank = np.arange(len(row)) - bounds[code]
+
+    s1 = m['p1_sets'].to_numpy(dtype=float)[row]
+    s2 = m['p2_sets'].to_numpy(dtype=float)[row]
+    win = np.where(is_p1, s1 > s2, s2 > s1)  # NULL-сеты — не победа
+    night, fatigue = f['night'][row], f['fatigue'][row]
+    table_code, table_labels = pd.factorize(m['table_label'])
+    table_code = table_code[row]
+
+    def per_player(mask):
+        return np.bincount(code, weights=mask, minlength=len(names)).astype(np.int64).tolist()
+
+    total = per_player(np.ones(len(row)))
+    wins = per_player(win)
+    form = {k: (per_player(win & (rank < k)), per_player(rank < k)) for k in (5, 10)}
+    night_n, night_w = per_player(night), per_player(night & win)
+    fatigue_n, fatigue_w = per_player(fatigue), per_player(fatigue & win)
+    surrender = per_player(np.where(is_p1, f['surrender_p1'][row], f['surrender_p2'][row]))
+    comeback = per_player(f['comeback'][row])
+    at = {t: table_code == (table_labels.get_loc(t) if t in table_labels else -2) for t in TABLES}
+    tables = {t: (per_player(at[t] & win), per_player(at[t])) for t in TABLES}
+
+    # Макс. серия побед подряд (по записям игрока, новые сверху)
+    idx = np.arange(len(row))
+    last_reset = np.maximum.accumulate(np.where(~win, idx + 1, np.where(rank == 0, idx, 0)))
+    streak = np.where(win, idx - last_reset + 1, 0)
+    max_streak = np.maximum.reduceat(streak, bounds[:-1]).tolist() if len(row) else []
+
+    vol, has_vol = f['vol'][row], f['has_vol'][row]
+    passports = []
+    for i, name in enumerate(names):
+        a, b = bounds[i], bounds[i + 1]
+        v = vol[a:b][has_vol[a:b]]
+        passports.append({
+            "player_name": name,
+            "total_matches": total[i],
+            "winrate": round(wins[i]/total[i],3),
+            "form_winrate_5": round(form[5][0][i]/form[5][1][i],3),
+            "form_winrate_10": round(form[10][0][i]/form[10][1][i],3),
+            "night_winrate": round(night_w[i]/night_n[i],3) if night_n[i] else 0,
+            "fatigue_winrate": round(fatigue_w[i]/fatigue_n[i],3) if fatigue_n[i] else 0,
+            "set_surrender_rate": round(surrender[i]/total[i],3),
+            "comeback_rate": round(comeback[i]/total[i],3),
+            "volatility_index": round(np.mean(v),3) if len(v) else 0,
+            "table_winrates": {t: round(w[i]/g[i],3) if g[i] else None for t, (w, g) in tables.items()},
+            "current_streak": max_streak[i],
+            "tournament_streak": 0,
+            "finals_appear": 0,
+            "last_updated": last_updated
+        })
+    return passports
+
+# Паспорт одного игрока (CLI, passport_service.py): те же расчёты по его матчам
+
+def passport_for(conn, player_name):
+    matches, set_store = load_matches(conn, player_name)
+    found = build_passports(matches, set_store, only=player_name)
+    return found[0] if found else None
 
 def build_player_passport(player_name, db_path=DB_PATH):
     conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("""
-        SELECT match_id, finished_ts, p1_sets, p2_sets, winner_id, duration_sec, match_intensity, progress, comeback, table_label
-        FROM results NATURAL JOIN match_results
-        WHERE player1=? OR player2=?
-        ORDER BY finished_ts DESC
-    """, (player_name, player_name))
-    rows = c.fetchall()
-    if not rows:
+    try:
+        ensure_epoch_columns(conn)
+        return passport_for(conn, player_name)
+    finally:
         conn.close()
-        return None
-
-    total_matches = len(rows)
-    win_matches = 0
-    night_matches = 0
-    night_wins = 0
-    fatigue_matches = 0
-    fatigue_wins = 0
-    set_surrender = 0
-    comeback_cnt = 0
-    volatility_scores = []
-    table_wins = {t:0 for t in TABLES}
-    table_games = {t:0 for t in TABLES}
-    last10 = []
-    last5 = []
-    winseries = []
-    finals_appear = 0
-
-    for idx, (mid, ts, p1s, p2s, winner_id, duration_sec, match_intensity, progress, comeback, table) in enumerate(rows):
-        is_p1 = False
-        is_win = False
-        if c.execute("SELECT player1 FROM results WHERE match_id=?", (mid,)).fetchone()[0] == player_name:
-            is_p1 = True
-            is_win = (p1s > p2s)
-        else:
-            is_win = (p2s > p1s)
-        win_matches += is_win
-        if is_night(ts):
-            night_matches += 1
-            if is_win:
-                night_wins += 1
-        if duration_sec and (duration_sec > 1200 or (match_intensity and match_intensity > FATIGUE_THRESHOLD)):
-            fatigue_matches += 1
-            if is_win:
-                fatigue_wins += 1
-        # Set surrender
-        try:
-            c.execute("SELECT p1_pts, p2_pts FROM set_scores WHERE match_id=?", (mid,))
-            sets = c.fetchall()
-            if is_p1:
-                for s1,s2 in sets:
-                    if s1<=1 and s2>=11:
-                        set_surrender += 1
-            else:
-                for s1,s2 in sets:
-                    if s2<=1 and s1>=11:
-                        set_surrender += 1
-        except:
-            pass
-        if comeback:
-            comeback_cnt += 1
-        try:
-            diff = [abs(s1-s2) for s1,s2 in sets]
-            volatility_scores.append(np.std(diff) if diff else 0)
-        except:
-            pass
-        if table in TABLES:
-            table_games[table] += 1
-            if is_win:
-                table_wins[table] += 1
-        if idx<10:
-            last10.append(is_win)
-        if idx<5:
-            last5.append(is_win)
-        winseries.append(is_win)
-
-    current_streak = streak_calc(winseries)
-    tournament_streak = 0
-    passport = {
-        "player_name": player_name,
-        "total_matches": total_matches,
-        "winrate": round(win_matches/total_matches,3),
-        "form_winrate_5": round(sum(last5)/len(last5),3) if last5 else 0,
-        "form_winrate_10": round(sum(last10)/len(last10),3) if last10 else 0,
-        "night_winrate": round(night_wins/night_matches,3) if night_matches else 0,
-        "fatigue_winrate": round(fatigue_wins/fatigue_matches,3) if fatigue_matches else 0,
-        "set_surrender_rate": round(set_surrender/total_matches,3),
-        "comeback_rate": round(comeback_cnt/total_matches,3),
-        "volatility_index": round(np.mean(volatility_scores),3) if volatility_scores else 0,
-        "table_winrates": {k: round(table_wins[k]/table_games[k],3) if table_games[k] else None for k in TABLES},
-        "current_streak": current_streak,
-        "tournament_streak": tournament_streak,
-        "finals_appear": finals_appear,
-        "last_updated": datetime.now().isoformat(timespec='seconds')
-    }
-    conn.close()
-    return passport
 
 # Сохраняем паспорта игроков в БД
 
 def save_passports_to_db(all_passports, db_path=DB_PATH):
     ensure_passport_table(db_path)
     conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    for passport in all_passports:
-        c.execute("""
-            INSERT OR REPLACE INTO player_passports (player_name, json_blob, last_updated)
-            VALUES (?, ?, ?)
-        """, (
-            passport['player_name'],
-            json.dumps(passport, ensure_ascii=False),
-            passport['last_updated']
-        ))
+    conn.executemany("""
+        INSERT OR REPLACE INTO player_passports (player_name, json_blob, last_updated)
+        VALUES (?, ?, ?)
+    """, [(p['player_name'], json.dumps(p, ensure_ascii=False), p['last_updated']) for p in all_passports])
     conn.commit()
     conn.close()
+    count_rows_written(len(all_passports))
 
-# Экспортируем все паспорта игроков в .db
+# Экспортируем все паспорта игроков в .db: матчи и сеты читаются один раз, паспорта — одним проходом
 
 def export_all_passports_to_db(db_path=DB_PATH):
     conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    players = set()
-    c.execute("SELECT DISTINCT player1 FROM results")
-    players.update([row[0] for row in c.fetchall() if row[0]])
-    c.execute("SELECT DISTINCT player2 FROM results")
-    players.update([row[0] for row in c.fetchall() if row[0]])
-    conn.close()
+    try:
+        ensure_epoch_columns(conn)
+        players = {row[0] for row in conn.execute("SELECT player1 FROM results UNION SELECT player2 FROM results") if row[0]}
+        matches, set_store = load_matches(conn)
+    finally:
+        conn.close()
     print(f"Найдено {len(players)} уникальных игроков.")
-    all_passports = []
-    for pname in sorted(players):
-        passport = build_player_passport(pname, db_path)
-        if passport:
-            all_passports.append(passport)
-            print(f"✅ Паспорт заполнен: {pname} (матчей: {passport['total_matches']})")
-        else:
-            print(f"⛔ Нет данных: {pname}")
+    all_passports = build_passports(matches, set_store)
+    print(f"⛔ Нет данных: {len(players) - len(all_passports)} игроков")
     save_passports_to_db(all_passports, db_path)
     print(f"Всё готово! Паспортов сохранено: {len(all_passports)} в базе данных {db_path} (таблица player_passports)")
 
@@ -13,6 +13,13 @@ player_resilience_etl.py
 - медианная разница очков в проигранных матчах (median_lose_margin)
 - средняя длина comeback-серии (comeback_streak_avg)
 
+Расчёт без цикла по игрокам и матчам: long-формат «игрок — матч» читается готовым из player_matches
+(player_matches.py, строка за player1 и строка за player2), сеты — раскладка «матч × сет» из SetScoreStore
+(set_store.py), развёрнутая к точке зрения игрока; все условия — векторные маски, comeback-серии — проход
+по столбцам-сетам (не более 5), метрики игрока — groupby по игроку. Семантика прежнего цикла сохранена
+(матч «сам с собой» — одна строка за player1, матчи без сетов — первый сет не выигран, разница очков 0).
+Окно года — индексный диапазон по player_matches.finished_epoch (epoch_schema.py).
+
 Сохраняет: player_resilience (player_name, все метрики)
 
 Author: GPT-4 + Кирилл
@@ -22,117 +29,129 @@ import sqlite3
 import pandas as pd
 import numpy as np
 import os
-from datetime import datetime
-
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-results = pd.read_sql_query("SELECT * FROM results", conn)
-match_results = pd.read_sql_query("SELECT * FROM match_results", conn)
-set_scores = pd.read_sql_query("SELECT * FROM set_scores", conn)
-
-match_results = match_results.merge(
-    results[['match_id', 'player1', 'player2']],
-    on='match_id', how='left')
-match_results['finished_ts'] = pd.to_datetime(match_results['finished_ts'], errors='coerce')
-last_year = match_results[match_results['finished_ts'] >= pd.Timestamp.now() - pd.Timedelta(days=365)]
-players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
-
-rows = []
-for player in players:
-    pm = last_year[(last_year['player1'] == player) | (last_year['player2'] == player)].copy()
-    pm = pm.sort_values('finished_ts')
-    if len(pm) < 10:
-        continue
-    comebacks_1set = 0
-    comebacks_0_2 = 0
-    surrenders_0_2 = 0
-    clutch_win = 0
-    dry_win = 0
-    clutch_total = 0
-    lose_margins = []
-    pt_margins = []
-    set_margins = []
-    streak_lens = []
-    for idx, row in pm.iterrows():
-        mid = row['match_id']
-        s = set_scores[set_scores['match_id'] == mid].sort_values('set_no')
-        bo = max(row['p1_sets'], row['p2_sets'])
-        if row['player1'] == player:
-            is_win = row['p1_sets'] > row['p2_sets']
-            p_sets = s['p1_pts']
-            o_sets = s['p2_pts']
-            first_set_win = s.iloc[0]['p1_pts'] > s.iloc[0]['p2_pts'] if len(s) > 0 else False
-        else:
-            is_win = row['p2_sets'] > row['p1_sets']
-            p_sets = s['p2_pts']
-            o_sets = s['p1_pts']
-            first_set_win = s.iloc[0]['p2_pts'] > s.iloc[0]['p1_pts'] if len(s) > 0 else False
-        # dry win (3:0/2:0)
-        if is_win and (row['p1_sets'] == 3 or row['p2_sets'] == 3 or row['p1_sets'] == 2 or row['p2_sets'] == 2) and (abs(row['p1_sets'] - row['p2_sets']) == max(row['p1_sets'], row['p2_sets'])):
-            dry_win += 1
-        # comeback 1st set lose
-        if not first_set_win and is_win:
-            comebacks_1set += 1
-        # comeback 0:2 (BO5 only)
-        if bo == 3:
-            if (row['player1'] == player and row['p1_sets'] == 3 and row['p2_sets'] == 2 and list(s['p1_pts'][:2] < s['p2_pts'][:2]) == [True, True]) or \
-               (row['player2'] == player and row['p2_sets'] == 3 and row['p1_sets'] == 2 and list(s['p2_pts'][:2] < s['p1_pts'][:2]) == [True, True]):
-                comebacks_0_2 += 1
-        # surrender 0:2 (BO5 only)
-        if bo == 3:
-            if (row['player1'] == player and row['p1_sets'] == 2 and row['p2_sets'] == 3 and list(s['p1_pts'][:2] < s['p2_pts'][:2]) == [True, True]) or \
-               (row['player2'] == player and row['p2_sets'] == 2 and row['p1_sets'] == 3 and list(s['p2_pts'][:2] < s['p1_pts'][:2]) == [True, True]):
-                surrenders_0_2 += 1
-        # clutch win (выиграл решающий сет)
-        if (bo == 3 and abs(row['p1_sets'] - row['p2_sets']) == 1) or (bo == 2 and row['p1_sets'] == row['p2_sets']):
-            if is_win:
-                clutch_win += 1
-            clutch_total += 1
-        # проигрыш — margin для std/median
-        margin_pts = p_sets.sum() - o_sets.sum()
-        pt_margins.append(margin_pts)
-        set_margin = row['p1_sets']-row['p2_sets'] if row['player1'] == player else row['p2_sets']-row['p1_sets']
-        set_margins.append(set_margin)
-        if not is_win:
-            lose_margins.append(margin_pts)
-        # comeback streaks (выиграл N сетов подряд после отставания)
-        # простая реализация: макс streak после минуса
-        s_player = list(p_sets.values)
-        s_opp = list(o_sets.values)
-        d = np.array(s_player) - np.array(s_opp)
-        losing = d < 0
-        streak = 0
-        max_streak = 0
-        for i in range(1, len(d)):
-            if losing[i-1] and d[i] > 0:
-                streak = 1
-            elif streak > 0 and d[i] > 0:
-                streak += 1
-            else:
-                streak = 0
-            max_streak = max(max_streak, streak)
-        if max_streak:
-            streak_lens.append(max_streak)
-    total = len(pm)
-    resilience_row = {
-        'player_name': player,
+from db_utils import DB_PATH
+from epoch_schema import epoch_to_datetime, to_epoch
+from etl_metrics import read_sql, write_table
+from player_matches import match_view, read_player_matches, sync_player_matches
+from set_store import SetScoreStore
+
+MIN_MATCHES = 10
+PLAYER_MATCH_COLUMNS = ['match_id', 'is_p1', 'player', 'opponent', 'sets_for', 'sets_against', 'finished_epoch']
+
+
+def player_match_frame(player_matches):
+    """Строки player_matches + колонки матча (player1 / player2, p1_sets / p2_sets); is_p1 — игрок строки за player1."""
+    pm = match_view(player_matches)
+    pm['finished_ts'] = epoch_to_datetime(pm.pop('finished_epoch'))
+    return pm
+
+
+def comeback_streaks(d):
+    """
+    Макс. серия выигранных сетов сразу после проигранного, по строкам d (разница очков по сетам, NaN — сета нет).
+    Проход по столбцам-сетам вместо цикла по матчам.
+    """
+    streak = np.zeros(len(d), dtype=np.int64)
+    best = np.zeros(len(d), dtype=np.int64)
+    for i in range(1, d.shape[1]):
+        won = d[:, i] > 0
+        streak = np.where(won & (d[:, i - 1] < 0), 1, np.where(won & (streak > 0), streak + 1, 0))
+        best = np.maximum(best, streak)
+    return best
+
+
+def resilience_metrics(pm, set_store, players):
+    pm = pm.sort_values(['player', 'finished_ts', 'match_id'], kind='mergesort').reset_index(drop=True)
+    n = pm.groupby('player', sort=False)['match_id'].transform('size')
+    pm = pm[(n >= MIN_MATCHES).to_numpy()].reset_index(drop=True)
+
+    s1 = pm['p1_sets'].to_numpy(dtype=float)
+    s2 = pm['p2_sets'].to_numpy(dtype=float)
+    is_p1 = pm['is_p1'].to_numpy(dtype=bool)
+    on_p1 = (pm['player1'] == pm['player']).to_numpy()
+    on_p2 = (pm['player2'] == pm['player']).to_numpy()
+    is_win = np.where(is_p1, s1 > s2, s2 > s1)
+    bo = np.maximum(s1, s2)  # при NaN-сетах ни одно из условий ниже не выполняется, как и в цикле
+
+    # Сеты «матч × сет» с точки зрения игрока строки
+    p1_pts, p2_pts, _ = set_store.padded(pm['match_id'], width=max(2, int(set_store.n_sets.max(initial=0))))
+    own = np.where(is_p1[:, None], p1_pts, p2_pts)
+    opp = np.where(is_p1[:, None], p2_pts, p1_pts)
+    first_set_win = own[:, 0] > opp[:, 0]  # нет сетов -> NaN -> False
+    p1_lost_first2 = (p1_pts[:, 0] < p2_pts[:, 0]) & (p1_pts[:, 1] < p2_pts[:, 1])
+    p2_lost_first2 = (p2_pts[:, 0] < p1_pts[:, 0]) & (p2_pts[:, 1] < p1_pts[:, 1])
+
+    dry_win = is_win & ((s1 == 3) | (s2 == 3) | (s1 == 2) | (s2 == 2)) & (np.abs(s1 - s2) == bo)
+    comeback_0_2 = (bo == 3) & ((on_p1 & (s1 == 3) & (s2 == 2) & p1_lost_first2) |
+                                (on_p2 & (s2 == 3) & (s1 == 2) & p2_lost_first2))
+    surrender_0_2 = (bo == 3) & ((on_p1 & (s1 == 2) & (s2 == 3) & p1_lost_first2) |
+                                 (on_p2 & (s2 == 2) & (s1 == 3) & p2_lost_first2))
+    clutch = ((bo == 3) & (np.abs(s1 - s2) == 1)) | ((bo == 2) & (s1 == s2))
+
+    p1_tot, p2_tot, _ = set_store.totals(pm['match_id'])
+    pt_margin = np.where(is_p1, p1_tot - p2_tot, p2_tot - p1_tot)
+    set_margin = np.where(is_p1, s1 - s2, s2 - s1)
+    streak = comeback_streaks(own - opp)
+
+    frame = pd.DataFrame({
+        'player': pm['player'],
+        'comeback_1set': (~first_set_win & is_win).astype(int),
+        'comeback_0_2': comeback_0_2.astype(int),
+        'surrender_0_2': surrender_0_2.astype(int),
+        'clutch_win': (clutch & is_win).astype(int),
+        'clutch_total': clutch.astype(int),
+        'dry_win': dry_win.astype(int),
+        'pt_margin': pt_margin,
+        'set_margin': set_margin,
+        'set_margin_nan': np.isnan(set_margin).astype(int),
+        'lose_margin': np.where(is_win, np.nan, pt_margin),
+        'streak': np.where(streak > 0, streak, np.nan),
+    })
+    # np.std по всем матчам игрока (ddof=0): среднее по группе, затем средний квадрат отклонения
+    g = frame.groupby('player', sort=False)
+    for col in ['pt_margin', 'set_margin']:
+        frame[f'{col}_sq'] = (frame[col] - g[col].transform('mean')) ** 2
+    g = frame.groupby('player', sort=False)
+    agg = g.agg(
+        matches_played=('player', 'size'), comeback_1set=('comeback_1set', 'sum'), comeback_0_2=('comeback_0_2', 'sum'),
+        surrender_0_2=('surrender_0_2', 'sum'), clutch_win=('clutch_win', 'sum'), clutch_total=('clutch_total', 'sum'),
+        dry_win=('dry_win', 'sum'), pt_margin_sq=('pt_margin_sq', 'mean'), set_margin_sq=('set_margin_sq', 'mean'),
+        set_margin_nan=('set_margin_nan', 'sum'), median_lose_margin=('lose_margin', 'median'),
+        comeback_streak_avg=('streak', 'mean'))
+
+    present = set(agg.index)
+    agg = agg.reindex([p for p in players if p in present])
+    total = agg['matches_played'].to_numpy()
+    clutch_total = agg['clutch_total'].to_numpy()
+    return pd.DataFrame({
+        'player_name': agg.index,
         'matches_played': total,
-        'comeback_1set_win': comebacks_1set / total,
-        'comeback_0_2_win': comebacks_0_2 / total,
-        'surrender_0_2_lose': surrenders_0_2 / total,
-        'clutch_win': clutch_win / clutch_total if clutch_total else np.nan,
-        'dry_win': dry_win / total,
-        'volatility_pts': np.std(pt_margins),
-        'volatility_sets': np.std(set_margins),
-        'median_lose_margin': np.median(lose_margins) if lose_margins else np.nan,
-        'comeback_streak_avg': np.mean(streak_lens) if streak_lens else np.nan,
-    }
-    rows.append(resilience_row)
-
-df = pd.DataFrame(rows)
-df.to_sql('player_resilience', conn, if_exists='replace', index=False)
-print(f'Таблица player_resilience обновлена: {len(df)} игроков')
-conn.close()
+        'comeback_1set_win': agg['comeback_1set'].to_numpy() / total,
+        'comeback_0_2_win': agg['comeback_0_2'].to_numpy() / total,
+        'surrender_0_2_lose': agg['surrender_0_2'].to_numpy() / total,
+        'clutch_win': np.where(clutch_total > 0, agg['clutch_win'].to_numpy() / np.maximum(clutch_total, 1), np.nan),
+        'dry_win': agg['dry_win'].to_numpy() / total,
+        'volatility_pts': np.sqrt(agg['pt_margin_sq'].to_numpy()),
+        # NaN в сетах матча -> np.std по игроку тоже NaN
+        'volatility_sets': np.where(agg['set_margin_nan'].to_numpy() > 0, np.nan, np.sqrt(agg['set_margin_sq'].to_numpy())),
+        'median_lose_margin': agg['median_lose_margin'].to_numpy(),
+        'comeback_streak_avg': agg['comeback_streak_avg'].to_numpy(),
+    })
+
+
+if __name__ == '__main__':
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+
+    conn = sqlite3.connect(DB_PATH)
+    results = read_sql("SELECT player1, player2 FROM results", conn)
+    sync_player_matches(conn, ())  # дозаполнение матчей, ещё не прошедших нормализацию
+    last_year = read_player_matches(conn, PLAYER_MATCH_COLUMNS, since=to_epoch(pd.Timestamp.now() - pd.Timedelta(days=365)),
+                                    read=read_sql)
+    set_store = SetScoreStore.from_db(conn, read=read_sql)
+    players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
+
+    df = resilience_metrics(player_match_frame(last_year), set_store, players)
+    write_table(df, 'player_resilience', conn)
+    print(f'Таблица player_resilience обновлена: {len(df)} игроков')
+    conn.close()
@@ -7,82 +7,219 @@ ETL для расчета Strength of Schedule (SoS) по разным окна
 
 cf_flag: ✅ если >=5 матчей в окне, ⚠️ если 1-4, ⛔ если 0 (NULL)
 
+Рейтинг соперника — на момент матча через rating_index.py (glicko2_snapshot или player_elo_history).
+
+Расчёт без цикла по игрокам:
+- long-формат «игрок — матч» — готовые строки player_matches (player_matches.py: за player1 и за player2,
+  матч «сам с собой» — одна строка)
+- рейтинг соперника — один векторный as-of запрос ratings_at по всем строкам
+- окна по матчам — номер матча с конца внутри игрока (cumcount) + groupby sum/count,
+  окна по дням — маска по finished_ts + groupby
+- время матчей — finished_epoch (epoch_schema.py): новые строки player_matches после watermark и отпечаток
+  по match_results — индексные диапазоны по целым секундам
+
+Инкрементальный режим (по умолчанию):
+- состояние окон игроков — sos_state.py (кольцевые буферы и бегущие суммы в player_sos_state),
+  watermark (finished_ts последнего учтённого матча) — в etl_state
+- новые матчи добавляются в буферы за O(1), окна по дням истекают лениво относительно текущего времени
+- в player_sos_windows перезаписываются только игроки, у которых окна изменились
+- Полный пересчёт (векторный, как выше): --full, смена источника рейтингов, поздние/исправленные матчи
+  или пересчитанные рейтинги до watermark (по отпечатку матчей и рейтингов)
+
 Результат: таблица player_sos_windows в betcity_results.db
 
 Author: GPT-4 + Кирилл
 """
 
+import argparse
+import json
 import sqlite3
 import pandas as pd
 import numpy as np
 import os
+from db_utils import DB_PATH, get_watermark, set_watermark
+from epoch_schema import ensure_epoch_columns, epoch_to_datetime, to_epoch
+from etl_metrics import acquire_write_lock, count_rows_written, read_sql, write_table
+from player_matches import read_player_matches, sync_player_matches
+from rating_index import load_rating_index, table_exists, to_epoch_seconds
+from sos_state import DAY_WINDOWS, MATCH_WINDOWS, STATE_TABLE, SoSStateStore, ensure_state_table, output_columns
+
+ETL_NAME = 'player_sos_windows'
+META_NAME = 'player_sos_windows_meta'  # источник рейтингов и отпечаток данных до watermark (JSON в etl_state)
+
+
+def cf_flag(count):
+    return np.where(count >= 5, '✅', np.where(count > 0, '⚠️', '⛔'))
+
+
+PLAYER_MATCH_COLUMNS = ['match_id', 'player', 'opponent', 'finished_epoch']
+
 
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-results = pd.read_sql_query("SELECT * FROM results", conn)
-match_results = pd.read_sql_query("SELECT * FROM match_results", conn)
-try:
-    glicko2_snap = pd.read_sql_query("SELECT * FROM glicko2_snapshot", conn)
-except Exception:
-    print("glicko2_snapshot не найден — используем elo_final как proxy.")
-    glicko2_snap = pd.read_sql_query("SELECT player_name, elo_final as rating, last_match_ts as snap_ts FROM player_elo", conn)
-
-# Универсальный привод к datetime
-for col in ['finished_ts', 'snap_ts', 'last_match_ts']:
-    for df in [match_results, results, glicko2_snap]:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce')
-
-match_results = match_results.merge(
-    results[['match_id', 'player1', 'player2']],
-    on='match_id', how='left')
-players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
-
-rows = []
-for player in players:
-    pm = match_results[(match_results['player1'] == player) | (match_results['player2'] == player)].copy()
-    pm = pm.sort_values('finished_ts')
-    if len(pm) == 0:
-        continue
-    pm['opponent'] = pm.apply(lambda row: row['player2'] if row['player1'] == player else row['player1'], axis=1)
-    # Для каждого матча — рейтинг соперника на этот день
-    def get_opp_rating(opp_name, snap_ts):
-        subset = glicko2_snap[glicko2_snap['player_name'] == opp_name]
-        subset = subset.dropna(subset=['snap_ts', 'rating'])
-        subset = subset[subset['snap_ts'] <= snap_ts]
-        if len(subset) == 0:
-            subset = glicko2_snap[glicko2_snap['player_name'] == opp_name]
-        if len(subset) == 0:
-            return np.nan
-        return subset.sort_values('snap_ts').iloc[-1]['rating']
-    pm['opp_rating'] = pm.apply(lambda row: get_opp_rating(row['opponent'], row['finished_ts']), axis=1)
+def player_match_frame(player_matches):
+    """Строки player_matches: (match_id, player, opponent, finished_ts)."""
+    pm = player_matches.copy()
+    pm['finished_ts'] = epoch_to_datetime(pm.pop('finished_epoch'))
+    return pm
+
+
+def sos_windows(pm, players, now):
+    """
+    Окна SoS по всем игрокам сразу; порядок строк — как в players (только игроки с матчами).
+    pm на выходе — строки с рейтингом, отсортированные по игроку и времени (для SoSStateStore.from_frame).
+    """
+    seen = set(pm['player'])
+    present = [p for p in players if p in seen]
     pm = pm.dropna(subset=['opp_rating'])
-    # Окна по матчам
-    def sos_last_nm(n):
-        vals = pm['opp_rating'].tail(n)
-        cf = '✅' if len(vals) >= 5 else ('⚠️' if len(vals) > 0 else '⛔')
-        return (vals.mean() if len(vals) > 0 else np.nan, cf)
-    # Окна по дням
-    now = pd.Timestamp.now()
-    def sos_last_nd(days):
-        vals = pm[pm['finished_ts'] >= now - pd.Timedelta(days=days)]['opp_rating']
-        cf = '✅' if len(vals) >= 5 else ('⚠️' if len(vals) > 0 else '⛔')
-        return (vals.mean() if len(vals) > 0 else np.nan, cf)
-    row = {'player_name': player}
-    for n in [5, 10, 30]:
-        mean, cf = sos_last_nm(n)
-        row[f'sos_last_{n}m'] = mean
-        row[f'sos_last_{n}m_cf'] = cf
-    for d in [2, 7, 30]:
-        mean, cf = sos_last_nd(d)
-        row[f'sos_last_{d}d'] = mean
-        row[f'sos_last_{d}d_cf'] = cf
-    rows.append(row)
-
-df_sos = pd.DataFrame(rows)
-df_sos.to_sql('player_sos_windows', conn, if_exists='replace', index=False)
-print(f'Таблица player_sos_windows обновлена: {len(df_sos)} игроков')
-conn.close()
+    pm = pm.sort_values(['player', 'finished_ts', 'match_id'], kind='mergesort')
+    g = pm.groupby('player', sort=False)
+    from_end = g.cumcount(ascending=False).to_numpy()
+
+    out = pd.DataFrame({'player_name': present})
+    masks = [(f'sos_last_{n}m', from_end < n) for n in MATCH_WINDOWS]
+    masks += [(f'sos_last_{d}d', (pm['finished_ts'] >= now - pd.Timedelta(days=d)).to_numpy()) for d in DAY_WINDOWS]
+    for col, mask in masks:
+        sel = pm[mask].groupby('player')['opp_rating'].agg(['sum', 'count'])
+        sel = sel.reindex(present)
+        count = sel['count'].fillna(0).to_numpy()
+        out[col] = np.where(count > 0, sel['sum'].to_numpy() / np.maximum(count, 1), np.nan)
+        out[f'{col}_cf'] = cf_flag(count)
+    return out, pm
+
+
+def rating_source(conn):
+    return 'glicko2' if table_exists(conn, 'glicko2_snapshot') else 'elo'
+
+
+def fingerprint(conn, watermark, source):
+    """Отпечаток матчей и рейтингов до watermark: меняется при поздних матчах или пересчёте рейтингов."""
+    matches = conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(mr.match_id), 0)
+        FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch <= ?
+    """, (to_epoch(watermark),)).fetchone()
+    if source == 'glicko2':
+        ratings = conn.execute(
+            "SELECT COUNT(*), ROUND(COALESCE(SUM(rating), 0), 6) FROM glicko2_snapshot WHERE snap_ts <= ?",
+            (watermark,)).fetchone()
+    else:
+        ratings = conn.execute(
+            "SELECT COUNT(*), ROUND(COALESCE(SUM(elo_after), 0), 6) FROM player_elo_history WHERE date <= ?",
+            (watermark,)).fetchone()
+    return list(matches) + list(ratings)
+
+
+def save_meta(conn, watermark, source):
+    set_watermark(conn, ETL_NAME, watermark)
+    set_watermark(conn, META_NAME, json.dumps({'source': source, 'fingerprint': fingerprint(conn, watermark, source)}))
+
+
+def now_seconds(now):
+    return now.value / 10**9
+
+
+def run_full(conn, rating_index, source, now):
+    set_watermark(conn, ETL_NAME, None)
+    conn.commit()
+    results = read_sql("SELECT player1, player2 FROM results", conn)
+    players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
+
+    pm = player_match_frame(read_player_matches(conn, PLAYER_MATCH_COLUMNS, read=read_sql))
+    # Для каждого матча — рейтинг соперника на момент матча (as-of, без заглядывания в будущее)
+    pm['opp_rating'] = rating_index.ratings_at(pm['opponent'], pm['finished_ts'])
+    df_sos, rated = sos_windows(pm, players, now)
+    rated = rated.assign(ts=to_epoch_seconds(rated['finished_ts'])[0])
+    # Игроки без единого матча с рейтингом тоже в состоянии — с пустыми окнами (строка ⛔)
+    store = SoSStateStore.from_frame(rated, now_seconds(now), players=df_sos['player_name'])
+
+    write_table(df_sos, 'player_sos_windows', conn)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_player_sos_windows_player ON player_sos_windows(player_name)")
+    ensure_state_table(conn)
+    acquire_write_lock(conn)
+    try:
+        conn.execute(f"DELETE FROM {STATE_TABLE}")
+        store.save(conn)
+        last = epoch_to_datetime([conn.execute("SELECT MAX(finished_epoch) FROM match_results").fetchone()[0]])[0]
+        if pd.notna(last):
+            save_meta(conn, last.strftime('%Y-%m-%d %H:%M:%S'), source)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(store))
+    print(f'Таблица player_sos_windows обновлена: {len(df_sos)} игроков')
+
+
+def run_incremental(conn, rating_index, source, now, watermark):
+    # Строки игроков в хронологическом порядке: в матче сначала player1, затем player2
+    new = player_match_frame(read_player_matches(conn, PLAYER_MATCH_COLUMNS, after=to_epoch(watermark),
+                                                 order='finished_epoch, match_id, is_p1 DESC', read=read_sql))
+    store = SoSStateStore.load(conn)
+
+    n = new['match_id'].nunique()
+    player = new['player'].to_numpy(dtype=object)
+    opponent = new['opponent'].to_numpy(dtype=object)
+    ts = new['finished_ts'].to_numpy()
+    ratings = rating_index.ratings_at(opponent, ts)
+    touched = store.apply(player, to_epoch_seconds(ts)[0], ratings)
+    changed = touched | store.expire(now_seconds(now))
+    names = sorted(changed)
+    df_sos = store.frame(names)
+
+    acquire_write_lock(conn)
+    try:
+        cols = output_columns()
+        conn.executemany(
+            f"INSERT OR REPLACE INTO player_sos_windows ({','.join(cols)}) VALUES ({','.join('?' * len(cols))})",
+            df_sos.astype(object).where(df_sos.notna(), None).itertuples(index=False, name=None))
+        store.save(conn, names)
+        if n:
+            save_meta(conn, new['finished_ts'].iloc[-1].strftime('%Y-%m-%d %H:%M:%S'), source)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(2 * len(names))
+    print(f'player_sos_windows: +{n} матчей, обновлено {len(names)} игроков')
+
+
+def rebuild_reason(conn, watermark, source):
+    """Почему нужен полный пересчёт; None — можно инкрементально."""
+    if watermark is None or not table_exists(conn, STATE_TABLE) or not table_exists(conn, 'player_sos_windows'):
+        return 'нет сохранённого состояния'
+    meta = json.loads(get_watermark(conn, META_NAME) or 'null')
+    if meta is None or meta.get('source') != source:
+        return f'сменился источник рейтингов ({source})'
+    if meta.get('fingerprint') != fingerprint(conn, watermark, source):
+        return f'поздние/исправленные матчи или пересчитанные рейтинги до {watermark}'
+    return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Strength of Schedule по окнам матчей и дней')
+    ap.add_argument('--full', action='store_true', help='Полный пересчёт всех игроков')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        ensure_epoch_columns(conn)
+        sync_player_matches(conn, ())  # дозаполнение матчей, ещё не прошедших нормализацию
+        source = rating_source(conn)
+        if source == 'elo':
+            print("glicko2_snapshot не найден — используем player_elo_history (рейтинг до матча).")
+        rating_index = load_rating_index(conn, read=read_sql)
+        now = pd.Timestamp.now()
+        watermark = get_watermark(conn, ETL_NAME)
+        reason = '--full' if args.full else rebuild_reason(conn, watermark, source)
+        if reason:
+            print(f'player_sos_windows: {reason} — полный пересчёт')
+            run_full(conn, rating_index, source, now)
+        else:
+            run_incremental(conn, rating_index, source, now, watermark)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
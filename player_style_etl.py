@@ -17,95 +17,373 @@ player_style_etl.py
 - Присваиваем лейблы кластерам по средним значениям (ручная маркировка)
 - Сохраняем в таблицу player_style (player_name, style, все средние метрики)
 
+Модель сохраняется в player_style_model (параметры StandardScaler, центроиды, стиль каждого кластера):
+- Инкрементальный запуск (по умолчанию): фичи пересчитываются у игроков с новыми матчами
+  (после watermark в etl_state) и у игроков, чьи матчи выпали из 365-дневного окна с прошлого запуска
+  (начало окна — тоже в etl_state); стиль — ближайший сохранённый центроид, player_style обновляется построчно:
+  игрок с < MIN_MATCHES матчей в окне удаляется, с пропусками в фичах — остаётся без стиля, как при переобучении
+- Поздние/исправленные/удалённые матчи до watermark — по отпечатку окна (etl_state): при расхождении
+  предсказание по сохранённой модели пересчитывается у всех игроков окна и таблицы player_style
+- Полное переобучение: нет модели, --refit, модель старше REFIT_DAYS дней или дрейф
+  (средний квадрат расстояния обновлённых игроков до центроидов > DRIFT_RATIO x того, что был при обучении)
+- При переобучении KMeans стартует с прежних центроидов (warm start), поэтому кластер i остаётся
+  тем же стилем и метки не перескакивают между запусками; первое обучение — как раньше (seed=42,
+  маркировка по среднему тоталу)
+- Фичи — один векторный проход (две строки на матч + groupby), итоги очков по сетам — SetScoreStore
+- Игроки с пропусками в фичах (NULL длительности) в модель не идут и не получают стиль
+
 Author: GPT-4 + Кирилл
 """
 
+import argparse
+import json
 import sqlite3
 import pandas as pd
 import numpy as np
 import os
-from datetime import datetime
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
+from db_utils import DB_PATH, get_watermark, set_watermark
+from epoch_schema import ensure_epoch_columns, epoch_to_datetime, to_epoch
+from etl_metrics import acquire_write_lock, count_rows_written, read_sql, write_table
+from rating_index import table_exists
+from set_store import SetScoreStore
 
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-results = pd.read_sql_query("SELECT * FROM results", conn)
-match_results = pd.read_sql_query("SELECT * FROM match_results", conn)
-set_scores = pd.read_sql_query("SELECT * FROM set_scores", conn)
-
-match_results = match_results.merge(
-    results[['match_id', 'player1', 'player2']],
-    on='match_id', how='left')
-match_results['finished_ts'] = pd.to_datetime(match_results['finished_ts'], errors='coerce')
-last_year = match_results[match_results['finished_ts'] >= pd.Timestamp.now() - pd.Timedelta(days=365)]
-players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
-
-rows = []
-for player in players:
-    pm = last_year[(last_year['player1'] == player) | (last_year['player2'] == player)].copy()
-    pm = pm.sort_values('finished_ts')
-    if len(pm) < 10:
-        continue
-    # Средний тотал очков
-    total_pts = []
-    pt_margin = []
-    set_margin = []
-    durations = []
-    for idx, row in pm.iterrows():
-        mid = row['match_id']
-        s = set_scores[set_scores['match_id'] == mid]
-        if row['player1'] == player:
-            ppts, opts = s['p1_pts'].sum(), s['p2_pts'].sum()
-            setm = row['p1_sets'] - row['p2_sets']
-        else:
-            ppts, opts = s['p2_pts'].sum(), s['p1_pts'].sum()
-            setm = row['p2_sets'] - row['p1_sets']
-        total = ppts + opts
-        total_pts.append(total)
-        pt_margin.append(ppts - opts)
-        set_margin.append(setm)
-        durations.append(row['duration_sec'] if row['duration_sec'] else 930)
-    rows.append({
-        'player_name': player,
-        'matches_played': len(pm),
-        'avg_total_pts': np.mean(total_pts),
-        'avg_duration_sec': np.mean(durations),
-        'avg_pt_margin': np.mean(pt_margin),
-        'avg_set_margin': np.mean(set_margin),
+ETL_NAME = 'player_style'
+WINDOW_NAME = 'player_style_window'  # начало окна прошлого запуска (etl_state)
+META_NAME = 'player_style_meta'  # отпечаток матчей окна до watermark (JSON в etl_state)
+MODEL_TABLE = 'player_style_model'
+FEATURES = ['avg_total_pts', 'avg_duration_sec', 'avg_pt_margin', 'avg_set_margin']
+OUTPUT_COLUMNS = ['player_name', 'matches_played'] + FEATURES + ['style']
+N_CLUSTERS = 4
+MIN_MATCHES = 10
+DEFAULT_DURATION_SEC = 930
+WINDOW_DAYS = 365
+REFIT_DAYS = 7
+DRIFT_RATIO = 1.5
+DRIFT_MIN_PLAYERS = 20
+
+
+# --- Фичи ---
+
+def load_window(conn, start):
+    """Матчи окна (с именами игроков) и сеты только этих матчей; окно — индекс по finished_epoch."""
+    start = to_epoch(start)
+    matches = read_sql("""
+        SELECT mr.match_id, mr.finished_epoch, mr.p1_sets, mr.p2_sets, mr.duration_sec, r.player1, r.player2
+        FROM match_results mr LEFT JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch >= ?
+        ORDER BY mr.match_id
+    """, conn, params=(start,))
+    matches.insert(1, 'finished_ts', epoch_to_datetime(matches.pop('finished_epoch')))
+    set_scores = read_sql("""
+        SELECT s.match_id, s.set_no, s.p1_pts, s.p2_pts
+        FROM set_scores s JOIN match_results mr ON mr.match_id = s.match_id
+        WHERE mr.finished_epoch >= ?
+        ORDER BY s.match_id, s.set_no
+    """, conn, params=(start,))
+    return matches, SetScoreStore.from_frame(set_scores)
+
+
+def player_match_frame(matches):
+    """Две строки на матч (за player1 и за player2); матч «сам с собой» — одна строка за player1."""
+    mr = matches.reset_index(drop=True)
+    mr['row'] = np.arange(len(mr))
+    self_match = (mr['player1'] == mr['player2']).to_numpy()
+    side1 = mr.assign(player=mr['player1'], is_p1=True)
+    side2 = mr.assign(player=mr['player2'], is_p1=False)[~self_match]
+    pm = pd.concat([side1, side2], ignore_index=True)
+    return pm[pm['player'].notna()]
+
+
+def style_features(pm, set_store, players):
+    """Средние по матчам игрока (>= MIN_MATCHES); порядок строк — как в players."""
+    pm = pm.sort_values(['player', 'finished_ts', 'row'], kind='mergesort')
+    is_p1 = pm['is_p1'].to_numpy(dtype=bool)
+    p1_tot, p2_tot, _ = set_store.totals(pm['match_id'])
+    s1 = pm['p1_sets'].to_numpy(dtype=float)
+    s2 = pm['p2_sets'].to_numpy(dtype=float)
+    dur = pm['duration_sec'].astype(float)
+    frame = pd.DataFrame({
+        'player': pm['player'].to_numpy(),
+        'total_pts': p1_tot + p2_tot,
+        # 0 -> 930 с, как `duration_sec if duration_sec else 930` (NULL остаётся NULL)
+        'duration': dur.where(dur != 0, DEFAULT_DURATION_SEC).to_numpy(),
+        'pt_margin': np.where(is_p1, p1_tot - p2_tot, p2_tot - p1_tot),
+        'set_margin': np.where(is_p1, s1 - s2, s2 - s1),
     })
+    # np.mean в цикле не пропускал NaN
+    agg = frame.groupby('player', sort=False).agg(
+        matches_played=('player', 'size'),
+        avg_total_pts=('total_pts', 'mean'),
+        avg_duration_sec=('duration', lambda x: x.mean(skipna=False)),
+        avg_pt_margin=('pt_margin', 'mean'),
+        avg_set_margin=('set_margin', lambda x: x.mean(skipna=False)),
+    )
+    agg = agg[agg['matches_played'] >= MIN_MATCHES]
+    present = set(agg.index)
+    agg = agg.reindex([p for p in players if p in present])
+    return agg.rename_axis('player_name').reset_index()
+
+
+# --- Модель ---
+
+def styles_by_total(centers):
+    """Маркировка кластеров по среднему тоталу центроида: defensive < balanced < chaotic < aggressive."""
+    names = ['defensive', 'balanced', 'chaotic', 'aggressive']
+    styles = [None] * len(centers)
+    for i, c in enumerate(np.argsort(centers[:, 0])):
+        styles[c] = names[i]
+    return styles
+
+
+class StyleModel:
+    """Сохранённые StandardScaler (mean, scale) и центроиды в нормированном пространстве; styles[i] — стиль кластера i."""
+
+    def __init__(self, mean, scale, centers, styles, inertia, fitted_at, n_players):
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.centers = np.asarray(centers, dtype=float)
+        self.styles = list(styles)
+        self.inertia = float(inertia)  # средний квадрат расстояния до центроида при обучении
+        self.fitted_at = fitted_at
+        self.n_players = n_players
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=float) - self.mean) / self.scale
+
+    def predict(self, X):
+        """Ближайший центроид и квадрат расстояния до него."""
+        d2 = ((self.transform(X)[:, None, :] - self.centers[None, :, :]) ** 2).sum(axis=2)
+        labels = d2.argmin(axis=1)
+        return labels, d2[np.arange(len(labels)), labels]
+
+    def raw_centers(self):
+        return self.centers * self.scale + self.mean
+
+    @classmethod
+    def fit(cls, X, fitted_at, prev=None):
+        """
+        Обучение на всех игроках. prev — прежняя модель: её центроиды (в новом масштабе) — стартовые,
+        стили кластеров наследуются. Возвращает (модель, метки).
+        """
+        scaler = StandardScaler()
+        Xs = scaler.fit_transform(X)
+        if prev is None:
+            kmeans = KMeans(n_clusters=N_CLUSTERS, random_state=42)
+            labels = kmeans.fit_predict(Xs)
+            styles = styles_by_total(kmeans.cluster_centers_)
+        else:
+            init = (prev.raw_centers() - scaler.mean_) / scaler.scale_
+            kmeans = KMeans(n_clusters=N_CLUSTERS, init=init, n_init=1, random_state=42)
+            labels = kmeans.fit_predict(Xs)
+            styles = prev.styles
+        model = cls(scaler.mean_, scaler.scale_, kmeans.cluster_centers_, styles,
+                    kmeans.inertia_ / len(Xs), fitted_at, len(Xs))
+        return model, labels
+
+    @classmethod
+    def load(cls, conn):
+        if not table_exists(conn, MODEL_TABLE):
+            return None
+        row = conn.execute(f"""
+            SELECT mean, scale, centers, styles, inertia, fitted_at, n_players
+            FROM {MODEL_TABLE} ORDER BY model_id DESC LIMIT 1
+        """).fetchone()
+        if row is None:
+            return None
+        mean, scale, centers, styles, inertia, fitted_at, n_players = row
+        return cls(json.loads(mean), json.loads(scale), json.loads(centers), json.loads(styles),
+                   inertia, fitted_at, n_players)
+
+    def save(self, conn):
+        """Дописывает модель в player_style_model (история обучений). Не коммитит."""
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {MODEL_TABLE} (
+                model_id  INTEGER PRIMARY KEY AUTOINCREMENT,
+                fitted_at TEXT,
+                n_players INTEGER,
+                features  TEXT,
+                mean      TEXT,
+                scale     TEXT,
+                centers   TEXT,
+                styles    TEXT,
+                inertia   REAL
+            )
+        """)
+        conn.execute(f"""
+            INSERT INTO {MODEL_TABLE} (fitted_at, n_players, features, mean, scale, centers, styles, inertia)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (self.fitted_at, self.n_players, json.dumps(FEATURES), json.dumps(self.mean.tolist()),
+              json.dumps(self.scale.tolist()), json.dumps(self.centers.tolist()), json.dumps(self.styles),
+              self.inertia))
+
+
+# --- Запуск ---
+
+def finite_rows(df):
+    return np.isfinite(df[FEATURES].to_numpy(dtype=float)).all(axis=1)
+
+
+def window_players(conn, a, b):
+    """Игроки матчей с временем между a и b (в любом порядке границ): полуинтервал [min, max)."""
+    lo, hi = sorted([to_epoch(a), to_epoch(b)])
+    rows = conn.execute("""
+        SELECT r.player1, r.player2
+        FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch >= ? AND mr.finished_epoch < ?
+    """, (lo, hi)).fetchall()
+    return {p for row in rows for p in row if p is not None}
+
+
+def fingerprint(conn, start, end):
+    """Отпечаток матчей окна [start, end] с длительностью и очками по сетам: меняется при позднем/исправленном/удалённом матче."""
+    params = (to_epoch(start), to_epoch(end))
+    matches = conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(mr.match_id), 0),
+               COALESCE(SUM(COALESCE(mr.p1_sets, 0) - COALESCE(mr.p2_sets, 0)), 0),
+               COALESCE(SUM(COALESCE(mr.p1_sets, 0)), 0), COALESCE(SUM(mr.duration_sec), 0)
+        FROM match_results mr JOIN results r ON r.match_id = mr.match_id
+        WHERE mr.finished_epoch >= ? AND mr.finished_epoch <= ?
+    """, params).fetchone()
+    sets = conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(s.p1_pts), 0), COALESCE(SUM(s.p2_pts), 0)
+        FROM set_scores s JOIN match_results mr ON mr.match_id = s.match_id
+        WHERE mr.finished_epoch >= ? AND mr.finished_epoch <= ?
+    """, params).fetchone()
+    return list(matches) + list(sets)
+
+
+def save_state(conn, watermark, start):
+    """Watermark, начало окна и отпечаток окна до watermark. Не коммитит."""
+    set_watermark(conn, ETL_NAME, watermark)
+    set_watermark(conn, WINDOW_NAME, str(start))
+    set_watermark(conn, META_NAME, json.dumps({'fingerprint': fingerprint(conn, start, watermark)}))
+
+
+def late_matches(conn, watermark, old_start):
+    """True, если матчи окна прошлого запуска (old_start .. watermark) изменились с тех пор."""
+    meta = json.loads(get_watermark(conn, META_NAME) or 'null')
+    return meta is None or meta.get('fingerprint') != fingerprint(conn, old_start, watermark)
+
+
+def run_refit(conn, matches, set_store, players, prev, now, start):
+    set_watermark(conn, ETL_NAME, None)
+    conn.commit()
+    df = style_features(player_match_frame(matches), set_store, players)
+    ok = finite_rows(df)
+    if ok.sum() < N_CLUSTERS:
+        print(f'player_style: игроков с полными фичами {ok.sum()} < {N_CLUSTERS} — модель не обучена, таблица не изменена')
+        return
+    model, labels = StyleModel.fit(df.loc[ok, FEATURES].to_numpy(dtype=float), now.strftime('%Y-%m-%d %H:%M:%S'), prev)
+    df['style'] = None
+    df.loc[ok, 'style'] = [model.styles[c] for c in labels]
+
+    # Выводим топ-3 по каждому стилю
+    for st in df['style'].dropna().unique():
+        print(f"Топ-3 {st}: ", df[df['style']==st].sort_values('avg_total_pts', ascending=(st=='defensive')).head(3)[['player_name','avg_total_pts']].values)
+
+    df_style = df[OUTPUT_COLUMNS]
+    write_table(df_style, 'player_style', conn)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_player_style_player ON player_style(player_name)")
+    acquire_write_lock(conn)
+    try:
+        model.save(conn)
+        last = matches['finished_ts'].max()
+        if pd.notna(last):
+            save_state(conn, last.strftime('%Y-%m-%d %H:%M:%S'), start)
+        else:
+            set_watermark(conn, WINDOW_NAME, str(start))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print(f'Таблица player_style обновлена: {len(df_style)} игроков')
+
+
+def run_incremental(conn, matches, set_store, model, watermark, start, old_start, recheck=False):
+    """
+    Фичи и стиль игроков с матчами после watermark и игроков, чьи матчи выпали из окна (old_start -> start);
+    recheck (поздние/исправленные матчи до watermark) — всех игроков окна и player_style.
+    Игроки без MIN_MATCHES в окне удаляются из player_style. None — обнаружен дрейф.
+    """
+    new = matches[matches['finished_ts'] > pd.Timestamp(watermark)]
+    expired = window_players(conn, old_start, start)
+    touched = set(new['player1'].dropna()) | set(new['player2'].dropna()) | expired
+    if recheck:
+        stored = conn.execute("SELECT player_name FROM player_style WHERE player_name IS NOT NULL").fetchall()
+        touched |= set(matches['player1'].dropna()) | set(matches['player2'].dropna()) | {p for p, in stored}
+    pm = player_match_frame(matches)
+    pm = pm[pm['player'].isin(touched)]
+    df = style_features(pm, set_store, sorted(touched))
+    ok = finite_rows(df)
+    labels, d2 = model.predict(df.loc[ok, FEATURES].to_numpy(dtype=float))
+    if ok.sum() >= DRIFT_MIN_PLAYERS and d2.mean() > DRIFT_RATIO * model.inertia:
+        print(f'player_style: дрейф — средний квадрат расстояния {d2.mean():.3f} против {model.inertia:.3f} при обучении')
+        return None
+    # Как в run_refit: игрок с пропусками в фичах остаётся в таблице без стиля
+    df['style'] = None
+    df.loc[ok, 'style'] = [model.styles[c] for c in labels]
+    gone = sorted(touched - set(df['player_name']))
+
+    acquire_write_lock(conn)
+    try:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO player_style ({','.join(OUTPUT_COLUMNS)}) VALUES ({','.join('?' * len(OUTPUT_COLUMNS))})",
+            df[OUTPUT_COLUMNS].astype(object).where(df[OUTPUT_COLUMNS].notna(), None).itertuples(index=False, name=None))
+        conn.executemany("DELETE FROM player_style WHERE player_name = ?", [(p,) for p in gone])
+        save_state(conn, new['finished_ts'].max().strftime('%Y-%m-%d %H:%M:%S') if len(new) else watermark, start)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(df) + len(gone))
+    print(f'player_style: +{len(new)} матчей, матчи выпали из окна у {len(expired)} игроков'
+          f'{"; поздние/исправленные матчи до " + watermark if recheck else ""}; обновлено {len(df)}, удалено {len(gone)}')
+    return len(df)
+
+
+def refit_reason(conn, model, watermark, old_start, now):
+    """Почему нужно полное переобучение; None — достаточно предсказания по сохранённой модели."""
+    if model is None:
+        return 'нет сохранённой модели'
+    if watermark is None or not table_exists(conn, 'player_style'):
+        return 'нет сохранённых стилей'
+    if old_start is None:
+        return 'нет начала окна прошлого запуска'
+    if now - pd.Timestamp(model.fitted_at) > pd.Timedelta(days=REFIT_DAYS):
+        return f'модели больше {REFIT_DAYS} дней'
+    return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Стиль игроков: KMeans по средним метрикам матчей')
+    ap.add_argument('--refit', action='store_true', help='Переобучить модель (warm start от сохранённых центроидов)')
+    args = ap.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        ensure_epoch_columns(conn)
+        now = pd.Timestamp.now()
+        start = now - pd.Timedelta(days=WINDOW_DAYS)
+        matches, set_store = load_window(conn, start)
+        results = read_sql("SELECT player1, player2 FROM results", conn)
+        players = pd.unique(pd.concat([results['player1'], results['player2']])).tolist()
+        model = StyleModel.load(conn)
+        watermark = get_watermark(conn, ETL_NAME)
+        old_start = get_watermark(conn, WINDOW_NAME)
+        reason = '--refit' if args.refit else refit_reason(conn, model, watermark, old_start, now)
+        if reason is None and run_incremental(conn, matches, set_store, model, watermark, start, old_start,
+                                              late_matches(conn, watermark, old_start)) is None:
+            reason = 'дрейф фич'
+        if reason:
+            print(f'player_style: {reason} — переобучение')
+            run_refit(conn, matches, set_store, players, model, now, start)
+    finally:
+        conn.close()
+
 
-df = pd.DataFrame(rows)
-features = ['avg_total_pts', 'avg_duration_sec', 'avg_pt_margin', 'avg_set_margin']
-scaler = StandardScaler()
-X = scaler.fit_transform(df[features])
-kmeans = KMeans(n_clusters=4, random_state=42)
-labels = kmeans.fit_predict(X)
-df['cluster'] = labels
-
-# Маркируем вручную (можно сделать динамически)
-centers = kmeans.cluster_centers_
-styles = {}
-order = np.argsort(centers[:,0])  # по среднему тоталу
-for i, c in enumerate(order):
-    if i == 0:
-        styles[c] = 'defensive'
-    elif i == 1:
-        styles[c] = 'balanced'
-    elif i == 2:
-        styles[c] = 'chaotic'
-    else:
-        styles[c] = 'aggressive'
-df['style'] = df['cluster'].map(styles)
-
-# Выводим топ-3 по каждому стилю
-for st in df['style'].unique():
-    print(f"Топ-3 {st}: ", df[df['style']==st].sort_values('avg_total_pts', ascending=(st=='defensive')).head(3)[['player_name','avg_total_pts']].values)
-
-df_style = df[['player_name','matches_played','avg_total_pts','avg_duration_sec','avg_pt_margin','avg_set_margin','style']]
-df_style.to_sql('player_style', conn, if_exists='replace', index=False)
-print(f'Таблица player_style обновлена: {len(df_style)} игроков')
-conn.close()
+if __name__ == '__main__':
+    main()
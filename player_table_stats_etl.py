@@ -7,104 +7,153 @@ Source: results (match_id, table_label, player1, player2, sc_ev, sc_ext_ev, fini
 Фильтр: matches_played >= 20 (везде, кроме стола A9 — >= 10)
 Флаг cf_flag (⚠️ small_sample), edge_flag_table (True/False)
 
+Строки счёта разобраны при нормализации results (match_features: tot_points, счёт по сетам sc_ev),
+дальше — long-формат «игрок — матч» и сгруппированные суммы (np.bincount) по (player, table_label) и по игроку.
+Порядок строк и семантика прежнего цикла сохранены: группы — в порядке первого появления,
+матч «сам с собой» учитывается игроку дважды, игрок/стол NULL — отдельная группа.
+
 Author: GPT-4 + Кирилл, 2025
 """
 import sqlite3
 import pandas as pd
 import numpy as np
 import os
-from collections import defaultdict
-
-DB_PATH = 'betcity_results.db'
-if not os.path.exists(DB_PATH):
-    raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
-
-conn = sqlite3.connect(DB_PATH)
-df = pd.read_sql_query("SELECT * FROM results", conn)
-
-if not set(['match_id','table_label','player1','player2','sc_ev','sc_ext_ev','finished']).issubset(df.columns):
-    raise Exception("В таблице results отсутствуют необходимые столбцы!")
-
-def get_tot_points(sc_ext_ev):
-    # Суммируем очки по всем сетам, пример: '11:8, 5:11, 6:11, 5:11, 7:11'
-    total = 0
-    for set_str in str(sc_ext_ev).split(','):
-        if ':' in set_str or '-' in set_str:
-            sep = ':' if ':' in set_str else '-'
-            try:
-                a, b = set_str.strip().split(sep)
-                total += int(a) + int(b)
-            except: pass
-    return total if total > 0 else np.nan
-
-def is_winner(row, player):
-    # Возвращает True, если player выиграл матч (по sc_ev)
-    try:
-        left, right = [int(x) for x in str(row['sc_ev']).replace(':', '-').split('-')]
-        if player == row['player1'] and left > right:
-            return True
-        if player == row['player2'] and right > left:
-            return True
-    except:
-        pass
-    return False
-
-def rolling_avg(seq):
-    seq = [x for x in seq if not np.isnan(x)]
-    return np.mean(seq) if seq else np.nan
-
-data = []
-grouped = defaultdict(list)
-# Собираем все матчи для каждого (player, table_label)
-for idx, row in df.iterrows():
-    for player in [row['player1'], row['player2']]:
-        grouped[(player, row['table_label'])].append(row)
-
-# Общая статистика по игроку для edge (по всем столам)
-overall_stats = defaultdict(list)
-for (player, _), rows in grouped.items():
-    for r in rows:
-        pts = get_tot_points(r['sc_ext_ev'])
-        overall_stats[player].append({
-            'win': is_winner(r, player),
-            'tot_points': pts,
-        })
-
-overall_win_pct = {p: np.mean([x['win'] for x in stats]) for p, stats in overall_stats.items()}
-overall_ov74_5 = {p: np.mean([(x['tot_points']>74.5) for x in stats if not np.isnan(x['tot_points'])]) for p, stats in overall_stats.items()}
-overall_tot_pts_mu = {p: rolling_avg([x['tot_points'] for x in stats]) for p, stats in overall_stats.items()}
-overall_tot_pts_std = {p: np.std([x['tot_points'] for x in stats if not np.isnan(x['tot_points'])]) for p, stats in overall_stats.items()}
-
-for (player, table), matches in grouped.items():
-    n = len(matches)
-    min_sample = 10 if table == 'A9' else 20
-    wins = [is_winner(r, player) for r in matches]
-    tot_points = [get_tot_points(r['sc_ext_ev']) for r in matches]
-    ov74_5 = [tp > 74.5 if not np.isnan(tp) else False for tp in tot_points]
-    variance = np.std([tp for tp in tot_points if not np.isnan(tp)])
-    # сравнение с общей std по игроку
-    variance_factor = variance / overall_tot_pts_std[player] if overall_tot_pts_std[player]>0 else np.nan
-    avg_pts_match_diff = rolling_avg(tot_points) - overall_tot_pts_mu[player] if not np.isnan(overall_tot_pts_mu[player]) else np.nan
-    rec = {
-        'player': player,
-        'table_label': table,
+from db_utils import DB_PATH
+from etl_metrics import read_sql, write_table
+from match_features import FEATURES_TABLE, sync_match_features
+
+OV_LINE = 74.5
+EDGE_DELTA = 0.10
+
+
+def parse_matches(df):
+    """tot_points (NaN, если очков нет), left_win / right_win по sc_ev — из колонок match_features."""
+    left = df['sets_left'].fillna(0).to_numpy(dtype=float)
+    right = df['sets_right'].fillna(0).to_numpy(dtype=float)
+    return pd.DataFrame({
+        'tot_points': df['tot_points'].to_numpy(dtype=float),
+        'left_win': left > right,
+        'right_win': right > left,
+    }, index=df.index)
+
+
+def first_seen_codes(*keys):
+    """Номер группы по набору ключей в порядке первого появления (NULL — обычное значение ключа)."""
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    for key in keys:
+        codes, uniques = pd.factorize(key, use_na_sentinel=False)
+        combined = combined * (len(uniques) + 1) + codes
+    return pd.factorize(combined)
+
+
+def ordered_group_sums(values, codes, n_groups, order):
+    """
+    Суммы values по группам, каждая — np.sum по непрерывному срезу в порядке order.
+    Попарное суммирование numpy зависит от порядка и состава элементов, поэтому std совпадает
+    с np.std(list) прежнего цикла бит в бит только при суммировании в том же порядке.
+    """
+    v, c = values[order], codes[order]
+    bounds = np.searchsorted(c, np.arange(n_groups + 1))
+    return np.array([v[a:b].sum() for a, b in zip(bounds[:-1], bounds[1:])], dtype=float)
+
+
+def grouped_stats(codes, n_groups, win, tp, order):
+    """
+    Суммы по группам: matches, win_pct, ov74_5 (по всем / по матчам с очками), среднее и std (ddof=0) очков.
+    order — порядок записей, в котором цикл собирал списки группы (записи каждой группы подряд).
+    """
+    has_tp = ~np.isnan(tp)
+    tp0 = np.where(has_tp, tp, 0.0)
+    ov = has_tp & (tp > OV_LINE)
+    n = np.bincount(codes, minlength=n_groups)
+    n_tp = np.bincount(codes, weights=has_tp, minlength=n_groups)
+    wins = np.bincount(codes, weights=win, minlength=n_groups)
+    ov_sum = np.bincount(codes, weights=ov, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Очки — целые, сумма точная в любом порядке
+        mu = np.bincount(codes, weights=tp0, minlength=n_groups) / n_tp
+        dev2 = (tp0 - mu[codes]) ** 2
+        order = order[has_tp[order]]
+        std = np.sqrt(ordered_group_sums(dev2, codes, n_groups, order) / n_tp)
+        return {
+            'n': n,
+            'win_pct': wins / n,
+            'ov_all': ov_sum / n,
+            'ov_with_pts': ov_sum / n_tp,
+            'mu': mu,
+            'std': std,
+        }
+
+
+def table_stats(df):
+    parsed = parse_matches(df)
+    # Две записи на матч (player1, затем player2) в порядке строк results
+    p1, p2 = df['player1'].to_numpy(dtype=object), df['player2'].to_numpy(dtype=object)
+    left_win, right_win = parsed['left_win'].to_numpy(), parsed['right_win'].to_numpy()
+    player = np.empty(2 * len(df), dtype=object)
+    player[0::2], player[1::2] = p1, p2
+    table = np.repeat(df['table_label'].to_numpy(dtype=object), 2)
+    # is_winner: player == player1 и left > right, либо player == player2 и right > left.
+    # Сравнение — питоновское ==, как в цикле: NaN-игрок не равен никому (и себе), None == None
+    same = p1 == p2
+    win = np.empty(2 * len(df), dtype=bool)
+    win[0::2] = ((p1 == p1) & left_win) | (same & right_win)
+    win[1::2] = (same & left_win) | ((p2 == p2) & right_win)
+    tp = np.repeat(parsed['tot_points'].to_numpy(), 2)
+
+    pt_codes, pt_keys = first_seen_codes(player, table)
+    pl_codes, pl_keys = first_seen_codes(player)
+    # Порядок цикла: записи (игрок, стол) подряд; для игрока — его группы по столам в порядке появления
+    by_table = np.argsort(pt_codes, kind='stable')
+    by_player = by_table[np.argsort(pl_codes[by_table], kind='stable')]
+    per_table = grouped_stats(pt_codes, len(pt_keys), win, tp, by_table)
+    overall = grouped_stats(pl_codes, len(pl_keys), win, tp, by_player)
+
+    # Игрок и стол группы — по первой записи группы
+    first = np.full(len(pt_keys), len(pt_codes))
+    np.minimum.at(first, pt_codes, np.arange(len(pt_codes)))
+    g_player, g_table, g_pl = player[first], table[first], pl_codes[first]
+    n = per_table['n']
+    o_std = overall['std'][g_pl]
+    o_mu = overall['mu'][g_pl]
+    win_pct = per_table['win_pct']
+    ov_pct = per_table['ov_all']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance_factor = np.where(o_std > 0, per_table['std'] / o_std, np.nan)
+    avg_pts_match_diff = np.where(np.isnan(o_mu), np.nan, per_table['mu'] - o_mu)
+
+    min_sample = np.where(pd.Series(g_table, dtype=object).eq('A9').to_numpy(), 10, 20)
+    big = n >= min_sample
+    edge = big & ((win_pct - overall['win_pct'][g_pl] >= EDGE_DELTA) |
+                  (ov_pct - overall['ov_with_pts'][g_pl] >= EDGE_DELTA))
+    return pd.DataFrame({
+        'player': g_player,
+        'table_label': g_table,
         'matches_played': n,
-        'win_pct': np.mean(wins) if n>0 else np.nan,
-        'ov74_5_hit_pct': np.mean(ov74_5) if n>0 else np.nan,
+        'win_pct': win_pct,
+        'ov74_5_hit_pct': ov_pct,
         'avg_pts_match_diff': avg_pts_match_diff,
         'variance_factor': variance_factor,
-        'edge_flag_table': False, # вычислим ниже
-        'cf_flag': '',
-    }
-    # edge flag logic
-    if n >= min_sample:
-        if (rec['win_pct'] - overall_win_pct[player] >= 0.10) or (rec['ov74_5_hit_pct'] - overall_ov74_5[player] >= 0.10):
-            rec['edge_flag_table'] = True
-    else:
-        rec['cf_flag'] = '⚠️ small_sample'
-    data.append(rec)
-
-result_df = pd.DataFrame(data)
-result_df.to_sql('player_table_stats', conn, if_exists='replace', index=False)
-print(f'player_table_stats обновлён! Только значения с min_sample (A9:10, остальные 20) edge-флагируются.')
-conn.close()
+        'edge_flag_table': edge,
+        'cf_flag': np.where(big, '', '⚠️ small_sample'),
+    })
+
+
+if __name__ == '__main__':
+    if not os.path.exists(DB_PATH):
+        raise FileNotFoundError(f"База данных не найдена по пути: {DB_PATH}")
+
+    conn = sqlite3.connect(DB_PATH)
+    sync_match_features(conn, ())  # дозаполнение признаков матчей, ещё не прошедших нормализацию
+    df = read_sql(f"""
+        SELECT r.*, f.tot_points, f.sets_left, f.sets_right
+        FROM results r LEFT JOIN {FEATURES_TABLE} f ON f.match_id = r.match_id
+    """, conn)
+
+    if not set(['match_id','table_label','player1','player2','sc_ev','sc_ext_ev','finished']).issubset(df.columns):
+        raise Exception("В таблице results отсутствуют необходимые столбцы!")
+
+    result_df = table_stats(df)
+    write_table(result_df, 'player_table_stats', conn)
+    print(f'player_table_stats обновлён! Только значения с min_sample (A9:10, остальные 20) edge-флагируются.')
+    conn.close()
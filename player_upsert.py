@@ -0,0 +1,108 @@
+"""
+player_upsert.py
+----------------
+Инкрементальная публикация таблиц «одна строка на игрока» (player_passport, player_passports).
+
+- Отпечаток входа игрока — сумма хешей его входных строк (pd.util.hash_pandas_object), порядок строк не важен;
+  хранится в <таблица>_state (player_name, input_hash)
+- changed_players: игроки, чей отпечаток появился / изменился / пропал с прошлой сборки
+- publish_changed: строки этих игроков — INSERT ... ON CONFLICT(player_name) DO UPDATE (ключ и rowid стабильны),
+  игроки без строки — DELETE; отпечатки — в той же транзакции
+- publish_full: полная запись (write_table) + уникальный индекс по player_name; нужна, если таблицы или состояния нет
+  или набор колонок изменился (rebuild_reason)
+"""
+
+import numpy as np
+import pandas as pd
+
+from etl_metrics import acquire_write_lock, count_rows_written, read_sql, write_table
+from rating_index import table_exists
+
+KEY = 'player_name'
+
+
+def input_hashes(frames, key=KEY):
+    """Отпечаток входа по игроку: сумма (mod 2^64) хешей строк всех frames; строки без игрока пропускаются."""
+    keys, hashes = [], []
+    for i, df in enumerate(frames):
+        df = df[df[key].notna()]
+        values = df.drop(columns=key)
+        # int -> float: NULL в чужой строке превращает INTEGER-колонку во float64, хеши строк не должны от этого меняться
+        numeric = [c for c in values.columns
+                   if pd.api.types.is_numeric_dtype(values[c]) and not pd.api.types.is_bool_dtype(values[c])]
+        values = values.astype({c: 'float64' for c in numeric})
+        h = pd.util.hash_pandas_object(values, index=False).to_numpy()
+        keys.append(df[key].to_numpy(dtype=object))
+        hashes.append(h * np.uint64(2 * i + 1))  # одна и та же строка в разных источниках — разный вклад
+    codes, players = pd.factorize(np.concatenate(keys) if keys else np.zeros(0, dtype=object))
+    sums = np.zeros(len(players), dtype=np.uint64)
+    np.add.at(sums, codes, np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64))
+    return pd.Series(sums.view(np.int64), index=pd.Index(players, dtype=object, name=key))
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def rebuild_reason(conn, table, state_table, columns):
+    """Почему нужна полная запись таблицы; None — можно обновлять по игрокам."""
+    if not table_exists(conn, table) or not table_exists(conn, state_table):
+        return f'нет {table} или {state_table}'
+    if table_columns(conn, table) != list(columns):
+        return f'изменился набор колонок {table}'
+    return None
+
+
+def changed_players(conn, state_table, hashes):
+    """(changed, removed): отпечаток новый или другой / игрока больше нет во входе."""
+    old = read_sql(f"SELECT {KEY}, input_hash FROM {state_table}", conn)
+    old = dict(zip(old[KEY], old['input_hash'].astype(np.int64)))
+    changed = [p for p, h in hashes.items() if old.get(p) != h]
+    removed = [p for p in old if p not in hashes.index]
+    return changed, removed
+
+
+def _upsert(conn, table, df):
+    cols = list(df.columns)
+    updates = ', '.join(f'{c}=excluded.{c}' for c in cols if c != KEY)
+    conn.executemany(
+        f"INSERT INTO {table} ({','.join(cols)}) VALUES ({','.join('?' * len(cols))}) "
+        f"ON CONFLICT({KEY}) DO UPDATE SET {updates}",
+        df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def _delete(conn, table, players):
+    conn.executemany(f"DELETE FROM {table} WHERE {KEY} = ?", [(p,) for p in players])
+
+
+def _state_frame(hashes):
+    return pd.DataFrame({KEY: hashes.index.to_numpy(dtype=object), 'input_hash': hashes.to_numpy()})
+
+
+def publish_full(conn, table, state_table, df, hashes):
+    write_table(df, table, conn)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_player ON {table}({KEY})")
+    write_table(_state_frame(hashes), state_table, conn)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{state_table}_player ON {state_table}({KEY})")
+    conn.commit()
+
+
+def publish_changed(conn, table, state_table, df, hashes, changed, removed):
+    """
+    Upsert строк df (пересчитанные игроки из changed); игроки removed и игроки changed без строки в df удаляются.
+    Возвращает (обновлено, удалено).
+    """
+    gone = sorted((set(changed) | set(removed)) - set(df[KEY]), key=str)
+    acquire_write_lock(conn)
+    try:
+        if len(df):
+            _upsert(conn, table, df)
+        _delete(conn, table, gone)
+        _upsert(conn, state_table, _state_frame(hashes[hashes.index.isin(changed)]))
+        _delete(conn, state_table, removed)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    count_rows_written(len(df) + len(gone))
+    return len(df), len(gone)
@@ -0,0 +1,143 @@
+"""
+rating_index.py
+---------------
+Индекс рейтингов «на момент времени» (as-of) для leak-free фич.
+
+- Источник: glicko2_snapshot (если есть), иначе player_elo_history
+- Для каждого игрока — отсортированные по времени снапшоты в общих массивах (CSR: offsets по id игрока)
+- rating_at(player, ts) — O(log n) бинарным поиском по снапшотам игрока
+- ratings_at(players, ts) — векторная версия для целого списка матчей (один np.searchsorted)
+
+Семантика источников:
+- player_elo_history: строка с датой матча — это рейтинг ПОСЛЕ матча, поэтому берутся строго более ранние
+  снапшоты (strict=True); до первого матча рейтинг = elo_before первого матча (стартовый)
+- glicko2_snapshot: snap_ts <= ts (снапшот пишется на конец рейтингового периода);
+  до первого снапшота — стартовый рейтинг Glicko-2
+- fallback_latest=True: если до ts снапшотов нет, берётся самый поздний снапшот игрока
+  (так исторически работал get_opp_rating в player_sos_windows_etl.py; это утечка будущего)
+
+Пример:
+    idx = load_rating_index(conn)
+    idx.rating_at('Иванов А.', '2025-06-01 12:00:00')
+    pm['opp_rating'] = idx.ratings_at(pm['opponent'], pm['finished_ts'])
+"""
+
+import numpy as np
+import pandas as pd
+
+GLICKO2_START_RATING = 1500.0
+
+
+def to_epoch_seconds(values):
+    """Время (строки, Timestamp, datetime64) -> (int64 секунды, маска valid); NaT/мусор -> valid=False."""
+    ts = pd.to_datetime(pd.Series(values), errors='coerce')
+    valid = ts.notna().to_numpy()
+    sec = np.zeros(len(ts), dtype=np.int64)
+    sec[valid] = ts[valid].to_numpy(dtype='datetime64[s]').astype(np.int64)
+    return sec, valid
+
+
+class RatingIndex:
+    """
+    Снапшоты (player, ts, rating), сгруппированные по игроку и отсортированные по времени.
+    strict — брать только снапшоты строго раньше ts; initial — рейтинг до первого снапшота
+    (скаляр, dict {player: rating} или None — тогда NaN / fallback_latest).
+    """
+
+    def __init__(self, players, ts, ratings, strict=False, initial=None):
+        players = pd.Series(players, dtype=object).reset_index(drop=True)
+        ratings = pd.Series(ratings, dtype=float).reset_index(drop=True)
+        sec, valid = to_epoch_seconds(pd.Series(ts).reset_index(drop=True))
+        self.strict = strict
+        codes, names = pd.factorize(players, sort=True)
+        self.names = pd.Index(names)
+        n_players = len(names)
+
+        # Самый поздний снапшот игрока среди всех строк (NaN-время — в конце, как sort_values)
+        order_all = np.lexsort((np.where(valid, sec, np.iinfo(np.int64).max), codes))
+        last_pos = np.full(n_players, -1)
+        last_pos[codes[order_all]] = order_all
+        self.latest = np.where(last_pos >= 0, ratings.to_numpy()[np.maximum(last_pos, 0)], np.nan)
+
+        keep = valid & ratings.notna().to_numpy() & (codes >= 0)
+        codes, sec, rating = codes[keep], sec[keep], ratings.to_numpy()[keep]
+        order = np.lexsort((sec, codes))
+        self.codes, self.ts, self.rating = codes[order], sec[order], rating[order]
+        self.offsets = np.searchsorted(self.codes, np.arange(n_players + 1))
+
+        # Составной ключ (id игрока, время) — монотонный по всему массиву
+        self.t0 = int(self.ts.min()) - 1 if len(self.ts) else 0
+        self.span = (int(self.ts.max()) - self.t0 + 2) if len(self.ts) else 2
+        self.keys = self.codes.astype(np.int64) * self.span + (self.ts - self.t0)
+
+        if initial is None:
+            self.initial = np.full(n_players, np.nan)
+        elif isinstance(initial, dict):
+            self.initial = np.array([initial.get(p, np.nan) for p in names], dtype=float)
+        else:
+            self.initial = np.full(n_players, float(initial))
+
+    def __len__(self):
+        return len(self.ts)
+
+    def rating_at(self, player, ts, fallback_latest=False):
+        """Рейтинг игрока на момент ts (строка/Timestamp/datetime) за O(log n)."""
+        code = self.names.get_indexer([player])[0]
+        if code < 0:
+            return np.nan
+        t = pd.Timestamp(ts)
+        if pd.isna(t):
+            return np.nan
+        t = int(t.value // 10**9)
+        lo, hi = self.offsets[code], self.offsets[code + 1]
+        j = lo + np.searchsorted(self.ts[lo:hi], t, side='left' if self.strict else 'right') - 1
+        if j >= lo:
+            return float(self.rating[j])
+        if fallback_latest:
+            return float(self.latest[code])
+        return float(self.initial[code])
+
+    def ratings_at(self, players, ts, fallback_latest=False):
+        """Векторная версия rating_at: массивы игроков и времён одинаковой длины -> float-массив."""
+        codes = self.names.get_indexer(pd.Series(players, dtype=object))
+        sec, valid = to_epoch_seconds(ts)
+        known = codes >= 0
+        safe_codes = np.where(known, codes, 0)
+        rel = np.clip(sec - self.t0, 0, self.span - 1)
+        qkeys = safe_codes.astype(np.int64) * self.span + rel
+        j = np.searchsorted(self.keys, qkeys, side='left' if self.strict else 'right') - 1
+        lo = self.offsets[safe_codes]
+        found = known & valid & (j >= lo)
+        out = np.full(len(codes), np.nan)
+        out[found] = self.rating[j[found]]
+        before_first = known & valid & ~found
+        fill = self.latest if fallback_latest else self.initial
+        out[before_first] = fill[safe_codes[before_first]]
+        return out
+
+
+def from_elo_history(history):
+    """Индекс из player_elo_history (DataFrame: player, date, elo_before, elo_after)."""
+    first = history.sort_values('date', kind='mergesort').drop_duplicates('player')
+    initial = dict(zip(first['player'], first['elo_before']))
+    return RatingIndex(history['player'], history['date'], history['elo_after'], strict=True, initial=initial)
+
+
+def from_glicko2(snap):
+    """Индекс из glicko2_snapshot (DataFrame: player_name, snap_ts, rating)."""
+    return RatingIndex(snap['player_name'], snap['snap_ts'], snap['rating'],
+                       strict=False, initial=GLICKO2_START_RATING)
+
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
+
+
+def load_rating_index(conn, source='auto', read=pd.read_sql_query):
+    """
+    source: 'auto' (glicko2_snapshot, если таблица есть, иначе player_elo_history) | 'glicko2' | 'elo'.
+    read — функция чтения (например, etl_metrics.read_sql для учёта строк).
+    """
+    if source == 'glicko2' or (source == 'auto' and table_exists(conn, 'glicko2_snapshot')):
+        return from_glicko2(read("SELECT player_name, snap_ts, rating FROM glicko2_snapshot", conn))
+    return from_elo_history(read("SELECT player, date, elo_before, elo_after FROM player_elo_history", conn))
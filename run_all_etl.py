@@ -15,6 +15,7 @@ import sys
 
 modules = [
     "player_elo_etl.py",
+    "player_glicko2_etl.py",
     "player_fatigue_etl.py",
     "player_style_etl.py",
     "player_resilience_etl.py",
@@ -0,0 +1,107 @@
+"""
+set_store.py
+------------
+Компактное хранилище счётов по сетам (CSR-раскладка) для ETL игроков.
+
+- match_ids — отсортированные id матчей, offsets[i]:offsets[i+1] — сеты матча i
+  в плоских массивах p1_pts / p2_pts (по возрастанию set_no)
+- Итоги по матчу посчитаны заранее: p1_total, p2_total (NaN-очки не учитываются, как в pandas .sum()), n_sets
+- Сеты матча — срез массивов, поиск матча — np.searchsorted (без сканирования set_scores на каждый матч)
+
+Сборка один раз на батч: из таблицы set_scores (from_db / from_frame)
+или прямо из разобранных счётов parse_set_scores при загрузке (from_parsed).
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class SetScoreStore:
+    """Сеты всех матчей: match_ids, offsets, p1_pts, p2_pts + итоги p1_total, p2_total, n_sets."""
+
+    def __init__(self, match_ids, offsets, p1_pts, p2_pts):
+        self.match_ids = np.asarray(match_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.p1_pts = np.asarray(p1_pts)
+        self.p2_pts = np.asarray(p2_pts)
+        self.n_sets = np.diff(self.offsets)
+        self.p1_total = self._segment_sums(self.p1_pts)
+        self.p2_total = self._segment_sums(self.p2_pts)
+
+    def __len__(self):
+        return len(self.match_ids)
+
+    def _segment_sums(self, pts):
+        if len(self.match_ids) == 0:
+            return np.zeros(0)
+        return np.add.reduceat(np.nan_to_num(pts.astype(float)), self.offsets[:-1])
+
+    @classmethod
+    def from_frame(cls, set_scores):
+        """Из фрейма (match_id, set_no, p1_pts, p2_pts); строки без match_id пропускаются."""
+        df = set_scores[set_scores['match_id'].notna()]
+        df = df.sort_values(['match_id', 'set_no'], kind='mergesort')
+        mid = df['match_id'].to_numpy(dtype=np.int64)
+        match_ids, starts = np.unique(mid, return_index=True)
+        offsets = np.append(starts, len(mid))
+        return cls(match_ids, offsets, df['p1_pts'].to_numpy(copy=True), df['p2_pts'].to_numpy(copy=True))
+
+    @classmethod
+    def from_db(cls, conn, read=pd.read_sql_query):
+        return cls.from_frame(read("SELECT match_id, set_no, p1_pts, p2_pts FROM set_scores", conn))
+
+    @classmethod
+    def from_parsed(cls, parsed):
+        """
+        Из разобранных счётов при загрузке: parsed — пары (match_id, [(p1, p2), ...]),
+        как их возвращает parse_set_scores(sc_ext_ev). Матчи без сетов пропускаются.
+        """
+        rows = [(mid, no, a, b) for mid, sets in parsed for no, (a, b) in enumerate(sets, start=1)]
+        return cls.from_frame(pd.DataFrame(rows, columns=['match_id', 'set_no', 'p1_pts', 'p2_pts']))
+
+    def positions(self, match_ids):
+        """Индексы матчей в хранилище; -1 — сетов нет."""
+        ids = np.asarray(match_ids, dtype=np.int64)
+        if len(self.match_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.match_ids, ids), len(self.match_ids) - 1)
+        return np.where(self.match_ids[pos] == ids, pos, -1)
+
+    def sets(self, match_id):
+        """(p1_pts, p2_pts) матча по возрастанию set_no — срезы без копирования; пустые, если сетов нет."""
+        pos = self.positions([match_id])[0]
+        if pos < 0:
+            return self.p1_pts[:0], self.p2_pts[:0]
+        a, b = self.offsets[pos], self.offsets[pos + 1]
+        return self.p1_pts[a:b], self.p2_pts[a:b]
+
+    def totals(self, match_ids):
+        """Итоги по списку матчей: (p1_total, p2_total, n_sets); для матчей без сетов — 0, 0, 0."""
+        pos = self.positions(match_ids)
+        if len(self.match_ids) == 0:
+            return np.zeros(len(pos)), np.zeros(len(pos)), np.zeros(len(pos), dtype=np.int64)
+        found = pos >= 0
+        safe = np.where(found, pos, 0)
+        return (np.where(found, self.p1_total[safe], 0.0),
+                np.where(found, self.p2_total[safe], 0.0),
+                np.where(found, self.n_sets[safe], 0))
+
+    def padded(self, match_ids, width=None):
+        """
+        Раскладка «матч × сет» для векторных расчётов: (p1 [m, width], p2 [m, width], n_sets),
+        сеты по возрастанию set_no, хвост после последнего сета — NaN. width — по умолчанию макс. число сетов.
+        """
+        pos = self.positions(match_ids)
+        if len(self.match_ids) == 0:
+            empty = np.full((len(pos), width or 0), np.nan)
+            return empty, empty.copy(), np.zeros(len(pos), dtype=np.int64)
+        found = pos >= 0
+        safe = np.where(found, pos, 0)
+        n_sets = np.where(found, self.n_sets[safe], 0)
+        width = int(n_sets.max(initial=0)) if width is None else width
+        cols = np.arange(width)
+        valid = cols < n_sets[:, None]
+        idx = np.where(valid, self.offsets[safe][:, None] + cols, 0)
+        p1 = np.where(valid, self.p1_pts.astype(float)[idx], np.nan)
+        p2 = np.where(valid, self.p2_pts.astype(float)[idx], np.nan)
+        return p1, p2, n_sets
@@ -0,0 +1,163 @@
+"""
+sos_state.py
+------------
+Инкрементальное состояние Strength of Schedule (player_sos_windows_etl.py).
+
+Для каждого игрока — кольцевые буферы (deque) последних записей (ts, рейтинг соперника) и бегущие суммы:
+- окна по матчам (5/10/30): deque фиксированной длины, новый матч вытесняет самый старый — O(1)
+- окна по дням (2/7/30): записи истекают лениво — при expire(now) срезаются с головы deque
+
+Персистентность: таблица player_sos_state (player_name, entries JSON, updated_at).
+Все буферы — суффиксы одного и того же потока матчей игрока, поэтому хранится только
+самый длинный из них (последние 30 матчей или все матчи за 30 дней); суммы пересчитываются при загрузке.
+"""
+
+import json
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+MATCH_WINDOWS = [5, 10, 30]
+DAY_WINDOWS = [2, 7, 30]
+SECONDS_PER_DAY = 86_400
+
+STATE_TABLE = 'player_sos_state'
+
+
+def window_columns():
+    return [f'sos_last_{n}m' for n in MATCH_WINDOWS] + [f'sos_last_{d}d' for d in DAY_WINDOWS]
+
+
+def output_columns():
+    cols = ['player_name']
+    for col in window_columns():
+        cols += [col, f'{col}_cf']
+    return cols
+
+
+def cf_flag(count):
+    return '✅' if count >= 5 else ('⚠️' if count > 0 else '⛔')
+
+
+class PlayerWindows:
+    """Окна одного игрока: buffers[col] — deque (ts, rating), sums[col] — бегущая сумма рейтингов."""
+
+    __slots__ = ('buffers', 'sums')
+
+    def __init__(self, entries=()):
+        self.buffers = {col: deque() for col in window_columns()}
+        self.sums = dict.fromkeys(window_columns(), 0.0)
+        for ts, rating in entries:
+            self.add(ts, rating)
+
+    def add(self, ts, rating):
+        """Новый матч (в хронологическом порядке): O(1) на окно."""
+        entry = (ts, rating)
+        for n in MATCH_WINDOWS:
+            col = f'sos_last_{n}m'
+            buf = self.buffers[col]
+            buf.append(entry)
+            self.sums[col] += rating
+            if len(buf) > n:
+                self.sums[col] -= buf.popleft()[1]
+        for d in DAY_WINDOWS:
+            col = f'sos_last_{d}d'
+            self.buffers[col].append(entry)
+            self.sums[col] += rating
+
+    def expire(self, now_sec):
+        """Срезает записи старше now - d дней из окон по дням; True, если что-то изменилось."""
+        changed = False
+        for d in DAY_WINDOWS:
+            col = f'sos_last_{d}d'
+            buf = self.buffers[col]
+            limit = now_sec - d * SECONDS_PER_DAY
+            while buf and buf[0][0] < limit:
+                self.sums[col] -= buf.popleft()[1]
+                changed = True
+            if not buf:
+                self.sums[col] = 0.0  # без накопленной ошибки округления
+        return changed
+
+    def entries(self):
+        """Самый длинный буфер — объединение всех окон."""
+        return list(max(self.buffers.values(), key=len))
+
+    def row(self, player):
+        row = {'player_name': player}
+        for col in window_columns():
+            count = len(self.buffers[col])
+            row[col] = self.sums[col] / count if count else np.nan
+            row[f'{col}_cf'] = cf_flag(count)
+        return row
+
+
+class SoSStateStore:
+    """Состояние всех игроков: {player_name: PlayerWindows}."""
+
+    def __init__(self, players=None):
+        self.players = players or {}
+
+    def __len__(self):
+        return len(self.players)
+
+    @classmethod
+    def from_frame(cls, pm, now_sec, players=None):
+        """
+        Полная сборка из long-фрейма (player, ts, opp_rating), отсортированного по игроку и времени.
+        Каждому игроку достаточно суффикса: последние 30 матчей и все матчи за 30 дней.
+        players — кого завести в состоянии, даже если в pm у них нет строк (по умолчанию игроки из pm).
+        """
+        keep = max(MATCH_WINDOWS)
+        horizon = now_sec - max(DAY_WINDOWS) * SECONDS_PER_DAY
+        from_end = pm.groupby('player', sort=False).cumcount(ascending=False).to_numpy()
+        tail = pm[(from_end < keep) | (pm['ts'].to_numpy() >= horizon)]
+        names = pd.unique(pm['player']) if players is None else players
+        store = cls({p: PlayerWindows() for p in names})
+        for player, ts, rating in zip(tail['player'], tail['ts'], tail['opp_rating']):
+            store.players[player].add(int(ts), float(rating))
+        store.expire(now_sec)
+        return store
+
+    @classmethod
+    def load(cls, conn):
+        rows = conn.execute(f"SELECT player_name, entries FROM {STATE_TABLE}").fetchall()
+        return cls({p: PlayerWindows(json.loads(e)) for p, e in rows})
+
+    def apply(self, players, ts, ratings):
+        """Новые матчи игроков в хронологическом порядке; NaN-рейтинг — игрок есть, окна не меняются."""
+        touched = set()
+        for player, t, rating in zip(players, ts, ratings):
+            w = self.players.get(player)
+            if w is None:
+                w = self.players[player] = PlayerWindows()
+            if pd.notna(rating):
+                w.add(int(t), float(rating))
+            touched.add(player)
+        return touched
+
+    def expire(self, now_sec):
+        return {p for p, w in self.players.items() if w.expire(now_sec)}
+
+    def frame(self, names=None):
+        names = list(self.players) if names is None else names
+        return pd.DataFrame([self.players[p].row(p) for p in names], columns=output_columns())
+
+    def save(self, conn, names=None):
+        """Upsert состояния игроков names (по умолчанию всех). Не коммитит."""
+        names = list(self.players) if names is None else names
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {STATE_TABLE} (player_name, entries, updated_at) VALUES (?, ?, datetime('now'))",
+            ((p, json.dumps(self.players[p].entries())) for p in names))
+        return len(names)
+
+
+def ensure_state_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            player_name TEXT PRIMARY KEY,
+            entries     TEXT,
+            updated_at  TEXT
+        )
+    """)
@@ -0,0 +1,297 @@
+"""
+synthetic_db.py
+---------------
+Детерминированный генератор синтетической betcity_results.db для замеров производительности.
+
+- Полная схема: results, match_results, set_scores, player_matches, match_features
+  (как в betcity_results_parser_all_in_one_rolling.py), line_* (line_parser_debug_v2.py), live_* (live_parser_debug_v_3.py)
+- N игроков с латентной силой и разной активностью, M матчей BO5 на столах A3–A9
+- Реалистичные sc_ev / sc_ext_ev: сеты до 11, больше-меньше при 10:10
+- match_results/set_scores считаются теми же функциями, что и в парсере результатов
+- История линии и лайва (коэффициенты П1/П2, фора, тотал) для матчей последних --odds-days дней
+- Одинаковые --seed и --end-date дают побайтно одинаковые данные; масштаб от 10k до 5M матчей
+
+CLI:
+    python synthetic_db.py --out bench/betcity_results.db --players 400 --matches 100000
+    python synthetic_db.py --out big.db --players 3000 --matches 5000000 --odds-days 3
+
+Функции make_results_feed / make_line_feed / make_live_feed отдают JSON в формате фида betcity
+для замеров write-путей парсеров (см. etl_benchmark.py).
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from betcity_results_parser_all_in_one_rolling import (
+    calc_duration_and_intensity,
+    calc_progress_and_comeback,
+    create_tables,
+)
+from match_features import sync_match_features
+from player_matches import sync_player_matches
+from line_parser_debug_v2 import DDL as LINE_DDL
+from live_parser_debug_v_3 import DDL as LIVE_DDL
+
+TABLES = ['A3', 'A4', 'A5', 'A6', 'A9']
+SURNAMES = [
+    'Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов',
+    'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров',
+    'Павлов', 'Козлов', 'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин',
+    'Захаров', 'Зайцев', 'Соловьев', 'Борисов', 'Яковлев', 'Григорьев', 'Романов', 'Воробьев',
+    'Сергеев', 'Кузьмин', 'Фролов', 'Александров', 'Дмитриев', 'Королев', 'Гусев', 'Киселев',
+]
+INITIALS = 'АБВГДЕИКЛМНОПРСТФЮЯ'
+CHUNK = 200_000
+
+
+def player_names(n):
+    names = []
+    for i in range(n):
+        surname = SURNAMES[i % len(SURNAMES)]
+        initial = INITIALS[(i // len(SURNAMES)) % len(INITIALS)]
+        rnd = i // (len(SURNAMES) * len(INITIALS))
+        names.append(f"{surname} {initial}." + (f" {rnd + 1}" if rnd else ''))
+    return names
+
+
+def simulate_matches(n_players, n_matches, days=360, end_date=None, seed=42):
+    """
+    Генерирует матчи в памяти (numpy-массивы), отсортированные по времени окончания.
+    Возвращает dict: match_id, finished (datetime64[s]), table, p1, p2 (индексы игроков),
+    sets (n_matches x 5 x 2, очки по сетам, -1 для несыгранных), n_sets, p1_sets, p2_sets.
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end_date).normalize() if end_date else pd.Timestamp.now().normalize()
+    start = end - pd.Timedelta(days=days)
+
+    skill = rng.normal(0.0, 1.0, n_players)
+    activity = rng.lognormal(0.0, 0.8, n_players)
+    activity /= activity.sum()
+
+    offsets = np.sort(rng.integers(0, days * 86400, n_matches))
+    finished = (np.datetime64(start.to_datetime64(), 's') + offsets.astype('timedelta64[s]'))
+    table = rng.integers(0, len(TABLES), n_matches)
+    p1 = rng.choice(n_players, n_matches, p=activity)
+    p2 = rng.choice(n_players, n_matches, p=activity)
+    p2 = np.where(p2 == p1, (p1 + rng.integers(1, n_players, n_matches)) % n_players, p2)
+
+    # Вероятность выиграть сет у p1
+    p_set = 1.0 / (1.0 + np.exp(-0.6 * (skill[p1] - skill[p2])))
+    set_win = rng.random((n_matches, 5)) < p_set[:, None]
+    w1 = np.cumsum(set_win, axis=1)
+    w2 = np.cumsum(~set_win, axis=1)
+    done = (w1 >= 3) | (w2 >= 3)
+    n_sets = done.argmax(axis=1) + 1
+    played = np.arange(5)[None, :] < n_sets[:, None]
+    p1_sets = np.where(played, set_win, False).sum(axis=1)
+    p2_sets = n_sets - p1_sets
+
+    # Очки проигравшего сет: близкие соперники чаще доходят до больше-меньше
+    closeness = 1.0 - np.abs(p_set - 0.5) * 2
+    loser = rng.binomial(9, (0.45 + 0.25 * closeness)[:, None], (n_matches, 5))
+    deuce = rng.random((n_matches, 5)) < (0.06 + 0.14 * closeness)[:, None]
+    loser = np.where(deuce, 10 + rng.geometric(0.55, (n_matches, 5)) - 1, loser)
+    winner = np.where(deuce, loser + 2, 11)
+    sets = np.full((n_matches, 5, 2), -1, dtype=np.int64)
+    sets[:, :, 0] = np.where(set_win, winner, loser)
+    sets[:, :, 1] = np.where(set_win, loser, winner)
+    sets[~played] = -1
+
+    return {
+        'match_id': np.arange(10_000_000, 10_000_000 + n_matches, dtype=np.int64),
+        'finished': finished,
+        'table': table,
+        'p1': p1,
+        'p2': p2,
+        'sets': sets,
+        'n_sets': n_sets,
+        'p1_sets': p1_sets,
+        'p2_sets': p2_sets,
+    }
+
+
+def _chunk_rows(sim, names, lo, hi):
+    results, match_results, set_rows = [], [], []
+    finished = pd.DatetimeIndex(sim['finished'][lo:hi]).strftime('%Y-%m-%d %H:%M:%S')
+    for j, i in enumerate(range(lo, hi)):
+        mid = int(sim['match_id'][i])
+        ns = int(sim['n_sets'][i])
+        sc = [(int(a), int(b)) for a, b in sim['sets'][i, :ns]]
+        p1s, p2s = int(sim['p1_sets'][i]), int(sim['p2_sets'][i])
+        fin = finished[j]
+        results.append((
+            mid, TABLES[sim['table'][i]], names[sim['p1'][i]], names[sim['p2'][i]],
+            f"{p1s}:{p2s}", ', '.join(f"{a}:{b}" for a, b in sc), fin,
+        ))
+        winner_id = 1 if p1s > p2s else 2
+        progress, comeback = calc_progress_and_comeback(sc)
+        duration_sec, intensity = calc_duration_and_intensity(sc)
+        match_results.append((
+            mid, fin, p1s, p2s, winner_id, 3 - winner_id, duration_sec, intensity, progress, comeback, fin, fin,
+        ))
+        set_rows.extend((mid, k, a, b) for k, (a, b) in enumerate(sc, start=1))
+    return results, match_results, set_rows
+
+
+def _odds(p_win, margin=1.06):
+    p = np.clip(p_win, 0.05, 0.95)
+    return np.round(1.0 / (p * margin), 2), np.round(1.0 / ((1 - p) * margin), 2)
+
+
+def write_odds(conn, sim, names, since, rng, line_snapshots=8, live_ticks=12):
+    """Линия и лайв для матчей с finished >= since: текущие коэффициенты + история изменений."""
+    idx = np.nonzero(sim['finished'] >= np.datetime64(since, 's'))[0]
+    cur = conn.cursor()
+    for i in idx:
+        mid = int(sim['match_id'][i])
+        fin = int(sim['finished'][i].astype('int64'))
+        start_ts = fin - 900
+        table = TABLES[sim['table'][i]]
+        p_true = float(rng.uniform(0.2, 0.8))
+        total_lv = float(rng.choice([72.5, 74.5, 75.5, 76.5]))
+        fora_lv = float(rng.choice([1.5, 2.5, 3.5]))
+        cur.execute("INSERT OR REPLACE INTO line_matches VALUES(?,?,?,?,?,?,?)",
+                    (mid, f"Россия. Лига Про. Мужчины. Стол {table}", table, start_ts, 0, 'finished', start_ts))
+        hist, live_hist = [], []
+        for k in range(line_snapshots):
+            ts = start_ts - (line_snapshots - k) * 600
+            kf1, kf2 = _odds(p_true + rng.normal(0, 0.03))
+            hist += [
+                (mid, 69, 0.0, 'P1', kf1, 6.0, 5000.0, ts), (mid, 69, 0.0, 'P2', kf2, 6.0, 5000.0, ts),
+                (mid, 71, -fora_lv, 'KF_F1', 1.85, 7.0, 3000.0, ts), (mid, 71, fora_lv, 'KF_F2', 1.85, 7.0, 3000.0, ts),
+                (mid, 72, total_lv, 'Tm', 1.85, 7.0, 3000.0, ts), (mid, 72, total_lv, 'Tb', 1.85, 7.0, 3000.0, ts),
+            ]
+        cur.executemany("INSERT INTO line_markets_history VALUES(?,?,?,?,?,?,?,?)", hist)
+        last = hist[-6:]
+        cur.executemany("INSERT OR REPLACE INTO line_market_odds VALUES(?,?,?,?,?,?,?,?)", last)
+        cur.executemany("INSERT OR REPLACE INTO results_odds VALUES(?,?,?,?,?)", [r[:5] for r in last])
+        for m_id, base_lv in ((69, 0.0), (71, fora_lv), (72, total_lv)):
+            blk = {r[3]: {'kf': r[4], 'lv': r[2]} for r in last if r[1] == m_id}
+            cur.execute("INSERT OR REPLACE INTO line_markets VALUES(?,?,?,?,?)",
+                        (mid, m_id, base_lv, json.dumps(blk, separators=(',', ':'), ensure_ascii=False), last[0][7]))
+        for k in range(live_ticks):
+            ts = start_ts + k * (900 // live_ticks)
+            kf1, kf2 = _odds(p_true + rng.normal(0, 0.12))
+            live_hist += [(mid, ts, 69, 0.0, 'P1', kf1, 6.0, 3000.0), (mid, ts, 69, 0.0, 'P2', kf2, 6.0, 3000.0),
+                          (mid, ts, 72, total_lv, 'Tm', 1.85, 7.0, 1000.0), (mid, ts, 72, total_lv, 'Tb', 1.85, 7.0, 1000.0)]
+        cur.executemany("INSERT OR REPLACE INTO live_market_odds VALUES(?,?,?,?,?,?,?,?)", live_hist)
+        cur.executemany("INSERT INTO live_history VALUES(?,?,?,?,?,?,?,?)", live_hist)
+    conn.commit()
+    return len(idx)
+
+
+def generate_db(path, n_players=400, n_matches=100_000, days=360, end_date=None, seed=42, odds_days=7, verbose=True):
+    if os.path.exists(path):
+        os.remove(path)
+    create_tables(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(LINE_DDL)
+    conn.executescript(LIVE_DDL)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    sim = simulate_matches(n_players, n_matches, days, end_date, seed)
+    names = player_names(n_players)
+    cur = conn.cursor()
+    for lo in range(0, n_matches, CHUNK):
+        hi = min(lo + CHUNK, n_matches)
+        results, match_results, set_rows = _chunk_rows(sim, names, lo, hi)
+        cur.executemany("INSERT INTO results VALUES(?,?,?,?,?,?,?)", results)
+        cur.executemany("INSERT INTO match_results VALUES(?,?,?,?,?,?,?,?,?,?,?,?)", match_results)
+        cur.executemany("INSERT INTO set_scores VALUES(?,?,?,?)", set_rows)
+        conn.commit()
+        if verbose:
+            print(f"  {hi}/{n_matches} матчей записано")
+    sync_player_matches(conn)
+    sync_match_features(conn)
+
+    end = sim['finished'][-1] if n_matches else np.datetime64('now', 's')
+    since = (pd.Timestamp(end) - pd.Timedelta(days=odds_days)).to_pydatetime()
+    n_odds = write_odds(conn, sim, names, since, np.random.default_rng(seed + 1)) if odds_days > 0 else 0
+    conn.close()
+    if verbose:
+        print(f"Готово: {path} — {n_players} игроков, {n_matches} матчей, линия/лайв для {n_odds} матчей")
+    return sim
+
+
+# --- Фиды в формате betcity (для write-путей парсеров) ---
+
+def _feed(events_by_table, tournament=True):
+    chmps = {}
+    for k, (table, evts) in enumerate(sorted(events_by_table.items())):
+        name = f"Настольный теннис. Россия. Лига Про. Мужчины. Стол {table}" if tournament else f"Стол {table}"
+        chmps[str(1000 + k)] = {'name_ch': name, 'evts': evts}
+    return {'reply': {'sports': {'46': {'id_sp': 46, 'chmps': chmps}}}}
+
+
+def make_results_feed(sim, names, lo, hi):
+    by_table = {}
+    finished = pd.DatetimeIndex(sim['finished'][lo:hi]).strftime('%Y-%m-%d %H:%M:%S')
+    for j, i in enumerate(range(lo, hi)):
+        ns = int(sim['n_sets'][i])
+        by_table.setdefault(TABLES[sim['table'][i]], {})[str(sim['match_id'][i])] = {
+            'id_ev': int(sim['match_id'][i]),
+            'name_ht': names[sim['p1'][i]],
+            'name_at': names[sim['p2'][i]],
+            'sc_ev': f"{sim['p1_sets'][i]}:{sim['p2_sets'][i]}",
+            'sc_ext_ev': ', '.join(f"{a}:{b}" for a, b in sim['sets'][i, :ns]),
+            'finished': finished[j],
+        }
+    return _feed(by_table)
+
+
+def _main_markets(mid, kf1, kf2, fora_lv=2.5, total_lv=74.5):
+    key = str(mid)
+    return {
+        '69': {'data': {key: {'blocks': {'Wm': {'P1': {'kf': kf1}, 'P2': {'kf': kf2}}}}}},
+        '71': {'data': {key: {'blocks': {'F': {'KF_F1': {'kf': 1.85, 'lv': -fora_lv, 'mx': 3000},
+                                               'KF_F2': {'kf': 1.85, 'lv': fora_lv, 'mx': 3000}}}}}},
+        '72': {'data': {key: {'blocks': {'T': {'Tm': {'kf': 1.85, 'lv': total_lv, 'mx': 3000},
+                                               'Tb': {'kf': 1.85, 'lv': total_lv, 'mx': 3000}}}}}},
+    }
+
+
+def make_line_feed(sim, names, lo, hi, rng):
+    by_table = {}
+    for i in range(lo, hi):
+        mid = int(sim['match_id'][i])
+        kf1, kf2 = _odds(rng.uniform(0.2, 0.8))
+        by_table.setdefault(TABLES[sim['table'][i]], {})[str(mid)] = {
+            'id_ev': mid,
+            'date_ev': int(sim['finished'][i].astype('int64')) - 900,
+            'name_ht': names[sim['p1'][i]],
+            'name_at': names[sim['p2'][i]],
+            'main': _main_markets(mid, float(kf1), float(kf2)),
+        }
+    return _feed(by_table)
+
+
+def make_live_feed(sim, names, lo, hi, rng):
+    feed = make_line_feed(sim, names, lo, hi, rng)
+    for ch in feed['reply']['sports']['46']['chmps'].values():
+        for ev in ch['evts'].values():
+            ev['sc_ev'] = '1:1'
+            ev['sc_ext_ev'] = '11:7, 9:11, 4:3'
+    return feed
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Синтетическая betcity_results.db для бенчмарков')
+    ap.add_argument('--out', default='betcity_results.db')
+    ap.add_argument('--players', type=int, default=400)
+    ap.add_argument('--matches', type=int, default=100_000)
+    ap.add_argument('--days', type=int, default=360, help='Глубина истории в днях')
+    ap.add_argument('--end-date', help='Дата окончания истории YYYY-MM-DD (по умолчанию сегодня)')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--odds-days', type=int, default=7, help='Для скольких последних дней писать линию/лайв')
+    args = ap.parse_args()
+    generate_db(args.out, args.players, args.matches, args.days, args.end_date, args.seed, args.odds_days)
+
+
+if __name__ == '__main__':
+    main()